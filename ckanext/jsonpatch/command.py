@@ -1,11 +1,44 @@
 # encoding: utf-8
 
+import json
 import logging
+import os
 import sys
 
 import ckan.plugins.toolkit as tk
 
 
+def _apply_batch(batch):
+    """
+    Patch a batch of objects in a worker process, using jsonpatch_apply_many.
+
+    :param batch: tuple of (model_name, scope, object_ids)
+    :returns: tuple of (JSON lines of the patched dictionaries, in object id order,
+        list of (object_id, error message) for the objects that could not be patched)
+    """
+    import ckan.model as model
+    from ckanext.jsonpatch.lib import pool
+
+    model_name, scope, object_ids = batch
+    context = pool.worker_context()
+    try:
+        result = tk.get_action('jsonpatch_apply_many')(context, {
+            'model_name': model_name,
+            'object_ids': object_ids,
+            'scope': scope,
+        })
+    except Exception, e:
+        return [], [(object_id, str(e)) for object_id in object_ids]
+    finally:
+        model.Session.remove()
+
+    lines = [json.dumps(result['results'][object_id]) for object_id in object_ids
+             if object_id in result['results']]
+    errors = [(object_id, result['errors'][object_id]) for object_id in object_ids
+              if object_id in result['errors']]
+    return lines, errors
+
+
 class JSONPatchCommand(tk.CkanCommand):
     """
     JSONPatch management commands.
@@ -13,10 +46,111 @@ class JSONPatchCommand(tk.CkanCommand):
     Usage:
         paster jsonpatch initdb
             - Initialize the database tables for the jsonpatch plugin
+
+        paster jsonpatch upgradedb
+            - Create any missing tables and indexes on an existing installation
+              (indexes are built concurrently on PostgreSQL)
+
+        paster jsonpatch rebuild-index
+            - Regenerate the denormalized per-object operation lists from the jsonpatch table
+
+        paster jsonpatch compact [--dry-run] [--model=<model_name>]
+            - Reduce each object's list of patches to a minimal equivalent list, reporting the
+              number of operations removed per object
+
+        paster jsonpatch materialize [--model=<model_name>]
+            - Store the patched dictionaries of all patched objects (of the models for which
+              materialization is enabled), for every scope, where missing or stale
+
+        paster jsonpatch export [--output=<file>] [--gzip] [--model=<model_name>]
+                                [--after=<id>] [--checkpoint=<file>]
+            - Write all patches, in id order, as newline-delimited JSON to stdout or the given file;
+              the export may be resumed after the given patch id, or from a checkpoint file
+              that records the last id written, to an output file that does not yet exist
+
+        paster jsonpatch import <file> [--gzip] [--chunk-size=<n>] [--after=<id>] [--checkpoint=<file>]
+            - Load patches from newline-delimited JSON ('-' for stdin), skipping any that already
+              exist; each chunk of patches is saved under one revision and committed, and the
+              import may be resumed after the given patch id, or from a checkpoint file
+
+        paster jsonpatch apply-all [--model=<model_name>] [--scope=<scope>] [--workers=<n>]
+                                   [--batch-size=<n>] [--ordered] [--output=<file>] [--gzip]
+            - Write the patched dictionaries of all objects with patches (in the given scope) as
+              newline-delimited JSON to stdout or the given file, applying the patches in batches
+              across a pool of worker processes; with --ordered, objects are written in id order
+
+        paster jsonpatch check [--model=<model_name>] [--workers=<n>] [--batch-size=<n>]
+                               [--timeout=<seconds>] [--recheck] [--deactivate]
+            - Apply the patches of all patched objects, for every scope, across a pool of worker
+              processes, recording for each object whether its patches apply, or the first
+              operation that fails; objects that have not changed since their last check are
+              skipped, unless --recheck is given, and with --deactivate, patches whose operations
+              fail in the list for their own scope are deleted
+
+        paster jsonpatch prune-revisions --older-than=<days> [--batch-size=<n>]
+            - Delete the versions of patches that were superseded more than the given number of
+              days ago, and the revisions that no longer apply to any object
+
+        paster jsonpatch migrate-jsonb [--batch-size=<n>]
+            - Convert the JSON columns of the patch tables to JSONB, copying the given number of
+              rows per transaction, and build GIN indexes on patch operations and data
+              (PostgreSQL only; may be run against a live site, and resumed if interrupted)
+
+        paster jsonpatch benchmark [--resources=<n>] [--patches=<n>] [--repeat=<n>]
+            - Compare the time taken to apply patches to a synthetic package dictionary using the
+              jsonpatch library directly (which deep-copies the document) and using compiled
+              patches applied to a shared document and in place
+
+        paster jsonpatch benchmark-actions [--resources=<n>] [--patches=<n>] [--repeat=<n>] [--output=<file>]
+            - Time jsonpatch_create, jsonpatch_list (with and without all_fields), jsonpatch_apply
+              and patch validation against the configured database, for synthetic packages of
+              various sizes with various numbers of patches, writing the results, together with
+              the git commit of this extension, as a JSON document to stdout or the given file
     """
     summary = __doc__.split('\n')[0]
     usage = __doc__
 
+    def __init__(self, name):
+        super(JSONPatchCommand, self).__init__(name)
+        self.parser.add_option('--dry-run', dest='dry_run', action='store_true', default=False,
+                               help='report changes without modifying any patches')
+        self.parser.add_option('--model', dest='model_name', default=None,
+                               help='only process patches for the given model name')
+        self.parser.add_option('--output', dest='output', default=None,
+                               help='file to which to export patches (default: stdout)')
+        self.parser.add_option('--gzip', dest='gzip', action='store_true', default=False,
+                               help='compress the export, or decompress the import, with gzip')
+        self.parser.add_option('--after', dest='after', default=None,
+                               help='resume an export or import after the given patch id')
+        self.parser.add_option('--checkpoint', dest='checkpoint', default=None,
+                               help='file recording the last patch id exported or imported, '
+                                    'from which an interrupted run is resumed')
+        self.parser.add_option('--chunk-size', dest='chunk_size', type='int', default=1000,
+                               help='number of patches imported per revision and transaction')
+        self.parser.add_option('--scope', dest='scope', default=None,
+                               help='apply only patches with the given scope')
+        self.parser.add_option('--workers', dest='workers', type='int', default=4,
+                               help='number of worker processes')
+        self.parser.add_option('--batch-size', dest='batch_size', type='int', default=100,
+                               help='number of objects patched, revisions pruned, '
+                                    'or rows converted to JSONB, per batch')
+        self.parser.add_option('--older-than', dest='older_than', type='int', default=None,
+                               help='prune revisions superseded more than this many days ago')
+        self.parser.add_option('--ordered', dest='ordered', action='store_true', default=False,
+                               help='write patched objects in id order')
+        self.parser.add_option('--timeout', dest='timeout', type='int', default=None,
+                               help='time limit in seconds for checking an object')
+        self.parser.add_option('--recheck', dest='recheck', action='store_true', default=False,
+                               help='check all objects, including those unchanged since their last check')
+        self.parser.add_option('--deactivate', dest='deactivate', action='store_true', default=False,
+                               help='delete patches whose operations cannot be applied in the list for their scope')
+        self.parser.add_option('--resources', dest='resources', type='int', default=None,
+                               help='number of resources in the benchmark package')
+        self.parser.add_option('--patches', dest='patches', type='int', default=None,
+                               help='number of patches in the benchmark')
+        self.parser.add_option('--repeat', dest='repeat', type='int', default=20,
+                               help='number of repetitions of each benchmark measurement')
+
     def command(self):
         if not self.args or self.args[0] in ['--help', '-h', 'help']:
             print self.usage
@@ -30,8 +164,305 @@ class JSONPatchCommand(tk.CkanCommand):
 
         if cmd == 'initdb':
             self._initdb()
+        elif cmd == 'upgradedb':
+            self._upgradedb()
+        elif cmd == 'rebuild-index':
+            self._rebuild_index()
+        elif cmd == 'compact':
+            self._compact()
+        elif cmd == 'materialize':
+            self._materialize()
+        elif cmd == 'export':
+            self._export()
+        elif cmd == 'import':
+            self._import()
+        elif cmd == 'apply-all':
+            self._apply_all()
+        elif cmd == 'check':
+            self._check()
+        elif cmd == 'prune-revisions':
+            self._prune_revisions()
+        elif cmd == 'migrate-jsonb':
+            self._migrate_jsonb()
+        elif cmd == 'benchmark':
+            self._benchmark()
+        elif cmd == 'benchmark-actions':
+            self._benchmark_actions()
+        else:
+            print 'Command %s not recognized' % cmd
 
     def _initdb(self):
         from ckanext.jsonpatch.model import setup
         setup.init_tables()
         self.log.info("JSONPatch tables have been initialized")
+
+    def _upgradedb(self):
+        from ckanext.jsonpatch.model import setup
+        setup.upgrade_tables()
+        self.log.info("JSONPatch tables have been upgraded")
+
+    def _rebuild_index(self):
+        import ckan.model as model
+        from ckanext.jsonpatch.model.jsonpatch import JSONPatch
+        from ckanext.jsonpatch.model.oplist import JSONPatchOplist
+
+        # include objects whose patches have all been deleted, so that their stale lists are removed
+        objects = model.Session.query(JSONPatch.model_name, JSONPatch.object_id) \
+            .union(model.Session.query(JSONPatchOplist.model_name, JSONPatchOplist.object_id)) \
+            .all()
+
+        for i, (model_name, object_id) in enumerate(objects, 1):
+            JSONPatchOplist.rebuild(model_name, object_id)
+            if i % 1000 == 0:
+                model.Session.commit()
+                self.log.info("Rebuilt operation lists for %d of %d objects", i, len(objects))
+        model.Session.commit()
+        self.log.info("Rebuilt operation lists for %d objects", len(objects))
+
+    def _compact(self):
+        import ckan.model as model
+        from ckanext.jsonpatch.model.jsonpatch import JSONPatch
+
+        q = model.Session.query(JSONPatch.model_name, JSONPatch.object_id).filter_by(state='active').distinct()
+        if self.options.model_name:
+            q = q.filter_by(model_name=self.options.model_name)
+        objects = q.all()
+
+        site_user = tk.get_action('get_site_user')({'ignore_auth': True}, {})
+        total_before = total_after = 0
+        for model_name, object_id in objects:
+            context = {'model': model, 'session': model.Session, 'user': site_user['name'], 'ignore_auth': True}
+            result = tk.get_action('jsonpatch_compact')(context, {
+                'model_name': model_name,
+                'object_id': object_id,
+                'dry_run': self.options.dry_run,
+            })
+            total_before += result['operations_before']
+            total_after += result['operations_after']
+            removed = result['operations_before'] - result['operations_after']
+            if removed or result['modified_ids']:
+                print '%s %s: %d operations removed, %d merged' % (
+                    model_name, object_id, removed, len(result['modified_ids']))
+
+        print '%s %d objects: %d operations reduced to %d' % (
+            'Would compact' if self.options.dry_run else 'Compacted', len(objects), total_before, total_after)
+
+    def _materialize(self):
+        import ckan.model as model
+        from ckanext.jsonpatch.model.oplist import JSONPatchOplist
+        from ckanext.jsonpatch.lib import materialize
+
+        if self.options.model_name:
+            model_names = [self.options.model_name]
+        else:
+            model_names = [model_name for (model_name,) in model.Session.query(JSONPatchOplist.model_name).distinct()]
+        model_names = [model_name for model_name in model_names if materialize.is_enabled(model_name)]
+        if not model_names:
+            print 'Materialization is not enabled for any patched model (see ckanext.jsonpatch.materialize)'
+            return
+
+        oplists = model.Session.query(JSONPatchOplist.model_name, JSONPatchOplist.object_id, JSONPatchOplist.scope) \
+            .filter(JSONPatchOplist.model_name.in_(model_names)) \
+            .all()
+
+        site_user = tk.get_action('get_site_user')({'ignore_auth': True}, {})
+        failed = 0
+        for i, (model_name, object_id, scope) in enumerate(oplists, 1):
+            context = {'model': model, 'session': model.Session, 'user': site_user['name'], 'ignore_auth': True}
+            try:
+                # jsonpatch_apply stores the patched dictionary if it is missing or stale
+                tk.get_action('jsonpatch_apply')(context, {
+                    'model_name': model_name,
+                    'object_id': object_id,
+                    'scope': scope,
+                })
+            except Exception, e:
+                failed += 1
+                self.log.error("Unable to materialize %s %s (scope: %s): %s", model_name, object_id, scope, e)
+            if i % 1000 == 0:
+                self.log.info("Materialized %d of %d patched objects/scopes", i, len(oplists))
+            model.Session.remove()
+
+        print 'Materialized %d patched objects/scopes (%d failed)' % (len(oplists) - failed, failed)
+
+    def _export(self):
+        import gzip
+        from ckanext.jsonpatch.lib.transfer import export_patches
+
+        after = self._resume_id()
+        if after and self.options.output and os.path.exists(self.options.output):
+            # the existing file holds the patches exported before the interruption (possibly ending
+            # with a partial line written after the last checkpoint), which opening it would discard
+            print 'Output file %s exists: a resumed export must be written to a new file' % self.options.output
+            sys.exit(1)
+
+        if self.options.output:
+            out = gzip.open(self.options.output, 'wb') if self.options.gzip else open(self.options.output, 'w')
+        else:
+            out = gzip.GzipFile(fileobj=sys.stdout, mode='wb') if self.options.gzip else sys.stdout
+
+        def checkpoint(last_id, count):
+            out.flush()
+            self._save_checkpoint(last_id)
+            self.log.info("Exported %d patches (checkpoint: %s)", count, last_id)
+
+        try:
+            count = export_patches(out, after=after, model_name=self.options.model_name,
+                                   checkpoint=checkpoint)
+        finally:
+            if out is not sys.stdout:
+                out.close()
+        self.log.info("Exported %d patches", count)
+
+    def _import(self):
+        import gzip
+        from ckanext.jsonpatch.lib.transfer import import_patches
+
+        if len(self.args) < 2:
+            print 'Usage: paster jsonpatch import <file>'
+            sys.exit(1)
+        filename = self.args[1]
+        if filename == '-':
+            lines = gzip.GzipFile(fileobj=sys.stdin, mode='rb') if self.options.gzip else sys.stdin
+        else:
+            lines = gzip.open(filename, 'rb') if self.options.gzip or filename.endswith('.gz') else open(filename)
+
+        def checkpoint(last_id, count):
+            self._save_checkpoint(last_id)
+            self.log.info("Processed %d patches (checkpoint: %s)", count, last_id)
+
+        site_user = tk.get_action('get_site_user')({'ignore_auth': True}, {})
+        try:
+            imported, skipped = import_patches(lines, site_user['name'], after=self._resume_id(),
+                                               chunk_size=self.options.chunk_size, checkpoint=checkpoint)
+        finally:
+            if lines is not sys.stdin:
+                lines.close()
+        print 'Imported %d patches (%d already existed)' % (imported, skipped)
+
+    def _apply_all(self):
+        import gzip
+        import time
+        import ckan.model as model
+        from ckanext.jsonpatch.lib import pool
+        from ckanext.jsonpatch.model.oplist import JSONPatchOplist, ALL_SCOPES
+
+        model_name = self.options.model_name or 'package'
+        q = model.Session.query(JSONPatchOplist.object_id) \
+            .filter_by(model_name=model_name, scope=self.options.scope or ALL_SCOPES)
+        if self.options.ordered:
+            q = q.order_by(JSONPatchOplist.object_id)
+        object_ids = [object_id for (object_id,) in q]
+        batch_size = max(self.options.batch_size, 1)
+        batches = [(model_name, self.options.scope, object_ids[i:i + batch_size])
+                   for i in xrange(0, len(object_ids), batch_size)]
+
+        site_user = tk.get_action('get_site_user')({'ignore_auth': True}, {})
+
+        if self.options.output:
+            out = gzip.open(self.options.output, 'wb') if self.options.gzip else open(self.options.output, 'w')
+        else:
+            out = gzip.GzipFile(fileobj=sys.stdout, mode='wb') if self.options.gzip else sys.stdout
+
+        start = time.time()
+        written = failed = 0
+        try:
+            for lines, errors in pool.imap(_apply_batch, batches, self.options.workers, site_user['name'],
+                                           ordered=self.options.ordered):
+                for line in lines:
+                    out.write(line + '\n')
+                written += len(lines)
+                for object_id, message in errors:
+                    self.log.error("Unable to apply JSON Patches to %s %s: %s", model_name, object_id, message)
+                failed += len(errors)
+                elapsed = time.time() - start
+                self.log.info("Patched %d of %d objects (%d failed, %.1f objects/s)", written + failed,
+                              len(object_ids), failed, (written + failed) / elapsed if elapsed else 0)
+        finally:
+            if out is not sys.stdout:
+                out.close()
+            else:
+                out.flush()
+
+        elapsed = time.time() - start
+        self.log.info("Wrote %d patched %s dictionaries in %.1f s (%.1f objects/s); %d failed",
+                      written, model_name, elapsed, written / elapsed if elapsed else 0, failed)
+
+    def _check(self):
+        from ckanext.jsonpatch.lib import health
+
+        totals = health.run(model_name=self.options.model_name,
+                            recheck=self.options.recheck,
+                            deactivate=self.options.deactivate,
+                            workers=self.options.workers,
+                            batch_size=max(self.options.batch_size, 1),
+                            timeout=self.options.timeout)
+        print 'Checked patched objects: %s' % (
+            ', '.join('%d %s' % (count, status) for status, count in sorted(totals.iteritems())) or 'none')
+
+    def _prune_revisions(self):
+        import datetime
+        from ckanext.jsonpatch.lib import revisions
+
+        if self.options.older_than is None:
+            print 'Usage: paster jsonpatch prune-revisions --older-than=<days>'
+            sys.exit(1)
+        older_than = datetime.datetime.utcnow() - datetime.timedelta(days=self.options.older_than)
+        versions, revs = revisions.prune(older_than, batch_size=max(self.options.batch_size, 1))
+        print 'Deleted %d patch versions and %d revisions superseded before %s' % (
+            versions, revs, older_than.isoformat())
+
+    def _migrate_jsonb(self):
+        from ckanext.jsonpatch.lib import storage
+
+        try:
+            count = storage.migrate_to_jsonb(batch_size=max(self.options.batch_size, 1))
+        except ValueError, e:
+            print str(e)
+            sys.exit(1)
+        print 'Converted %d rows to JSONB storage' % count
+
+    def _resume_id(self):
+        """
+        Return the patch id after which to resume an export or import: the --after option, or
+        the id recorded in the checkpoint file, if it exists.
+        """
+        if self.options.after:
+            return self.options.after
+        if self.options.checkpoint and os.path.exists(self.options.checkpoint):
+            with open(self.options.checkpoint) as f:
+                return f.read().strip() or None
+        return None
+
+    def _save_checkpoint(self, last_id):
+        if self.options.checkpoint:
+            with open(self.options.checkpoint, 'w') as f:
+                f.write(last_id + '\n')
+
+    def _benchmark(self):
+        from ckanext.jsonpatch.lib.benchmark import benchmark_apply
+
+        resources_list = [self.options.resources] if self.options.resources is not None else [10, 100, 1000]
+        patches_list = [self.options.patches] if self.options.patches is not None else [1, 10, 100]
+        for resources in resources_list:
+            for patches in patches_list:
+                result = benchmark_apply(resources=resources, patches=patches, repeat=self.options.repeat)
+                print json.dumps(result, sort_keys=True)
+
+    def _benchmark_actions(self):
+        from ckanext.jsonpatch.lib.benchmark import benchmark_actions, environment
+
+        resources_list = [self.options.resources] if self.options.resources is not None else [1, 100, 1000]
+        patches_list = [self.options.patches] if self.options.patches is not None else [1, 100, 1000, 10000]
+        results = []
+        for resources in resources_list:
+            for patches in patches_list:
+                self.log.info("Benchmarking actions with %d resources and %d patches", resources, patches)
+                results += [benchmark_actions(resources=resources, patches=patches, repeat=self.options.repeat)]
+
+        output = json.dumps({'environment': environment(), 'results': results}, indent=2, sort_keys=True)
+        if self.options.output:
+            with open(self.options.output, 'w') as f:
+                f.write(output + '\n')
+        else:
+            print output
@@ -0,0 +1,231 @@
+# encoding: utf-8
+
+import copy
+import datetime
+import json
+import os
+import time
+import uuid
+import jsonpatch
+from sqlalchemy import select, and_
+
+from ckanext.jsonpatch.lib.patch import CompiledPatch
+
+
+def synthetic_package(resources=10, extras=10):
+    """
+    Return a dictionary shaped like the output of package_show.
+    """
+    package_id = unicode(uuid.uuid4())
+    return {
+        'id': package_id,
+        'name': u'benchmark-' + package_id,
+        'title': u'Benchmark dataset',
+        'notes': u'A synthetic dataset. ' * 50,
+        'state': u'active',
+        'private': False,
+        'tags': [{'name': u'tag-%d' % i, 'display_name': u'tag-%d' % i} for i in xrange(10)],
+        'extras': [{'key': u'extra-%d' % i, 'value': u'value %d' % i} for i in xrange(extras)],
+        'resources': [{
+            'id': unicode(uuid.uuid4()),
+            'package_id': package_id,
+            'name': u'Resource %d' % i,
+            'description': u'A synthetic resource. ' * 10,
+            'url': u'http://example.org/resource/%d' % i,
+            'format': u'CSV',
+            'position': i,
+        } for i in xrange(resources)],
+    }
+
+
+def synthetic_oplist(package_dict, patches=10):
+    """
+    Return a list of operations touching a mix of top-level fields, extras and resources of the
+    given package dictionary.
+    """
+    resources = len(package_dict['resources'])
+    extras = len(package_dict['extras'])
+    oplist = []
+    for i in xrange(patches):
+        kind = i % 4
+        if kind == 0:
+            oplist += [{'op': 'replace', 'path': '/title', 'value': u'Patched title %d' % i}]
+        elif kind == 1 and extras:
+            oplist += [{'op': 'replace', 'path': '/extras/%d/value' % (i % extras), 'value': u'patched %d' % i}]
+        elif kind == 2 and resources:
+            oplist += [{'op': 'replace', 'path': '/resources/%d/name' % (i % resources), 'value': u'Patched %d' % i}]
+        else:
+            oplist += [{'op': 'add', 'path': '/patched_%d' % i, 'value': {'index': i}}]
+    return oplist
+
+
+def timed(func, inputs):
+    """
+    Call func once for each of the given inputs.
+
+    :returns: the mean duration of a call, in milliseconds
+    """
+    start = time.time()
+    for item in inputs:
+        func(item)
+    return (time.time() - start) * 1000.0 / len(inputs)
+
+
+def benchmark_apply(resources=10, extras=10, patches=10, repeat=20):
+    """
+    Compare the ways of applying a patch to a package dictionary: the jsonpatch library's default
+    (a deep copy of the document), a compiled patch applied to a shared document (copying only the
+    containers along the patched paths), and a compiled patch applied in place.
+
+    :returns: dictionary of mean durations in milliseconds
+    """
+    package_dict = synthetic_package(resources, extras)
+    oplist = synthetic_oplist(package_dict, patches)
+    compiled = CompiledPatch(oplist)
+
+    results = {
+        'resources': resources,
+        'extras': extras,
+        'patches': patches,
+        'size_bytes': len(json.dumps(package_dict)),
+        'jsonpatch_deepcopy_ms': timed(lambda doc: jsonpatch.JsonPatch(oplist).apply(doc), [package_dict] * repeat),
+        'compiled_shared_ms': timed(lambda doc: compiled.apply(doc), [package_dict] * repeat),
+    }
+    # patching in place consumes its input, so each call is given its own copy
+    copies = [copy.deepcopy(package_dict) for i in xrange(repeat)]
+    results['compiled_in_place_ms'] = timed(lambda doc: compiled.apply(doc, in_place=True), copies)
+    return results
+
+
+def sampled(func, inputs):
+    """
+    Call func once for each of the given inputs, timing each call.
+
+    :returns: dictionary of the mean, median and 95th percentile durations, in milliseconds
+    """
+    durations = []
+    for item in inputs:
+        start = time.time()
+        func(item)
+        durations.append((time.time() - start) * 1000.0)
+    durations.sort()
+    return {
+        'mean_ms': sum(durations) / len(durations),
+        'p50_ms': durations[len(durations) // 2],
+        'p95_ms': durations[min(int(len(durations) * 0.95), len(durations) - 1)],
+    }
+
+
+def benchmark_actions(resources=10, extras=10, patches=10, repeat=20):
+    """
+    Time the jsonpatch actions against the configured database, for a synthetic package with
+    the given number of resources and extras, having the given number of patches. The package and
+    its patches are purged afterwards.
+
+    jsonpatch_create is timed for the first patches created (up to repeat); the remaining patches
+    are created in bulk. Each jsonpatch_apply call is made with an empty result cache.
+
+    :returns: dictionary of timings, each a dictionary as returned by sampled()
+    """
+    import ckan.model as model
+    import ckan.plugins.toolkit as tk
+    from ckanext.jsonpatch.lib import cache
+    from ckanext.jsonpatch.logic import schema
+
+    site_user = tk.get_action('get_site_user')({'ignore_auth': True}, {})
+
+    def context():
+        return {'model': model, 'session': model.Session, 'user': site_user['name']}
+
+    package_dict = synthetic_package(resources, extras)
+    for resource_dict in package_dict['resources']:
+        del resource_dict['id'], resource_dict['package_id']
+    package_dict['tags'] = [{'name': tag_dict['name']} for tag_dict in package_dict['tags']]
+    del package_dict['id']
+    package_id = tk.get_action('package_create')(context(), package_dict)['id']
+
+    try:
+        oplist = synthetic_oplist(tk.get_action('package_show')(context(), {'id': package_id}), patches)
+        patch_dicts = [{
+            'model_name': 'package',
+            'object_id': package_id,
+            'operation': operation,
+        } for operation in oplist]
+        results = {
+            'resources': resources,
+            'extras': extras,
+            'patches': patches,
+        }
+
+        timed_creates = min(repeat, patches)
+        create = tk.get_action('jsonpatch_create')
+        results['jsonpatch_create'] = sampled(lambda patch_dict: create(context(), dict(patch_dict)),
+                                              patch_dicts[:timed_creates])
+        for i in xrange(timed_creates, patches, 1000):
+            tk.get_action('jsonpatch_create_many')(context(), {'patches': patch_dicts[i:i + 1000]})
+
+        list_params = {'model_name': 'package', 'object_id': package_id}
+        list_ = tk.get_action('jsonpatch_list')
+        results['jsonpatch_list'] = sampled(lambda params: list_(context(), dict(params)), [list_params] * repeat)
+        results['jsonpatch_list_all_fields'] = sampled(lambda params: list_(context(), dict(params, all_fields=True)),
+                                                       [list_params] * repeat)
+
+        apply_ = tk.get_action('jsonpatch_apply')
+
+        def apply_uncached(params):
+            cache.invalidate('package', package_id)
+            return apply_(context(), dict(params))
+
+        results['jsonpatch_apply'] = sampled(apply_uncached, [list_params] * repeat)
+
+        create_schema = schema.jsonpatch_create_schema()
+        results['validate_create'] = sampled(lambda patch_dict: tk.navl_validate(dict(patch_dict), create_schema, context()),
+                                             [patch_dicts[0]] * repeat)
+        results['size_bytes'] = len(json.dumps(apply_(context(), dict(list_params))))
+        return results
+
+    finally:
+        model.Session.rollback()
+        _purge_patches('package', package_id)
+        tk.get_action('dataset_purge')(context(), {'id': package_id})
+
+
+def _purge_patches(model_name, object_id):
+    """
+    Delete an object's patches, and their revision history, from the database.
+    """
+    import ckan.model as model
+    from ckanext.jsonpatch.lib import cache, materialize
+    from ckanext.jsonpatch.model.jsonpatch import jsonpatch_table, jsonpatch_revision_table
+    from ckanext.jsonpatch.model.oplist import JSONPatchOplist
+
+    is_object_patch = and_(jsonpatch_table.c.model_name == model_name, jsonpatch_table.c.object_id == object_id)
+    model.Session.execute(jsonpatch_revision_table.delete().where(
+        jsonpatch_revision_table.c.continuity_id.in_(select([jsonpatch_table.c.id]).where(is_object_patch))))
+    model.Session.execute(jsonpatch_table.delete().where(is_object_patch))
+    JSONPatchOplist.rebuild(model_name, object_id)
+    materialize.expire(model_name, object_id)
+    model.Session.commit()
+    cache.invalidate(model_name, object_id)
+
+
+def environment():
+    """
+    Return a description of the environment in which benchmarks are run, for comparing results
+    across commits: the git commit of this extension, the Python version and the database dialect.
+    """
+    import platform
+    import subprocess
+    from ckan.model import meta
+
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(__file__),
+                                         stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'timestamp': datetime.datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'database': meta.engine.dialect.name,
+    }
@@ -0,0 +1,215 @@
+# encoding: utf-8
+
+import json
+import logging
+import threading
+import time
+import importlib
+from collections import OrderedDict
+from paste.deploy.converters import asint
+
+log = logging.getLogger(__name__)
+
+_cache = None
+
+
+class MemoryBackend(object):
+    """
+    In-process LRU store with an optional per-entry time-to-live (in seconds; 0 for no expiry).
+    """
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._keys_by_object = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires and expires < time.time():
+                self._discard(key)
+                return None
+            # re-insert to mark as most recently used
+            self._entries[key] = entry
+            return value
+
+    def set(self, key, value):
+        expires = time.time() + self.ttl if self.ttl else None
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, expires)
+            self._keys_by_object.setdefault(key[:2], set()).add(key)
+            while len(self._entries) > self.size:
+                oldest_key = next(iter(self._entries))
+                self._entries.pop(oldest_key)
+                self._discard(oldest_key)
+
+    def invalidate(self, model_name, object_id):
+        with self._lock:
+            for key in self._keys_by_object.pop((model_name, object_id), ()):
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_object.clear()
+
+    def _discard(self, key):
+        self._entries.pop(key, None)
+        keys = self._keys_by_object.get(key[:2])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_object[key[:2]]
+
+
+class RedisBackend(object):
+    """
+    Store shared between processes, using CKAN's Redis connection.
+
+    Each object has a generation counter that forms part of its entry keys; invalidating the object
+    increments the counter, which orphans all its entries (for all scopes and kwargs) at once. The
+    orphaned entries expire according to the TTL.
+    """
+    prefix = 'ckanext-jsonpatch:apply:'
+
+    def __init__(self, size, ttl):
+        from ckan.lib.redis import connect_to_redis
+        self.ttl = ttl
+        self._redis = connect_to_redis()
+
+    def get(self, key):
+        return self._redis.get(self._entry_key(key))
+
+    def set(self, key, value):
+        self._redis.set(self._entry_key(key), value, ex=self.ttl or None)
+
+    def invalidate(self, model_name, object_id):
+        self._redis.incr(self._generation_key(model_name, object_id))
+
+    def clear(self):
+        for key in self._redis.scan_iter(self.prefix + '*'):
+            self._redis.delete(key)
+
+    def _generation_key(self, model_name, object_id):
+        return self.prefix + json.dumps(['generation', model_name, object_id])
+
+    def _entry_key(self, key):
+        generation = self._redis.get(self._generation_key(*key[:2])) or '0'
+        return self.prefix + json.dumps(['entry', generation] + list(key))
+
+
+BACKENDS = {
+    'memory': MemoryBackend,
+    'redis': RedisBackend,
+}
+
+
+class ApplyCache(object):
+    """
+    Cache of jsonpatch_apply results, keyed on (model_name, object_id, scope, kwargs).
+
+    Each entry records the version of the operation list and the modification time of the source
+    object from which it was derived, and is only returned while both are current. Entries are
+    therefore never served stale, even if they were not invalidated, e.g. by another process;
+    invalidation merely frees them early.
+
+    Values are stored as JSON strings, so that every hit returns a new dictionary that the caller
+    is free to modify.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.invalidations = 0
+
+    def get(self, model_name, object_id, scope, kwargs, patch_version, source_modified):
+        value = self.backend.get(self._key(model_name, object_id, scope, kwargs))
+        if value is None:
+            self.misses += 1
+            return None
+        entry = json.loads(value)
+        if entry['patch_version'] != patch_version or entry['source_modified'] != source_modified:
+            self.stale += 1
+            return None
+        self.hits += 1
+        return entry['object']
+
+    def set(self, model_name, object_id, scope, kwargs, patch_version, source_modified, object_dict):
+        try:
+            value = json.dumps({
+                'patch_version': patch_version,
+                'source_modified': source_modified,
+                'object': object_dict,
+            })
+        except (TypeError, ValueError), e:
+            log.warning("Unable to cache patched %s %s: %s", model_name, object_id, e)
+            return
+        self.backend.set(self._key(model_name, object_id, scope, kwargs), value)
+
+    def invalidate(self, model_name, object_id):
+        self.invalidations += 1
+        self.backend.invalidate(model_name, object_id)
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        return {
+            'backend': self.backend.__class__.__name__,
+            'hits': self.hits,
+            'misses': self.misses,
+            'stale': self.stale,
+            'invalidations': self.invalidations,
+        }
+
+    @staticmethod
+    def _key(model_name, object_id, scope, kwargs):
+        return model_name, object_id, scope or None, json.dumps(kwargs or {}, sort_keys=True)
+
+
+def configure(config):
+    """
+    Set up the jsonpatch_apply result cache from the CKAN config. The cache is disabled unless
+    ``ckanext.jsonpatch.cache.backend`` is set, to ``memory``, ``redis``, or the dotted path
+    (``package.module:Class``) of a custom backend class.
+    """
+    global _cache
+    backend_name = config.get('ckanext.jsonpatch.cache.backend')
+    if not backend_name:
+        _cache = None
+        return
+
+    size = asint(config.get('ckanext.jsonpatch.cache.size', 1000))
+    ttl = asint(config.get('ckanext.jsonpatch.cache.ttl', 300))
+
+    if backend_name in BACKENDS:
+        backend_class = BACKENDS[backend_name]
+    else:
+        module_name, sep, class_name = backend_name.partition(':')
+        backend_class = getattr(importlib.import_module(module_name), class_name)
+
+    _cache = ApplyCache(backend_class(size, ttl))
+    log.info("JSON Patch apply cache enabled, using %s", backend_class.__name__)
+
+
+def get_cache():
+    """
+    Return the jsonpatch_apply result cache, or None if caching is disabled.
+    """
+    return _cache
+
+
+def invalidate(model_name, object_id):
+    """
+    Discard all cached results for the given object.
+    """
+    if _cache is not None:
+        _cache.invalidate(model_name, object_id)
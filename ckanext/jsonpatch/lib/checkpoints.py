@@ -0,0 +1,147 @@
+# encoding: utf-8
+
+"""
+Write-time checking of patch operations against cached patched states.
+
+A new or updated patch is checked by applying its operation alone to the patched state of the
+object at the patch's position in the object's operation list. Patched states are cached per
+process, for each object and scope, at every ``checkpoint_interval`` operations, and after the
+most recently checked operation. A state is reused for as long as the operations preceding it
+are unchanged, so that a patch appended to the list is checked by applying its operation only,
+and a patch inserted mid-list by replaying the operations from the nearest preceding checkpoint.
+
+Checking is enabled for all writes with ``ckanext.jsonpatch.validate = true``, or per request
+with the 'validate' parameter of the create and update actions.
+"""
+
+import logging
+import jsonpatch
+import jsonpointer
+from paste.deploy.converters import asbool, asint
+
+import ckan.plugins.toolkit as tk
+from ckanext.jsonpatch.lib import materialize
+from ckanext.jsonpatch.lib.cache import MemoryBackend
+from ckanext.jsonpatch.lib.patch import CompiledPatch
+from ckanext.jsonpatch.model.oplist import JSONPatchOplist, ALL_SCOPES
+
+log = logging.getLogger(__name__)
+
+_enabled = False
+_interval = 50
+_states = MemoryBackend(100, 300)
+
+
+def configure(config):
+    global _enabled, _interval, _states
+    _enabled = asbool(config.get('ckanext.jsonpatch.validate', False))
+    _interval = max(asint(config.get('ckanext.jsonpatch.validate.checkpoint_interval', 50)), 1)
+    _states = MemoryBackend(asint(config.get('ckanext.jsonpatch.validate.cache_size', 100)),
+                            asint(config.get('ckanext.jsonpatch.validate.ttl', 300)))
+
+
+def is_enabled():
+    return _enabled
+
+
+def invalidate(model_name, object_id):
+    """
+    Discard the cached patched states of an object, e.g. when the object itself is updated.
+    """
+    _states.invalidate(model_name, object_id)
+
+
+class _Entry(object):
+    """
+    The cached patched states of an object for a scope.
+
+    :ivar patch_ids: the ids of the patches in the operation list from which the states were computed
+    :ivar operations: the operations of those patches
+    :ivar states: dictionary of patched states by the number of operations applied; the state
+        for 0 is the unpatched object
+    """
+
+    __slots__ = ('source_modified', 'patch_ids', 'operations', 'states')
+
+    def __init__(self, source_modified, object_dict):
+        self.source_modified = source_modified
+        self.patch_ids = []
+        self.operations = []
+        self.states = {0: object_dict}
+
+
+def check(context, model_name, object_id, scope, patch_id):
+    """
+    Check that a patch's operation can be applied at its position in the object's operation list
+    for the patch's scope (or for all scopes, if the patch has no scope). The operation list must
+    already include the patch, i.e. this is called after the object's derived tables have been
+    updated, and before the transaction is committed.
+
+    Operations following the patch are not checked.
+
+    :raises jsonpatch.JsonPatchException, jsonpointer.JsonPointerException: if the operation
+        cannot be applied
+    :returns: False if the operation could not be checked, because the operations preceding it
+        cannot be applied; True otherwise
+    """
+    oplist = JSONPatchOplist.get(model_name, object_id, scope)
+    if oplist is None or patch_id not in oplist.patch_ids:
+        return True
+    position = oplist.patch_ids.index(patch_id)
+    operations = oplist.operations
+
+    key = (model_name, object_id, scope or ALL_SCOPES)
+    source_modified = materialize.get_source_modified(context, model_name, object_id) \
+        if materialize.has_source_modified(model_name) else None
+    entry = _states.get(key)
+    if entry is None or entry.source_modified != source_modified:
+        entry = _Entry(source_modified, _show(context, model_name, object_id))
+
+    # a state remains valid for as long as the operations preceding it are unchanged
+    valid = _common_prefix(entry, oplist.patch_ids, operations)
+    states = dict((n, state) for n, state in entry.states.iteritems()
+                  if n <= valid and (n % _interval == 0 or n == position))
+    start = max(n for n in states if n <= position)
+    state = states[start]
+    try:
+        while start < position:
+            end = min(position, (start // _interval + 1) * _interval)
+            state = CompiledPatch(operations[start:end]).apply(state)
+            start = end
+            if end % _interval == 0:
+                states[end] = state
+    except (jsonpatch.JsonPatchException, jsonpointer.JsonPointerException), e:
+        log.warning("Cannot check patch %s: the preceding patches of %s %s (scope: %s) fail: %s",
+                    patch_id, model_name, object_id, scope, e)
+        return False
+    finally:
+        entry.patch_ids = list(oplist.patch_ids)
+        entry.operations = list(operations)
+        entry.states = states
+        _states.set(key, entry)
+
+    # the patched state is shared with the cached states, which the patch must not modify
+    states[position + 1] = CompiledPatch([operations[position]]).apply(state)
+    return True
+
+
+def _show(context, model_name, object_id):
+    show_context = {
+        'model': context['model'],
+        'session': context['session'],
+        'user': context.get('user'),
+        'ignore_auth': True,
+    }
+    return tk.get_action('{}_show'.format(model_name))(show_context, {'id': object_id})
+
+
+def _common_prefix(entry, patch_ids, operations):
+    """
+    Return the number of leading operations that are the same in the cached entry and the given list.
+    """
+    n = 0
+    for cached_id, cached_op, patch_id, operation in zip(entry.patch_ids, entry.operations, patch_ids, operations):
+        if cached_id != patch_id or cached_op != operation:
+            break
+        n += 1
+    return n
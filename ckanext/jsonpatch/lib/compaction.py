@@ -0,0 +1,174 @@
+# encoding: utf-8
+
+"""
+Reduction of an object's ordered list of patch operations to a shorter, equivalent list.
+
+The list is equivalent in the sense that, for any document to which the original list applies
+without error, the compacted list produces the same result. This holds for the list of all the
+object's patches, and for the list of each scope's patches. Only operations that are provably
+redundant are touched:
+
+- any operation writing strictly inside a location that is subsequently replaced or removed
+  is dropped, as is a ``replace`` of a location that is subsequently replaced or removed;
+- an ``add`` followed by a ``replace`` of the same location becomes a single ``add`` of the
+  final value;
+- a ``remove``, ``add``, ``remove`` sequence on the same location becomes a single ``remove``.
+
+An operation is never moved or merged across another operation that reads, tests or restructures
+a related location, so ``test`` operations keep their meaning. Since the location of a numeric
+path segment may be shifted by additions to and removals from an array, such operations are
+treated as touching every location within the array.
+"""
+
+import jsonpointer
+
+
+class _Entry(object):
+
+    def __init__(self, key, scope, operation):
+        self.key = key
+        self.scope = scope or None
+        self.operation = operation
+        self.op = operation['op']
+        self.path = tuple(jsonpointer.JsonPointer(operation['path']).parts)
+        self.from_path = tuple(jsonpointer.JsonPointer(operation['from']).parts) \
+            if self.op in ('move', 'copy') else None
+        self.modified = False
+
+    def regions(self):
+        """
+        Return the locations that this operation reads or writes.
+        """
+        if self.op == 'test':
+            return [self.path]
+        if self.op == 'replace':
+            return [self.path]
+        if self.op in ('add', 'remove'):
+            return [_structural_region(self.path)]
+        if self.op == 'move':
+            return [_structural_region(self.from_path), _structural_region(self.path)]
+        if self.op == 'copy':
+            return [self.from_path, _structural_region(self.path)]
+        return [()]
+
+    def within(self, path):
+        """
+        Return True if this operation only writes strictly inside the given location.
+        """
+        if self.op in ('add', 'replace', 'remove', 'copy'):
+            return _strictly_under(self.path, path)
+        if self.op == 'move':
+            return _strictly_under(self.path, path) and _strictly_under(self.from_path, path)
+        return False
+
+    def shares_chains_with(self, other):
+        """
+        Return True if every list in which this operation is applied also includes the other operation.
+        """
+        return other.scope is None or self.scope == other.scope
+
+
+def compact(entries):
+    """
+    Compact an ordered list of patch operations.
+
+    :param entries: iterable of (key, scope, operation) tuples, in application order, where key
+        identifies the patch (e.g. its id)
+
+    :returns: tuple of (kept, removed_keys, modified_keys), where kept is the list of remaining
+        (key, scope, operation) tuples in application order
+    """
+    result = []
+    removed = []
+    for key, scope, operation in entries:
+        cur = _Entry(key, scope, operation)
+        if cur.op in ('replace', 'remove') and not _is_append(cur.path):
+            keep_cur = _eliminate(result, cur, removed)
+        else:
+            keep_cur = True
+        if keep_cur:
+            result.append(cur)
+        else:
+            removed.append(cur.key)
+
+    kept = [(entry.key, entry.scope, entry.operation) for entry in result]
+    modified = [entry.key for entry in result if entry.modified]
+    return kept, removed, modified
+
+
+def _eliminate(result, cur, removed):
+    """
+    Drop operations in result that are made redundant by cur, which replaces or removes a location.
+
+    :returns: False if cur itself has become redundant
+    """
+    i = len(result) - 1
+    while i >= 0:
+        e = result[i]
+
+        if e.within(cur.path) and e.shares_chains_with(cur):
+            # overwritten by cur
+            removed.append(result.pop(i).key)
+
+        elif e.path == cur.path and e.op in ('add', 'replace'):
+            if e.op == 'replace' and e.shares_chains_with(cur):
+                # replace or remove after replace
+                removed.append(result.pop(i).key)
+
+            elif e.op == 'add' and cur.op == 'replace' and e.scope == cur.scope:
+                # replace after add: add the final value
+                e.operation = dict(e.operation, value=cur.operation['value'])
+                e.modified = True
+                return False
+
+            elif e.op == 'add' and cur.op == 'remove' and e.scope == cur.scope:
+                # remove, add, remove: the location is known not to exist before the add
+                j = _previous_related(result, i, cur.path)
+                if j is not None and result[j].op == 'remove' and result[j].path == cur.path \
+                        and result[j].scope == cur.scope:
+                    removed.append(result.pop(i).key)
+                    return False
+                return True
+
+            else:
+                return True
+
+        elif any(_related(region, cur.path) for region in e.regions()):
+            return True
+
+        i -= 1
+
+    return True
+
+
+def _previous_related(result, i, path):
+    """
+    Return the index of the last operation before position i that touches a location related to path.
+    """
+    for j in xrange(i - 1, -1, -1):
+        if any(_related(region, path) for region in result[j].regions()):
+            return j
+    return None
+
+
+def _structural_region(path):
+    """
+    Return the location affected by an addition or removal at path: the containing array, if the
+    final path segment may be an array index, otherwise the path itself.
+    """
+    if path and (path[-1] == '-' or path[-1].isdigit()):
+        return path[:-1]
+    return path
+
+
+def _is_append(path):
+    return bool(path) and path[-1] == '-'
+
+
+def _strictly_under(path, ancestor):
+    return len(path) > len(ancestor) and path[:len(ancestor)] == ancestor
+
+
+def _related(path1, path2):
+    n = min(len(path1), len(path2))
+    return path1[:n] == path2[:n]
@@ -13,3 +13,7 @@ def jsonpatch_dict_save(jsonpatch_dict, context):
 
 def jsonpatch_dictize(jsonpatch, context):
     return d.table_dictize(jsonpatch, context)
+
+
+def jsonpatch_list_dictize(jsonpatches, context):
+    return [d.table_dictize(jsonpatch, context) for jsonpatch in jsonpatches]
@@ -0,0 +1,189 @@
+# encoding: utf-8
+
+"""
+Generation of a JSON Patch that transforms one document into another.
+
+Unlike jsonpatch.make_patch, which compares lists by position, lists of dictionaries that are
+identified by a key (by default 'id' or 'name') are compared by key: an element inserted into or
+removed from such a list gives a single add or remove operation, a reordering gives one move
+operation per element that is out of order (the elements forming the longest run already in
+order are left in place), and modified elements are compared recursively. Other lists are
+compared with jsonpatch.make_patch, or, should its operations not give the new list, replaced.
+"""
+
+import jsonpatch
+import jsonpointer
+
+DEFAULT_KEYS = ('id', 'name')
+
+
+def make_oplist(src, dst, keys=DEFAULT_KEYS):
+    """
+    Return a list of operations that transforms src into dst.
+
+    :param keys: the names of the keys identifying the elements of lists of dictionaries, in
+        order of preference
+    """
+    oplist = []
+    _diff(src, dst, u'', keys, oplist)
+    return oplist
+
+
+def verify(src, dst, oplist):
+    """
+    Return True if applying the operations to src (which is not modified) gives dst.
+    """
+    try:
+        return _equal(jsonpatch.apply_patch(src, oplist), dst)
+    except (jsonpatch.JsonPatchException, jsonpointer.JsonPointerException):
+        return False
+    except (KeyError, IndexError, TypeError):
+        # operations generated by make_patch may address the wrong type of value
+        return False
+
+
+def _diff(src, dst, path, keys, oplist):
+    if isinstance(src, dict) and isinstance(dst, dict):
+        _diff_dicts(src, dst, path, keys, oplist)
+    elif isinstance(src, list) and isinstance(dst, list):
+        key = _list_key(src, dst, keys)
+        if key is not None:
+            _diff_keyed_lists(src, dst, path, key, keys, oplist)
+        else:
+            _diff_lists(src, dst, path, oplist)
+    elif not _equal(src, dst):
+        oplist += [{'op': 'replace', 'path': path, 'value': dst}]
+
+
+def _diff_dicts(src, dst, path, keys, oplist):
+    for name in sorted(set(src) - set(dst)):
+        oplist += [{'op': 'remove', 'path': _join(path, name)}]
+    for name in sorted(set(dst) - set(src)):
+        oplist += [{'op': 'add', 'path': _join(path, name), 'value': dst[name]}]
+    for name in sorted(set(src) & set(dst)):
+        _diff(src[name], dst[name], _join(path, name), keys, oplist)
+
+
+def _diff_lists(src, dst, path, oplist):
+    if _equal(src, dst):
+        return
+    operations = jsonpatch.make_patch(src, dst).patch
+    if not verify(src, dst, operations):
+        # make_patch does not give operations that apply for some changes to nested lists
+        oplist += [{'op': 'replace', 'path': path, 'value': dst}]
+        return
+    for operation in operations:
+        operation = dict(operation, path=path + operation['path'])
+        if 'from' in operation:
+            operation['from'] = path + operation['from']
+        oplist += [operation]
+
+
+def _diff_keyed_lists(src, dst, path, key, keys, oplist):
+    """
+    Compare lists of dictionaries by the given key. Operations are generated against a simulated
+    list of keys, so that each operation's indexes refer to the list as it is when the operation
+    is applied.
+    """
+    dst_keys = [element[key] for element in dst]
+    dst_positions = dict((value, i) for i, value in enumerate(dst_keys))
+    current = [element[key] for element in src]
+
+    for i in reversed(xrange(len(current))):
+        if current[i] not in dst_positions:
+            oplist += [{'op': 'remove', 'path': _join(path, i)}]
+            del current[i]
+
+    # the elements that stay in place are those of the longest subsequence already in order; each
+    # other element is moved, and each new element added, directly after its predecessor in dst
+    stay = _longest_increasing([dst_positions[value] for value in current])
+    present = set(current)
+    for i, value in enumerate(dst_keys):
+        if i in stay:
+            continue
+        if value in present:
+            from_index = current.index(value)
+            del current[from_index]
+        else:
+            from_index = None
+        to_index = current.index(dst_keys[i - 1]) + 1 if i else 0
+        current.insert(to_index, value)
+        if from_index is None:
+            oplist += [{'op': 'add', 'path': _join(path, to_index), 'value': dst[i]}]
+        elif from_index != to_index:
+            oplist += [{'op': 'move', 'from': _join(path, from_index), 'path': _join(path, to_index)}]
+
+    # the list is now in the order of dst
+    src_elements = dict((element[key], element) for element in src)
+    for i, value in enumerate(dst_keys):
+        if value in src_elements:
+            _diff(src_elements[value], dst[i], _join(path, i), keys, oplist)
+
+
+def _list_key(src, dst, keys):
+    """
+    Return the first of the keys that identifies every element of both lists, or None.
+    """
+    if not src or not dst:
+        return None
+    for key in keys:
+        if all(_is_keyed(elements, key) for elements in (src, dst)):
+            return key
+    return None
+
+
+def _is_keyed(elements, key):
+    values = set()
+    for element in elements:
+        if not isinstance(element, dict) or not isinstance(element.get(key), (basestring, int, long)) \
+                or isinstance(element[key], bool) or element[key] in values:
+            return False
+        values.add(element[key])
+    return True
+
+
+def _longest_increasing(sequence):
+    """
+    Return the set of the values of a longest strictly increasing subsequence of a sequence of
+    distinct integers.
+    """
+    tails = []  # tails[n]: index of the smallest tail of an increasing subsequence of length n + 1
+    previous = [None] * len(sequence)
+    for i, value in enumerate(sequence):
+        low, high = 0, len(tails)
+        while low < high:
+            middle = (low + high) // 2
+            if sequence[tails[middle]] < value:
+                low = middle + 1
+            else:
+                high = middle
+        previous[i] = tails[low - 1] if low else None
+        if low == len(tails):
+            tails.append(i)
+        else:
+            tails[low] = i
+
+    result = set()
+    i = tails[-1] if tails else None
+    while i is not None:
+        result.add(sequence[i])
+        i = previous[i]
+    return result
+
+
+def _equal(value1, value2):
+    """
+    Compare JSON values, distinguishing booleans from numbers: True == 1 in Python, but not in JSON.
+    """
+    if isinstance(value1, dict) and isinstance(value2, dict):
+        return len(value1) == len(value2) and \
+            all(key in value2 and _equal(value, value2[key]) for key, value in value1.iteritems())
+    if isinstance(value1, list) and isinstance(value2, list):
+        return len(value1) == len(value2) and all(_equal(a, b) for a, b in zip(value1, value2))
+    if isinstance(value1, (dict, list)) or isinstance(value2, (dict, list)):
+        return False
+    return value1 == value2 and isinstance(value1, bool) == isinstance(value2, bool)
+
+
+def _join(path, part):
+    return u'{}/{}'.format(path, jsonpointer.escape(unicode(part)))
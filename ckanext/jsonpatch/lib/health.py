@@ -0,0 +1,292 @@
+# encoding: utf-8
+
+"""
+Patch health checks: the patches of every patched object are applied, for every scope, and the
+outcome is recorded in the jsonpatch_health table, so that patches that no longer apply to their
+(changed) source objects are found before users run into them.
+
+Objects are checked in batches, optionally across a pool of worker processes; the operation lists
+of each batch are loaded with a single query, and each object is given a time limit. A check is
+incremental: an object is skipped if the outcome recorded for each of its operation lists is for
+the list's current version and the source object's current modification time. Objects of models
+whose modification time cannot be looked up (see materialize.register_source_modified) are
+rechecked on every run.
+
+Checks are run with ``paster jsonpatch check``, or as a background job with the
+jsonpatch_health_check action.
+"""
+
+import contextlib
+import datetime
+import itertools
+import logging
+import signal
+import threading
+import jsonpatch
+import jsonpointer
+from paste.deploy.converters import asint
+from sqlalchemy import and_, not_, exists
+
+import ckan.plugins.toolkit as tk
+from ckan.model import meta
+from ckanext.jsonpatch.lib import materialize, pool
+from ckanext.jsonpatch.lib.patch import CompiledPatch
+from ckanext.jsonpatch.model.database import replace_row
+from ckanext.jsonpatch.model.jsonpatch import JSONPatch
+from ckanext.jsonpatch.model.oplist import JSONPatchOplist, jsonpatch_oplist_table, ALL_SCOPES
+from ckanext.jsonpatch.model.health import JSONPatchHealth, jsonpatch_health_table
+
+log = logging.getLogger(__name__)
+
+STATUS_OK = u'ok'
+STATUS_FAILED = u'failed'  # an operation could not be applied
+STATUS_DEACTIVATED = u'deactivated'  # an operation could not be applied, and its patch was deleted
+STATUS_ERROR = u'error'  # the object could not be fetched, or the check timed out
+
+_workers = 0
+_timeout = 30
+
+
+def configure(config):
+    global _workers, _timeout
+    _workers = asint(config.get('ckanext.jsonpatch.health.workers', 0))
+    _timeout = asint(config.get('ckanext.jsonpatch.health.timeout', 30))
+
+
+class CheckTimeout(Exception):
+    pass
+
+
+def run(model_name=None, recheck=False, deactivate=False, workers=None, batch_size=100, timeout=None):
+    """
+    Check the patches of all patched objects (of the given model), and record the outcomes.
+
+    :param recheck: check every object, including those whose recorded outcome is current
+    :param deactivate: delete the patches whose operations cannot be applied in the operation
+        list for their own scope; failures in the list of all scopes are only recorded for patches
+        with a scope
+    :param workers: number of worker processes (default: ``ckanext.jsonpatch.health.workers``;
+        0 or 1 to check all objects in this process)
+    :param timeout: time limit in seconds for checking an object (default:
+        ``ckanext.jsonpatch.health.timeout``; 0 for none)
+    :returns: dictionary of the numbers of operation lists by status, and of objects 'skipped'
+    """
+    import ckan.model as model
+
+    workers = _workers if workers is None else workers
+    timeout = _timeout if timeout is None else timeout
+    _discard_stale()
+
+    q = model.Session.query(JSONPatchOplist.model_name, JSONPatchOplist.object_id).distinct() \
+        .order_by(JSONPatchOplist.model_name, JSONPatchOplist.object_id)
+    if model_name:
+        q = q.filter(JSONPatchOplist.model_name == model_name)
+    batches = []
+    for model_name_, objects in itertools.groupby(q, lambda row: row.model_name):
+        object_ids = [row.object_id for row in objects]
+        batches += [(model_name_, object_ids[i:i + batch_size], timeout, recheck, deactivate)
+                    for i in xrange(0, len(object_ids), batch_size)]
+    object_count = sum(len(batch[1]) for batch in batches)
+
+    site_user = tk.get_action('get_site_user')({'ignore_auth': True}, {})
+    totals = {}
+    checked = 0
+    for object_ids, counts in pool.imap(_check_batch, batches, workers, site_user['name']):
+        checked += len(object_ids)
+        for status, count in counts.iteritems():
+            totals[status] = totals.get(status, 0) + count
+        log.info("Checked %d of %d objects: %s", checked, object_count,
+                 ', '.join('%d %s' % (count, status) for status, count in sorted(totals.iteritems())))
+    return totals
+
+
+def _check_batch(batch):
+    """
+    Check a batch of objects in a worker process.
+
+    :param batch: tuple of (model_name, object_ids, timeout, recheck, deactivate)
+    :returns: tuple of (object_ids, dictionary of counts by status)
+    """
+    import ckan.model as model
+
+    model_name, object_ids, timeout, recheck, deactivate = batch
+    context = pool.worker_context()
+    try:
+        return object_ids, check_objects(context, model_name, object_ids, timeout, recheck, deactivate)
+    except Exception, e:
+        log.exception("Unable to check a batch of %d %s objects: %s", len(object_ids), model_name, e)
+        return object_ids, {STATUS_ERROR: len(object_ids)}
+    finally:
+        model.Session.remove()
+
+
+def check_objects(context, model_name, object_ids, timeout=0, recheck=False, deactivate=False):
+    """
+    Check the patches of a batch of objects of a model, for every scope, and record the outcomes.
+
+    :returns: dictionary of the numbers of operation lists by status, and of objects 'skipped'
+    """
+    session = context['session']
+    # plain rows rather than mapped objects, which would be expired if the session is rolled back
+    oplists = {}
+    for oplist in session.query(JSONPatchOplist.object_id, JSONPatchOplist.scope, JSONPatchOplist.version,
+                                JSONPatchOplist.patch_ids, JSONPatchOplist.operations).filter(
+            JSONPatchOplist.model_name == model_name, JSONPatchOplist.object_id.in_(object_ids)):
+        oplists.setdefault(oplist.object_id, []).append(oplist)
+    recorded = dict(((health.object_id, health.scope), health) for health in session.query(
+        JSONPatchHealth.object_id, JSONPatchHealth.scope, JSONPatchHealth.patch_version,
+        JSONPatchHealth.source_modified).filter(
+        JSONPatchHealth.model_name == model_name, JSONPatchHealth.object_id.in_(object_ids)))
+
+    counts = {}
+    for object_id in object_ids:
+        object_oplists = oplists.get(object_id)
+        if not object_oplists:
+            continue
+        source_modified = materialize.get_source_modified(context, model_name, object_id) \
+            if materialize.has_source_modified(model_name) else None
+        if not recheck and source_modified is not None and \
+                all(_is_current(recorded.get((object_id, oplist.scope)), oplist, source_modified)
+                    for oplist in object_oplists):
+            counts['skipped'] = counts.get('skipped', 0) + 1
+            continue
+
+        outcomes = _check_object(context, model_name, object_id, object_oplists, timeout)
+        if deactivate:
+            patch_scopes = _get_patch_scopes(session, [
+                oplist.patch_ids[op_index] for oplist, (status, op_index, _) in zip(object_oplists, outcomes)
+                if status == STATUS_FAILED])
+        failed_patch_ids = set()
+        for oplist, (status, op_index, message) in zip(object_oplists, outcomes):
+            patch_id = oplist.patch_ids[op_index] if op_index is not None else None
+            if status == STATUS_FAILED:
+                log.warning("Patch %s (operation %d) of %s %s (scope: %s) cannot be applied: %s",
+                            patch_id, op_index, model_name, object_id, oplist.scope, message)
+                # a patch is deleted only if it fails in the list for its own scope; a scoped patch
+                # that fails only in the list of all scopes may be broken by another scope's patches
+                if deactivate and patch_id in patch_scopes and patch_scopes[patch_id] == oplist.scope:
+                    failed_patch_ids.add(patch_id)
+                    status = STATUS_DEACTIVATED
+            elif status == STATUS_ERROR:
+                log.warning("Unable to check %s %s (scope: %s): %s", model_name, object_id, oplist.scope, message)
+            _record(model_name, object_id, oplist.scope, status, patch_id, op_index, message,
+                    oplist.version, source_modified)
+            counts[status] = counts.get(status, 0) + 1
+
+        for patch_id in failed_patch_ids:
+            tk.get_action('jsonpatch_delete')(dict(context), {'id': patch_id})
+            log.info("Deleted patch %s of %s %s", patch_id, model_name, object_id)
+
+    return counts
+
+
+def _get_patch_scopes(session, patch_ids):
+    """
+    Return a dictionary of the scopes of the given patches by id, with ALL_SCOPES for patches
+    without a scope.
+    """
+    if not patch_ids:
+        return {}
+    return dict((patch_id, scope or ALL_SCOPES) for patch_id, scope in
+                session.query(JSONPatch.id, JSONPatch.scope).filter(JSONPatch.id.in_(patch_ids)))
+
+
+def _is_current(health, oplist, source_modified):
+    return health is not None and health.patch_version == oplist.version and \
+        health.source_modified == source_modified
+
+
+def _check_object(context, model_name, object_id, oplists, timeout):
+    """
+    Apply each of an object's operation lists to the object, operation by operation.
+
+    :returns: list of (status, index of the failed operation, message), one per operation list
+    """
+    outcomes = []
+    try:
+        with _time_limit(timeout):
+            show_context = dict(context, ignore_auth=True)
+            object_dict = tk.get_action('{}_show'.format(model_name))(show_context, {'id': object_id})
+            for oplist in oplists:
+                outcomes += [_check_oplist(object_dict, oplist.operations or [])]
+    except CheckTimeout:
+        context['session'].rollback()
+        message = u'Timed out after {} s'.format(timeout)
+        outcomes += [(STATUS_ERROR, None, message)] * (len(oplists) - len(outcomes))
+    except Exception, e:
+        context['session'].rollback()
+        message = getattr(e, 'message', None) or unicode(e) or e.__class__.__name__
+        outcomes += [(STATUS_ERROR, None, unicode(message))] * (len(oplists) - len(outcomes))
+    return outcomes
+
+
+def _check_oplist(object_dict, operations):
+    state = object_dict
+    for op_index, operation in enumerate(operations):
+        try:
+            # the object is shared between the operation lists, so it is not patched in place
+            state = CompiledPatch([operation]).apply(state)
+        except (jsonpatch.JsonPatchException, jsonpointer.JsonPointerException), e:
+            return STATUS_FAILED, op_index, unicode(e)
+    return STATUS_OK, None, None
+
+
+@contextlib.contextmanager
+def _time_limit(seconds):
+    """
+    Raise CheckTimeout in the enclosed block after the given number of seconds. Time limits are
+    only enforced in the main thread of a process, where signal handlers run, and while no other
+    alarm is set, which would otherwise be cancelled: in particular, not in the process of a
+    background job, whose worker uses an alarm for the job's own time limit (the worker processes
+    of a job's pool, which do not inherit the alarm, enforce time limits as usual).
+    """
+    if not seconds or threading.current_thread().name != 'MainThread' or \
+            signal.getitimer(signal.ITIMER_REAL)[0]:
+        yield
+        return
+
+    def handler(signum, frame):
+        raise CheckTimeout()
+
+    previous = signal.signal(signal.SIGALRM, handler)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+def _record(model_name, object_id, scope, status, patch_id, op_index, message, patch_version, source_modified):
+    """
+    Record the outcome of a check in its own transaction, independently of the session.
+    """
+    replace_row(jsonpatch_health_table, {
+        'model_name': model_name,
+        'object_id': object_id,
+        'scope': scope,
+    }, {
+        'status': status,
+        'patch_id': patch_id,
+        'op_index': op_index,
+        'message': message,
+        'patch_version': patch_version,
+        'source_modified': source_modified,
+        'checked': datetime.datetime.utcnow(),
+    })
+
+
+def _discard_stale():
+    """
+    Delete the recorded outcomes for operation lists that no longer exist.
+    """
+    health = jsonpatch_health_table
+    oplist = jsonpatch_oplist_table
+    with meta.engine.begin() as conn:
+        result = conn.execute(health.delete().where(not_(exists().where(and_(
+            oplist.c.model_name == health.c.model_name,
+            oplist.c.object_id == health.c.object_id,
+            oplist.c.scope == health.c.scope,
+        )))))
+    if result.rowcount:
+        log.info("Discarded %d outcomes of earlier checks", result.rowcount)
@@ -0,0 +1,119 @@
+# encoding: utf-8
+
+"""
+Materialized patched objects: patched object dictionaries stored in the jsonpatch_materialized
+table, and served directly by jsonpatch_apply while fresh.
+
+Materialization is enabled per model with ``ckanext.jsonpatch.materialize``, for models for which
+the modification time of the source object can be looked up cheaply (see register_source_modified).
+"""
+
+import logging
+from sqlalchemy.exc import IntegrityError
+
+from ckan.model import meta
+from ckanext.jsonpatch.model.database import replace_row
+from ckanext.jsonpatch.model.oplist import ALL_SCOPES
+from ckanext.jsonpatch.model.materialized import JSONPatchMaterialized, jsonpatch_materialized_table
+
+log = logging.getLogger(__name__)
+
+_models = set()
+_source_modified_funcs = {}
+
+
+def register_source_modified(model_name, func):
+    """
+    Register a function ``func(context, object_id)`` that returns a string that changes whenever
+    the output of the model's 'xyz_show' action for the object changes, e.g. its metadata_modified.
+    """
+    _source_modified_funcs[model_name] = func
+
+
+def configure(config):
+    global _models
+    _models = set(config.get('ckanext.jsonpatch.materialize', '').split())
+    for model_name in _models - set(_source_modified_funcs):
+        log.warning("Patched %s objects cannot be materialized: the modification time "
+                    "of a %s cannot be determined", model_name, model_name)
+
+
+def is_enabled(model_name):
+    return model_name in _models and model_name in _source_modified_funcs
+
+
+def has_source_modified(model_name):
+    """
+    Return True if the modification time of objects of the given model can be looked up.
+    """
+    return model_name in _source_modified_funcs
+
+
+def get_source_modified(context, model_name, object_id):
+    """
+    Return the modification time of the source object, or None if the object was not found.
+    """
+    return _source_modified_funcs[model_name](context, object_id)
+
+
+def get(model_name, object_id, scope, patch_version, source_modified):
+    """
+    Return the stored patched object dictionary, or None if there is none or it is stale.
+    """
+    materialized = JSONPatchMaterialized.get(model_name, object_id, scope)
+    if materialized is None:
+        return None
+    if materialized.patch_version != patch_version or materialized.source_modified != source_modified:
+        log.debug("Materialized %s %s (scope: %s) is stale", model_name, object_id, scope)
+        return None
+    return materialized.data
+
+
+def store(model_name, object_id, scope, patch_version, source_modified, data):
+    """
+    Store a patched object dictionary. This is done in its own transaction, independently of
+    the session, since it is called while reading.
+    """
+    scope = scope or ALL_SCOPES
+    try:
+        replace_row(jsonpatch_materialized_table, {
+            'model_name': model_name,
+            'object_id': object_id,
+            'scope': scope,
+        }, {
+            'data': data,
+            'patch_version': patch_version,
+            'source_modified': source_modified,
+        })
+    except IntegrityError:
+        # stored concurrently by another request
+        log.debug("Materialized %s %s (scope: %s) was stored concurrently", model_name, object_id, scope)
+
+
+def expire(model_name, object_id):
+    """
+    Discard the stored patched dictionaries of an object, within the current transaction.
+    """
+    if model_name in _models:
+        meta.Session.query(JSONPatchMaterialized) \
+            .filter_by(model_name=model_name, object_id=object_id) \
+            .delete(synchronize_session=False)
+
+
+def _package_modified(context, object_id):
+    package = context['model'].Package.get(object_id)
+    if package is None or package.metadata_modified is None:
+        return None
+    return package.metadata_modified.isoformat()
+
+
+def _resource_modified(context, object_id):
+    # resource changes are recorded in the metadata_modified of the resource's package
+    resource = context['model'].Resource.get(object_id)
+    if resource is None:
+        return None
+    return _package_modified(context, resource.package_id)
+
+
+register_source_modified('package', _package_modified)
+register_source_modified('resource', _resource_modified)
@@ -0,0 +1,154 @@
+# encoding: utf-8
+
+import copy
+import jsonpatch
+import jsonpointer
+from paste.deploy.converters import asint
+
+from ckanext.jsonpatch.lib.cache import MemoryBackend
+
+OPERATIONS = {
+    'add': jsonpatch.AddOperation,
+    'remove': jsonpatch.RemoveOperation,
+    'replace': jsonpatch.ReplaceOperation,
+    'move': jsonpatch.MoveOperation,
+    'copy': jsonpatch.CopyOperation,
+    'test': jsonpatch.TestOperation,
+}
+
+_compiled_patches = MemoryBackend(1000, 0)
+
+
+class CompiledPatch(object):
+    """
+    A JSON Patch whose operations (including their JSON Pointers) are parsed once, so that it can
+    be applied any number of times.
+    """
+
+    def __init__(self, oplist):
+        self.operations = []
+        for operation in oplist:
+            try:
+                operation_class = OPERATIONS[operation['op']]
+            except (KeyError, TypeError):
+                raise jsonpatch.InvalidJsonPatch("Invalid operation {0!r}".format(operation))
+
+            if operation['op'] == 'move':
+                operation = dict(operation, **{'from': jsonpointer.JsonPointer(operation['from'])})
+            compiled = operation_class(operation)
+
+            # the containers along this path must be copied before a shared document is patched
+            modified_path = compiled.pointer if operation['op'] != 'test' else None
+
+            # values inserted into the document must not be shared between applications of the patch
+            inserts_value = operation['op'] in ('add', 'replace') and isinstance(operation.get('value'), (dict, list))
+
+            self.operations += [(compiled, inserts_value, modified_path)]
+
+    def __len__(self):
+        return len(self.operations)
+
+    def apply(self, obj, in_place=False):
+        """
+        Apply the patch to the given document.
+
+        :param in_place: if True, the document is modified directly; this is the fastest option,
+            for use where the document is not referenced elsewhere. Otherwise, the document is
+            left unchanged, and the result shares all the parts of the document that the patch does
+            not touch; only the containers along the paths of the patch operations are copied.
+
+        :returns: the patched document
+        """
+        copied = None if in_place else set()
+        for operation, inserts_value, modified_path in self.operations:
+            if copied is not None:
+                if isinstance(operation, jsonpatch.MoveOperation):
+                    obj = _move_shared(obj, operation, copied)
+                    continue
+                if modified_path is not None:
+                    obj = _copy_path(obj, modified_path, copied)
+            if inserts_value:
+                operation = copy.copy(operation)
+                operation.operation = dict(operation.operation, value=copy.deepcopy(operation.operation['value']))
+            obj = operation.apply(obj)
+        return obj
+
+
+def _move_shared(doc, operation, copied):
+    """
+    Apply a move operation to a shared document. This is done as a remove followed by an add,
+    since the removal may shift the containers along the target path.
+    """
+    from_pointer = operation.operation['from']
+    doc = _copy_path(doc, from_pointer, copied)
+    subobj, part = from_pointer.to_last(doc)
+    try:
+        value = subobj[part]
+    except (KeyError, IndexError), e:
+        raise jsonpatch.JsonPatchConflict(str(e))
+
+    if operation.pointer == from_pointer:
+        return doc
+    if isinstance(subobj, dict) and operation.pointer.contains(from_pointer):
+        raise jsonpatch.JsonPatchConflict('Cannot move values into its own children')
+
+    doc = jsonpatch.RemoveOperation({'op': 'remove', 'path': from_pointer}).apply(doc)
+    doc = _copy_path(doc, operation.pointer, copied)
+    return jsonpatch.AddOperation({'op': 'add', 'path': operation.pointer, 'value': value}).apply(doc)
+
+
+def _copy_path(doc, pointer, copied):
+    """
+    Replace each container along the path to the parent of pointer's target with a shallow copy,
+    unless it has already been copied.
+
+    :param copied: set of the ids of containers that have already been copied
+    :returns: the (possibly copied) document root
+    """
+    if not isinstance(doc, (dict, list)):
+        return doc
+    if id(doc) not in copied:
+        doc = copy.copy(doc)
+        copied.add(id(doc))
+
+    container = doc
+    for part in pointer.parts[:-1]:
+        try:
+            key = pointer.get_part(container, part)
+            child = container[key]
+        except (jsonpointer.JsonPointerException, KeyError, IndexError, TypeError):
+            # the operation will fail on this path anyway
+            break
+        if not isinstance(child, (dict, list)):
+            break
+        if id(child) not in copied:
+            child = copy.copy(child)
+            container[key] = child
+            copied.add(id(child))
+        container = child
+
+    return doc
+
+
+def configure(config):
+    global _compiled_patches
+    size = asint(config.get('ckanext.jsonpatch.compiled_cache.size', 1000))
+    _compiled_patches = MemoryBackend(size, 0)
+
+
+def get_compiled_patch(key, version, load_oplist):
+    """
+    Return a compiled patch from the per-process cache, compiling and caching it if the cached
+    version is missing or out of date.
+
+    :param key: (model_name, object_id, scope)
+    :param version: a token that changes whenever the object's list of patches changes
+    :param load_oplist: function returning the ordered list of operations, called on a cache miss
+    """
+    cached = _compiled_patches.get(key)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    patch = CompiledPatch(load_oplist())
+    _compiled_patches.set(key, (version, patch))
+    return patch
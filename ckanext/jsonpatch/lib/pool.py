@@ -0,0 +1,58 @@
+# encoding: utf-8
+
+"""
+Processing of batches of objects across a pool of worker processes, as used by
+``paster jsonpatch apply-all`` and the patch health checks.
+"""
+
+import itertools
+import multiprocessing
+
+from ckan.model import meta
+
+_user = None
+
+
+def imap(func, batches, workers, user, ordered=False):
+    """
+    Call func on each batch, across a pool of worker processes if workers > 1, or else in this
+    process, and yield the results as they become available (in batch order if ordered is set).
+    The pool is terminated if iteration is abandoned.
+
+    :param user: the name of the user as whom the workers call actions (see worker_context)
+    """
+    # worker processes must not share the parent's database connections
+    meta.Session.remove()
+    meta.engine.dispose()
+
+    pool = None
+    if workers > 1:
+        pool = multiprocessing.Pool(workers, _init_worker, (user,))
+        results = pool.imap(func, batches) if ordered else pool.imap_unordered(func, batches)
+    else:
+        _init_worker(user)
+        results = itertools.imap(func, batches)
+    try:
+        for result in results:
+            yield result
+        if pool is not None:
+            pool.close()
+            pool.join()
+    except:
+        if pool is not None:
+            pool.terminate()
+        raise
+
+
+def _init_worker(user):
+    global _user
+    meta.engine.dispose()
+    _user = user
+
+
+def worker_context():
+    """
+    Return a context for calling actions in a worker, as the user given to imap.
+    """
+    import ckan.model as model
+    return {'model': model, 'session': model.Session, 'user': _user, 'ignore_auth': True}
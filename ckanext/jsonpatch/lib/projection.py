@@ -0,0 +1,67 @@
+# encoding: utf-8
+
+"""
+Selection of the patch operations needed to produce a subset of the top-level fields of a
+patched object.
+
+An operation is needed if it writes to a location related to (i.e. containing, or contained in)
+one of the requested fields, or to a location on which a later needed operation depends (its
+target location, or the source of a move or copy). Additions to and removals from an array may
+shift the locations of the array's other elements, so they are treated as writing to the whole
+array. ``test`` operations are always
+kept, so that a patch that fails as a whole still fails when only some fields are requested.
+"""
+
+import jsonpointer
+
+
+def project_oplist(oplist, fields):
+    """
+    Return the operations of oplist that are needed to produce the given top-level fields.
+
+    :param oplist: list of operations, in application order
+    :param fields: iterable of top-level field names
+    """
+    needed = [(field,) for field in fields]
+    selected = []
+    for operation in reversed(oplist):
+        op = operation.get('op')
+        path = _parts(operation.get('path'))
+        from_path = _parts(operation.get('from')) if op in ('move', 'copy') else None
+
+        if op == 'test':
+            writes = []
+        elif op in ('add', 'remove', 'copy'):
+            writes = [_structural_region(path)]
+        elif op == 'move':
+            writes = [_structural_region(path), _structural_region(from_path)]
+        else:
+            writes = [path]
+
+        if op == 'test' or any(_related(region, n) for region in writes for n in needed):
+            selected.append(operation)
+            # the operation depends on the state of the locations it writes to (in coordinates
+            # prior to any shift that it causes), its target location, and its source, if any
+            needed += writes + [path]
+            if from_path is not None:
+                needed.append(from_path)
+
+    selected.reverse()
+    return selected
+
+
+def _parts(pointer):
+    if pointer is None:
+        return None
+    return tuple(jsonpointer.JsonPointer(pointer).parts)
+
+
+def _structural_region(path):
+    if path and (path[-1] == '-' or path[-1].isdigit()):
+        return path[:-1]
+    return path
+
+
+def _related(path1, path2):
+    n = min(len(path1), len(path2))
+    return path1[:n] == path2[:n]
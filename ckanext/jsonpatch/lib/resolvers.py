@@ -0,0 +1,95 @@
+# encoding: utf-8
+
+"""
+Object reference resolvers, which check that an object exists and may be seen by the user,
+and return its id given its id or name.
+
+A resolver is a function ``resolver(context, object_id)`` that returns the object's id, or raises
+ObjectNotFound or NotAuthorized. Resolvers for further models may be added with register_resolver();
+references to models without a resolver are resolved by calling the model's 'xyz_show' action.
+"""
+
+import ckan.plugins.toolkit as tk
+from ckan.common import _
+
+_resolvers = {}
+
+
+def register_resolver(model_name, resolver):
+    """
+    Register a function for resolving references to objects of the given model.
+    """
+    _resolvers[model_name] = resolver
+
+
+def resolve(context, model_name, object_id):
+    """
+    Return the id of the referenced object. Results are remembered in the context, so that
+    repeated references to the same object within a request or batch are only resolved once.
+    """
+    resolved = context.setdefault('jsonpatch_resolved', {})
+    key = (model_name, object_id)
+    if key not in resolved:
+        resolver = _resolvers.get(model_name)
+        if resolver is not None:
+            resolved[key] = resolver(context, object_id)
+        else:
+            resolved[key] = _show_resolver(context, model_name, object_id)
+    return resolved[key]
+
+
+def _show_resolver(context, model_name, object_id):
+    object_dict = tk.get_action('{}_show'.format(model_name))(dict(context), {'id': object_id})
+    return object_dict['id']
+
+
+def _check_show_access(context, model_name, obj):
+    # the auth functions look for the object in the context before loading it; a copy of the
+    # context is used so that the object is not left behind for later references
+    auth_context = dict(context)
+    auth_context[model_name] = obj
+    tk.check_access('{}_show'.format(model_name), auth_context, {'id': obj.id})
+
+
+def package_resolver(context, object_id):
+    model = context['model']
+    package = model.Package.get(object_id)
+    if package is None:
+        raise tk.ObjectNotFound(_('Package was not found.'))
+    _check_show_access(context, 'package', package)
+    return package.id
+
+
+def resource_resolver(context, object_id):
+    model = context['model']
+    resource = model.Resource.get(object_id)
+    if resource is None:
+        raise tk.ObjectNotFound(_('Resource was not found.'))
+    _check_show_access(context, 'resource', resource)
+    return resource.id
+
+
+def group_resolver(context, object_id):
+    return _group_resolver(context, object_id, False)
+
+
+def organization_resolver(context, object_id):
+    return _group_resolver(context, object_id, True)
+
+
+def _group_resolver(context, object_id, is_organization):
+    model = context['model']
+    group = model.Group.get(object_id)
+    if group is None or group.is_organization != is_organization:
+        raise tk.ObjectNotFound(_('Organization was not found.') if is_organization
+                                else _('Group was not found.'))
+    auth_context = dict(context)
+    auth_context['group'] = group
+    tk.check_access('organization_show' if is_organization else 'group_show', auth_context, {'id': group.id})
+    return group.id
+
+
+register_resolver('package', package_resolver)
+register_resolver('resource', resource_resolver)
+register_resolver('group', group_resolver)
+register_resolver('organization', organization_resolver)
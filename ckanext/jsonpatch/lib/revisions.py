@@ -0,0 +1,129 @@
+# encoding: utf-8
+
+"""
+Control of the growth of the revision tables: patches with high-volume scopes may be written
+without vdm revisions, and old patch revisions may be pruned.
+
+Patches with a scope listed in ``ckanext.jsonpatch.unrevisioned_scopes`` are written with core SQL
+statements, which bypass the vdm revisioning mapper extension, so that neither a jsonpatch_revision
+row nor a CKAN revision is created for them. Such patches have no revision_id; they are otherwise
+identical to revisioned patches, and are listed and applied in the same way.
+
+The jsonpatch_changes feed pages through patch versions in revision timestamp order. A revision's
+timestamp is taken when the revision is created, not when its transaction commits, so a version
+may become visible after later-stamped versions have already been read; the feed therefore only
+returns versions older than ``ckanext.jsonpatch.changes.lag`` seconds.
+"""
+
+import datetime
+import logging
+from paste.deploy.converters import asint
+from sqlalchemy import select, and_, not_, exists
+
+from ckan.model import meta, types as _types
+from ckanext.jsonpatch.model.jsonpatch import JSONPatch, jsonpatch_table, jsonpatch_revision_table, operation_paths
+
+log = logging.getLogger(__name__)
+
+_unrevisioned_scopes = frozenset()
+_changes_lag = 60
+
+
+def configure(config):
+    global _unrevisioned_scopes, _changes_lag
+    _unrevisioned_scopes = frozenset(config.get('ckanext.jsonpatch.unrevisioned_scopes', '').split())
+    _changes_lag = max(asint(config.get('ckanext.jsonpatch.changes.lag', 60)), 0)
+
+
+def is_revisioned(scope):
+    """
+    Return False if patches with the given scope are written without vdm revisions.
+    """
+    return not scope or scope not in _unrevisioned_scopes
+
+
+def get_changes_horizon():
+    """
+    Return the latest revision timestamp that the jsonpatch_changes feed may return: versions
+    stamped after it may belong to transactions that have not yet committed.
+    """
+    return datetime.datetime.utcnow() - datetime.timedelta(seconds=_changes_lag)
+
+
+def save_unrevisioned(jsonpatch_dict, context):
+    """
+    Create or update (if 'jsonpatch' is in the context) a patch without a revision. A new patch
+    is given the id and state in the dictionary, if any (e.g. for imported patches).
+
+    :returns: the JSONPatch object
+    """
+    session = context['session']
+    jsonpatch = context.get('jsonpatch')
+    values = dict((column.name, jsonpatch_dict[column.name]) for column in jsonpatch_table.c
+                  if column.name in jsonpatch_dict and column.name not in ('id', 'revision_id', 'state', 'path', 'from_path'))
+    values['revision_id'] = None
+    if 'operation' in values:
+        values['path'], values['from_path'] = operation_paths(values['operation'])
+
+    if jsonpatch is not None:
+        session.flush()
+        session.execute(jsonpatch_table.update().where(jsonpatch_table.c.id == jsonpatch.id).values(**values))
+        session.expire(jsonpatch)
+        return jsonpatch
+
+    values['id'] = jsonpatch_dict.get('id') or _types.make_uuid()
+    values['state'] = jsonpatch_dict.get('state') or u'active'
+    session.execute(jsonpatch_table.insert().values(**values))
+    return JSONPatch.get(values['id'])
+
+
+def delete_unrevisioned(jsonpatch, context):
+    """
+    Mark a patch as deleted without a revision.
+    """
+    session = context['session']
+    session.flush()
+    session.execute(jsonpatch_table.update().where(jsonpatch_table.c.id == jsonpatch.id)
+                    .values(state=u'deleted', revision_id=None))
+    session.expire(jsonpatch)
+
+
+def prune(older_than, batch_size=1000):
+    """
+    Delete the superseded versions of patches (jsonpatch_revision rows) that expired before the
+    given date, and the CKAN revisions that are thereby no longer referenced by any table. The
+    current version of each patch is kept. Deletion is done in batches of revisions, each batch
+    being committed separately.
+
+    :param older_than: datetime
+    :returns: tuple of (patch versions deleted, revisions deleted)
+    """
+    from ckan.model.core import revision_table
+
+    # every table that references revisions, including those of CKAN core and other plugins
+    referencing_tables = [table for table in meta.metadata.sorted_tables
+                          if table is not revision_table and 'revision_id' in table.c]
+
+    session = meta.Session
+    expired = jsonpatch_revision_table.c.expired_timestamp < older_than
+    versions_deleted = revisions_deleted = 0
+    while True:
+        revision_ids = [revision_id for (revision_id,) in session.execute(
+            select([jsonpatch_revision_table.c.revision_id]).where(expired).distinct().limit(batch_size))]
+        if not revision_ids:
+            break
+
+        result = session.execute(jsonpatch_revision_table.delete().where(
+            and_(expired, jsonpatch_revision_table.c.revision_id.in_(revision_ids))))
+        versions_deleted += result.rowcount
+
+        unreferenced = [not_(exists().where(table.c.revision_id == revision_table.c.id))
+                        for table in referencing_tables]
+        result = session.execute(revision_table.delete().where(
+            and_(revision_table.c.id.in_(revision_ids), *unreferenced)))
+        revisions_deleted += result.rowcount
+
+        session.commit()
+        log.info("Pruned %d patch versions and %d revisions", versions_deleted, revisions_deleted)
+
+    return versions_deleted, revisions_deleted
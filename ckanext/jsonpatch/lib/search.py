@@ -0,0 +1,185 @@
+# encoding: utf-8
+
+"""
+Application of patches to packages at search-index time, so that searches match patched values,
+and to the packages in search results, so that package_search returns patched documents. This is
+enabled with ``ckanext.jsonpatch.index = true``; the patches applied are those with the scope
+given by ``ckanext.jsonpatch.index.scope`` (or all patches, if not set).
+"""
+
+import json
+import logging
+import time
+from paste.deploy.converters import asbool, asint
+
+from ckan.lib.search.index import KEY_CHARS, RESERVED_FIELDS
+from ckan.model import meta
+from ckanext.jsonpatch.model.oplist import JSONPatchOplist, ALL_SCOPES
+from ckanext.jsonpatch.lib.patch import get_compiled_patch
+
+log = logging.getLogger(__name__)
+
+# indexed fields that are copied as is from the patched package dictionary
+INDEXED_FIELDS = (
+    'title', 'notes', 'url', 'version', 'author', 'author_email', 'maintainer', 'maintainer_email',
+    'license_id',
+)
+
+_enabled = False
+_scope = ALL_SCOPES
+_prefetch_ttl = 0
+_prefetched = None
+_prefetched_at = 0
+
+
+def configure(config):
+    global _enabled, _scope, _prefetch_ttl
+    _enabled = asbool(config.get('ckanext.jsonpatch.index', False))
+    _scope = config.get('ckanext.jsonpatch.index.scope') or ALL_SCOPES
+    _prefetch_ttl = asint(config.get('ckanext.jsonpatch.index.prefetch_ttl', 0))
+    clear_prefetched()
+
+
+def is_enabled():
+    return _enabled
+
+
+def clear_prefetched():
+    global _prefetched
+    _prefetched = None
+
+
+def _get_oplist(package_id):
+    """
+    Return the (version, operations) of the package's operation list for the configured scope,
+    or None if the package has no patches.
+
+    If prefetching is enabled, the operation lists of all patched packages are loaded with a
+    single query, and reused for up to prefetch_ttl seconds; this is intended for bulk reindexing,
+    and is not used for search results.
+    """
+    global _prefetched, _prefetched_at
+    if _prefetch_ttl:
+        if _prefetched is None or time.time() - _prefetched_at > _prefetch_ttl:
+            q = meta.Session.query(JSONPatchOplist.object_id, JSONPatchOplist.version, JSONPatchOplist.operations) \
+                .filter_by(model_name='package', scope=_scope)
+            _prefetched = dict((object_id, (version, operations)) for (object_id, version, operations) in q)
+            _prefetched_at = time.time()
+        return _prefetched.get(package_id)
+
+    return meta.Session.query(JSONPatchOplist.version, JSONPatchOplist.operations) \
+        .filter_by(model_name='package', object_id=package_id, scope=_scope) \
+        .first()
+
+
+def patch_index_dict(pkg_dict):
+    """
+    Apply the package's patches to the searchable fields of the dictionary about to be indexed.
+
+    The stored package dictionaries (validated_data_dict and data_dict) are left unpatched, since
+    package_show may return them in place of the package itself; patches are applied to them in
+    search results instead (see patch_search_results).
+    """
+    oplist = _get_oplist(pkg_dict['id'])
+    if not oplist or not pkg_dict.get('validated_data_dict'):
+        return pkg_dict
+    version, operations = oplist
+    patch = get_compiled_patch(('package', pkg_dict['id'], _scope), version, lambda: operations)
+
+    unpatched = json.loads(pkg_dict['validated_data_dict'])
+    try:
+        patched = patch.apply(unpatched)
+    except Exception, e:
+        log.error("Unable to apply JSON Patches to package %s for indexing: %s", pkg_dict['id'], e)
+        return pkg_dict
+
+    for field in INDEXED_FIELDS:
+        if field in patched:
+            pkg_dict[field] = patched[field]
+
+    pkg_dict['tags'] = [tag['name'] for tag in patched.get('tags') or []]
+
+    # extras are indexed as ckan.lib.search.index does, both as extras_<key> and, unless the key
+    # is that of another field, as <key>
+    index_fields = set(RESERVED_FIELDS) | set(unpatched)
+    for key, _ in _index_extras(unpatched):
+        pkg_dict.pop('extras_' + key, None)
+        if key not in index_fields:
+            pkg_dict.pop(key, None)
+    for key, value in _index_extras(patched):
+        pkg_dict['extras_' + key] = value
+        if key not in index_fields:
+            pkg_dict[key] = value
+
+    resources = patched.get('resources') or []
+    for index_key, resource_key in (('res_name', 'name'), ('res_description', 'description'),
+                                    ('res_format', 'format'), ('res_url', 'url')):
+        pkg_dict[index_key] = [resource.get(resource_key) or u'' for resource in resources]
+
+    return pkg_dict
+
+
+def _index_extras(package_dict):
+    """
+    Return the (key, value) pairs of the package's extras, with keys and values as indexed.
+    """
+    for extra in package_dict.get('extras') or []:
+        key, value = extra['key'], extra['value']
+        if isinstance(value, (tuple, list)):
+            value = u' '.join(map(unicode, value))
+        key = ''.join(c for c in key if c in KEY_CHARS)
+        yield key, value
+
+
+def patch_search_results(search_results, search_params):
+    """
+    Apply the patches of each package in the results of package_search, whose dictionaries are
+    those stored, unpatched, in the search index. Results limited to certain fields (with 'fl')
+    are returned as is.
+    """
+    if search_params.get('fl'):
+        return search_results
+    packages = [package for package in search_results.get('results') or [] if package.get('id')]
+    if not packages:
+        return search_results
+
+    # only the result set's operation lists are loaded, whether or not prefetching is enabled
+    q = meta.Session.query(JSONPatchOplist.object_id, JSONPatchOplist.version, JSONPatchOplist.operations) \
+        .filter(JSONPatchOplist.model_name == 'package',
+                JSONPatchOplist.object_id.in_([package['id'] for package in packages]),
+                JSONPatchOplist.scope == _scope)
+    oplists = dict((object_id, (version, operations)) for (object_id, version, operations) in q)
+
+    results = []
+    for package in search_results['results']:
+        oplist = oplists.get(package.get('id'))
+        if oplist:
+            version, operations = oplist
+            patch = get_compiled_patch(('package', package['id'], _scope), version, lambda: operations)
+            try:
+                # the result dictionaries are decoded afresh for each search
+                package = patch.apply(package, in_place=True)
+            except Exception, e:
+                log.error("Unable to apply JSON Patches to package %s in search results: %s", package['id'], e)
+        results += [package]
+    search_results['results'] = results
+    return search_results
+
+
+def reindex(model_name, object_id):
+    """
+    Reindex a package whose patches have changed. Only package patches are applied at index time,
+    so changes to patches for other models do not require reindexing.
+
+    This is called after the patches have been committed, so an indexing error is logged rather
+    than raised: the package's index entry remains stale until the package is next indexed.
+    """
+    from ckan.lib.search import rebuild, SearchIndexError
+
+    if model_name != 'package':
+        return
+    clear_prefetched()
+    try:
+        rebuild(object_id)
+    except SearchIndexError, e:
+        log.error("Unable to reindex package %s after a change to its JSON Patches: %s", object_id, e)
@@ -0,0 +1,197 @@
+# encoding: utf-8
+
+"""
+Timing of the phases of the jsonpatch actions, enabled with ``ckanext.jsonpatch.stats = true``.
+
+Call counts, total and maximum durations, and latency histograms are aggregated per process by
+(action, phase, model_name, scope), and are returned by the jsonpatch_stats action. With
+``ckanext.jsonpatch.stats.log = true``, a structured (JSON) log line giving the duration of each
+phase is also written for every action call.
+
+When timing is disabled, timer() returns a shared no-op context manager, and timed actions
+call straight through to the action function.
+"""
+
+import functools
+import json
+import logging
+import threading
+import time
+from paste.deploy.converters import asbool
+
+log = logging.getLogger(__name__)
+
+# upper bounds of the latency histogram buckets, in milliseconds
+BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+_enabled = False
+_log_enabled = False
+_stats = {}
+_lock = threading.Lock()
+_local = threading.local()
+
+
+def configure(config):
+    global _enabled, _log_enabled
+    _enabled = asbool(config.get('ckanext.jsonpatch.stats', False))
+    _log_enabled = _enabled and asbool(config.get('ckanext.jsonpatch.stats.log', False))
+    reset()
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    with _lock:
+        _stats.clear()
+
+
+class _Stat(object):
+
+    __slots__ = ('count', 'total_ms', 'max_ms', 'histogram')
+
+    def __init__(self):
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.histogram = [0] * (len(BUCKETS_MS) + 1)
+
+    def add(self, ms):
+        self.count += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+        for i, bound in enumerate(BUCKETS_MS):
+            if ms <= bound:
+                self.histogram[i] += 1
+                break
+        else:
+            self.histogram[-1] += 1
+
+
+def record(action, phase, model_name, scope, ms):
+    """
+    Add a duration to the aggregated statistics, and to the log record of the current action call.
+    """
+    key = (action, phase, model_name, scope or None)
+    with _lock:
+        stat = _stats.get(key)
+        if stat is None:
+            stat = _stats[key] = _Stat()
+        stat.add(ms)
+
+    call = getattr(_local, 'call', None)
+    if call is not None:
+        call['phases'][phase] = call['phases'].get(phase, 0.0) + ms
+
+
+class _Timer(object):
+
+    __slots__ = ('action', 'phase', 'model_name', 'scope', 'start')
+
+    def __init__(self, action, phase, model_name, scope):
+        self.action = action
+        self.phase = phase
+        self.model_name = model_name
+        self.scope = scope
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        record(self.action, self.phase, self.model_name, self.scope, (time.time() - self.start) * 1000.0)
+
+
+class _NullTimer(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+_null_timer = _NullTimer()
+
+
+def timer(action, phase, model_name=None, scope=None):
+    """
+    Return a context manager that times a phase of an action.
+    """
+    if not _enabled:
+        return _null_timer
+    return _Timer(action, phase, model_name, scope)
+
+
+def timers(action, model_name=None, scope=None):
+    """
+    Return a function ``timed(phase)`` returning a timer for a phase of the given action call.
+
+    The call's 'total' is then also recorded under this model_name and scope, which an action
+    may only know once it has loaded the patch, e.g. jsonpatch_update and jsonpatch_delete.
+    """
+    total = getattr(_local, 'total', None)
+    if total is not None and total.action == action:
+        total.model_name = model_name
+        total.scope = scope
+        call = _local.call
+        if call is not None:
+            call['model_name'] = model_name
+            call['scope'] = scope
+    return lambda phase: timer(action, phase, model_name, scope)
+
+
+def timed_action(func):
+    """
+    Decorator for an action function, timing the whole call as the 'total' phase, aggregated by
+    the model_name and scope in the data_dict, or by those passed to timers() for the call.
+    """
+    action = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(context, data_dict):
+        if not _enabled:
+            return func(context, data_dict)
+
+        model_name = data_dict.get('model_name')
+        scope = data_dict.get('scope')
+        outer_call = getattr(_local, 'call', None)
+        outer_total = getattr(_local, 'total', None)
+        _local.call = {'action': action, 'model_name': model_name, 'scope': scope, 'phases': {}} \
+            if _log_enabled else None
+        _local.total = _Timer(action, 'total', model_name, scope)
+        try:
+            with _local.total:
+                return func(context, data_dict)
+        finally:
+            call = _local.call
+            _local.call = outer_call
+            _local.total = outer_total
+            if call is not None:
+                log.info("%s", json.dumps(call, sort_keys=True))
+
+    return wrapper
+
+
+def snapshot():
+    """
+    Return the aggregated statistics of this process.
+
+    :returns: list of dictionaries, ordered by action, phase, model_name and scope; the histogram
+        gives the number of calls taking up to each bucket's upper bound (None for the last bucket)
+    """
+    bounds = list(BUCKETS_MS) + [None]
+    with _lock:
+        items = sorted(_stats.items())
+        return [{
+            'action': action,
+            'phase': phase,
+            'model_name': model_name,
+            'scope': scope,
+            'count': stat.count,
+            'total_ms': stat.total_ms,
+            'mean_ms': stat.total_ms / stat.count,
+            'max_ms': stat.max_ms,
+            'histogram': [{'le_ms': bound, 'count': count} for bound, count in zip(bounds, stat.histogram)],
+        } for (action, phase, model_name, scope), stat in items]
@@ -0,0 +1,193 @@
+# encoding: utf-8
+
+"""
+Optional JSONB storage of patch operations and data on PostgreSQL.
+
+The JSON columns of the patch tables (the operations and data of patches and their revisions, the
+per-object operation lists, and materialized objects) are created as text.
+``paster jsonpatch migrate-jsonb`` converts them to JSONB on a live site: a JSONB copy of each
+column is added and filled in batches, a trigger keeping the copy in step with rows written
+in the meantime, after which the copies replace the original columns in one short transaction.
+GIN indexes are then built, so that searches on the operation's ``op`` or on keys in ``data`` are
+resolved by the database.
+
+The column types (see model/types.py) work with either storage: values are written as JSON text,
+which PostgreSQL converts on assignment to a JSONB column, and values read from JSONB columns are
+decoded by the driver rather than by json.loads.
+"""
+
+import logging
+from sqlalchemy import inspect, text, cast
+from sqlalchemy.dialects import postgresql
+
+from ckan.model import meta
+from ckanext.jsonpatch.model.database import column_exists, create_index_concurrently
+from ckanext.jsonpatch.model.jsonpatch import jsonpatch_table, jsonpatch_revision_table
+from ckanext.jsonpatch.model.oplist import jsonpatch_oplist_table
+from ckanext.jsonpatch.model.materialized import jsonpatch_materialized_table
+
+log = logging.getLogger(__name__)
+
+# the JSON columns of each table
+COLUMNS = (
+    (jsonpatch_table, ('operation', 'data')),
+    (jsonpatch_revision_table, ('operation', 'data')),
+    (jsonpatch_oplist_table, ('patch_ids', 'operations')),
+    (jsonpatch_materialized_table, ('data',)),
+)
+
+# (index name, indexed expression); jsonb_path_ops indexes are smaller, and support containment only
+GIN_INDEXES = (
+    ('idx_jsonpatch_operation_gin', 'operation jsonb_path_ops'),
+    ('idx_jsonpatch_data_gin', 'data'),
+)
+
+# converts a text value to JSONB, keeping values that are not valid JSON as JSON strings
+_TO_JSONB_FUNCTION = u"""
+CREATE OR REPLACE FUNCTION jsonpatch_to_jsonb(value text) RETURNS jsonb AS $$
+BEGIN
+    RETURN value::jsonb;
+EXCEPTION WHEN others THEN
+    RETURN to_json(value)::jsonb;
+END
+$$ LANGUAGE plpgsql IMMUTABLE
+"""
+
+_jsonb = None
+
+
+def uses_jsonb():
+    """
+    Return True if patch operations and data are stored as JSONB.
+    """
+    global _jsonb
+    if _jsonb is None:
+        _jsonb = meta.engine.dialect.name == 'postgresql' and \
+            set(('operation', 'data')) <= _jsonb_columns(jsonpatch_table.name)
+    return _jsonb
+
+
+def contains(column, value):
+    """
+    Return a filter condition matching rows in which the JSONB column contains the given value,
+    e.g. ``contains(jsonpatch_table.c.operation, {'op': 'remove'})``.
+    """
+    return column.op('@>')(cast(value, postgresql.JSONB))
+
+
+def migrate_to_jsonb(batch_size=1000):
+    """
+    Convert the JSON columns of the patch tables to JSONB, and build the GIN indexes on the
+    jsonpatch table. Each batch of rows is copied in its own transaction; an interrupted migration may be
+    resumed by running it again.
+
+    :returns: the number of rows copied
+    """
+    global _jsonb
+    engine = meta.engine
+    if engine.dialect.name != 'postgresql':
+        raise ValueError("JSONB storage requires PostgreSQL")
+
+    with engine.begin() as conn:
+        conn.execute(_TO_JSONB_FUNCTION)
+
+    count = 0
+    for table, json_columns in COLUMNS:
+        existing = _jsonb_columns(table.name)
+        columns = [column for column in json_columns if column not in existing]
+        if not columns:
+            log.info("Table %s already uses JSONB storage", table.name)
+            continue
+        _add_copies(table, columns)
+        count += _fill_copies(table, columns, batch_size)
+        _replace_columns(table, columns)
+        log.info("Converted %s of table %s to JSONB", ', '.join(columns), table.name)
+
+    for name, expression in GIN_INDEXES:
+        if create_index_concurrently(name, u'CREATE INDEX CONCURRENTLY {} ON {} USING gin ({})'.format(
+                name, jsonpatch_table.name, expression)):
+            log.info("Created index %s on table %s", name, jsonpatch_table.name)
+
+    _jsonb = True
+    return count
+
+
+def _jsonb_columns(table_name):
+    return set(column['name'] for column in inspect(meta.engine).get_columns(table_name)
+               if isinstance(column['type'], postgresql.JSONB))
+
+
+def _add_copies(table, columns):
+    """
+    Add a JSONB copy of each column, and a trigger that sets the copies of inserted and updated rows.
+    """
+    function = u'{}_sync_jsonb'.format(table.name)
+    assignments = u''.join(u'NEW.{0}_jsonb := jsonpatch_to_jsonb(NEW.{0}); '.format(column)
+                           for column in columns)
+    with meta.engine.begin() as conn:
+        for column in columns:
+            # added by an interrupted migration
+            if not column_exists(conn, table.name, column + u'_jsonb'):
+                conn.execute(u'ALTER TABLE {} ADD COLUMN {}_jsonb jsonb'.format(table.name, column))
+        conn.execute(u'CREATE OR REPLACE FUNCTION {}() RETURNS trigger AS $$ '
+                     u'BEGIN {}RETURN NEW; END $$ LANGUAGE plpgsql'.format(function, assignments))
+        conn.execute(u'DROP TRIGGER IF EXISTS {0} ON {1}'.format(function, table.name))
+        conn.execute(u'CREATE TRIGGER {0} BEFORE INSERT OR UPDATE ON {1} '
+                     u'FOR EACH ROW EXECUTE PROCEDURE {0}()'.format(function, table.name))
+
+
+def _fill_copies(table, columns, batch_size):
+    """
+    Copy the values of existing rows to the JSONB columns, in primary key order, in batches.
+    """
+    key = [column.name for column in table.primary_key.columns]
+    key_expression = u'({})'.format(u', '.join(key))
+    assignments = u', '.join(u'{0}_jsonb = jsonpatch_to_jsonb({0})'.format(column) for column in columns)
+
+    count = 0
+    last = None
+    while True:
+        with meta.engine.begin() as conn:
+            q = u'SELECT {0} FROM {1} ORDER BY {0} LIMIT :limit'
+            params = {'limit': batch_size}
+            if last:
+                q = u'SELECT {0} FROM {1} WHERE {2} > {3} ORDER BY {0} LIMIT :limit'
+                params.update(_key_params('last', last))
+            keys = conn.execute(text(q.format(u', '.join(key), table.name, key_expression,
+                                              _key_placeholders('last', len(key)))), params).fetchall()
+            if not keys:
+                break
+
+            where = u'{} <= {}'.format(key_expression, _key_placeholders('bound', len(key)))
+            params = _key_params('bound', keys[-1])
+            if last:
+                where += u' AND {} > {}'.format(key_expression, _key_placeholders('last', len(key)))
+                params.update(_key_params('last', last))
+            conn.execute(text(u'UPDATE {} SET {} WHERE {}'.format(table.name, assignments, where)), params)
+
+        count += len(keys)
+        last = tuple(keys[-1])
+        log.info("Copied %d rows of table %s", count, table.name)
+    return count
+
+
+def _key_placeholders(prefix, length):
+    return u'({})'.format(u', '.join(u':{}_{}'.format(prefix, i) for i in xrange(length)))
+
+
+def _key_params(prefix, values):
+    return dict(('{}_{}'.format(prefix, i), value) for i, value in enumerate(values))
+
+
+def _replace_columns(table, columns):
+    """
+    Replace the original columns with their JSONB copies, and remove the trigger.
+    """
+    function = u'{}_sync_jsonb'.format(table.name)
+    with meta.engine.begin() as conn:
+        conn.execute(u'LOCK TABLE {} IN ACCESS EXCLUSIVE MODE'.format(table.name))
+        conn.execute(u'DROP TRIGGER {} ON {}'.format(function, table.name))
+        conn.execute(u'DROP FUNCTION {}()'.format(function))
+        for column in columns:
+            conn.execute(u'ALTER TABLE {0} DROP COLUMN {1}'.format(table.name, column))
+            conn.execute(u'ALTER TABLE {0} RENAME COLUMN {1}_jsonb TO {1}'.format(table.name, column))
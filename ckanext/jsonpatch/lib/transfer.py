@@ -0,0 +1,179 @@
+# encoding: utf-8
+
+"""
+Export and import of patches as newline-delimited JSON (one patch per line), for backing up
+patch sets and moving them between instances.
+
+Patches are exported in id order, so an interrupted export or import may be resumed from the last
+id that was processed (the checkpoint).
+"""
+
+import json
+import logging
+from sqlalchemy import select
+
+import ckan.model as model
+import ckan.plugins.toolkit as tk
+from ckan.lib.helpers import date_str_to_datetime
+from ckan.model import meta
+from ckanext.jsonpatch.logic import schema
+from ckanext.jsonpatch.lib import cache as apply_cache, materialize, revisions
+from ckanext.jsonpatch.model.jsonpatch import JSONPatch, jsonpatch_table
+from ckanext.jsonpatch.model.oplist import JSONPatchOplist
+
+log = logging.getLogger(__name__)
+
+FIELDS = ('id', 'model_name', 'object_id', 'operation', 'scope', 'ordinal', 'timestamp', 'data', 'state')
+
+REQUIRED_FIELDS = ('id', 'model_name', 'object_id', 'operation', 'timestamp')
+
+
+def export_patches(out, after=None, model_name=None, batch_size=1000, checkpoint=None):
+    """
+    Write patches (in any state) to a file-like object, one JSON object per line, in id order.
+
+    Rows are read through a server-side cursor, so memory use does not grow with the number of patches.
+
+    :param after: only export patches with ids greater than this (a checkpoint from an earlier export)
+    :param checkpoint: function ``checkpoint(last_id, count)``, called after each batch is written
+    :returns: the number of patches exported
+    """
+    q = select([jsonpatch_table.c[field] for field in FIELDS]).order_by(jsonpatch_table.c.id)
+    if after:
+        q = q.where(jsonpatch_table.c.id > after)
+    if model_name:
+        q = q.where(jsonpatch_table.c.model_name == model_name)
+
+    count = 0
+    connection = meta.engine.connect().execution_options(stream_results=True)
+    try:
+        result = connection.execute(q)
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                out.write(json.dumps(_row_dict(row), sort_keys=True) + '\n')
+            count += len(rows)
+            if checkpoint is not None:
+                checkpoint(rows[-1]['id'], count)
+        result.close()
+    finally:
+        connection.close()
+    return count
+
+
+def import_patches(lines, user, after=None, chunk_size=1000, checkpoint=None):
+    """
+    Insert patches read from lines of newline-delimited JSON, as written by export_patches.
+
+    Each chunk of patches is validated, saved and committed; the operation lists of
+    the affected objects are rebuilt within the same transaction. Patches whose ids already exist
+    are skipped, so a file may safely be imported again after an interruption.
+
+    :param after: skip patches with ids up to and including this (a checkpoint from an earlier import)
+    :param checkpoint: function ``checkpoint(last_id, count)``, called after each chunk is committed
+    :returns: tuple of (imported, skipped) patch counts
+    """
+    imported = skipped = 0
+    chunk = []
+    for line_number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            patch_dict = json.loads(line)
+        except ValueError, e:
+            raise ValueError("Line %d: invalid JSON: %s" % (line_number, e))
+        missing = [field for field in REQUIRED_FIELDS if not patch_dict.get(field)]
+        if missing:
+            raise ValueError("Line %d: missing %s" % (line_number, ', '.join(missing)))
+        if after and patch_dict.get('id') <= after:
+            continue
+        chunk += [patch_dict]
+        if len(chunk) >= chunk_size:
+            added = _import_chunk(chunk, user)
+            imported += added
+            skipped += len(chunk) - added
+            if checkpoint is not None:
+                checkpoint(chunk[-1]['id'], imported + skipped)
+            chunk = []
+
+    if chunk:
+        added = _import_chunk(chunk, user)
+        imported += added
+        skipped += len(chunk) - added
+        if checkpoint is not None:
+            checkpoint(chunk[-1]['id'], imported + skipped)
+
+    return imported, skipped
+
+
+def _import_chunk(patch_dicts, user):
+    """
+    Save a chunk of patch dictionaries, skipping those that already exist. Each patch is validated
+    as by jsonpatch_create, keeping its exported id, timestamp and state. Patches are saved under
+    a single revision, except for those with scopes that are configured to be written without
+    revisions.
+
+    :returns: the number of patches added
+    """
+    session = model.Session
+    context = {'model': model, 'session': session, 'user': user, 'ignore_auth': True}
+    ids = [patch_dict['id'] for patch_dict in patch_dicts]
+    existing = set(id_ for (id_,) in session.query(JSONPatch.id).filter(JSONPatch.id.in_(ids)))
+
+    create_schema = schema.jsonpatch_create_schema()
+    validated = []
+    for patch_dict in patch_dicts:
+        if patch_dict['id'] in existing:
+            continue
+        existing.add(patch_dict['id'])
+        data, errors = tk.navl_validate(patch_dict, create_schema, context)
+        if errors:
+            session.rollback()
+            raise ValueError("Patch %s: %s" % (patch_dict['id'], errors))
+        # the create schema ignores the fields that are kept as exported
+        data['id'] = patch_dict['id']
+        data['timestamp'] = date_str_to_datetime(patch_dict['timestamp'])
+        data['state'] = patch_dict.get('state') or u'active'
+        data.setdefault('ordinal', 0)
+        validated += [data]
+
+    # the revision must be set before any revisioned patch is flushed
+    if any(revisions.is_revisioned(data.get('scope')) for data in validated):
+        rev = model.repo.new_revision()
+        rev.author = user
+        rev.message = u'Import JSON Patches'
+
+    objects = set()
+    added = 0
+    for data in validated:
+        if revisions.is_revisioned(data.get('scope')):
+            session.add(JSONPatch(**dict((field, data.get(field)) for field in FIELDS)))
+        else:
+            revisions.save_unrevisioned(data, context)
+        objects.add((data['model_name'], data['object_id']))
+        added += 1
+
+    if not added:
+        session.rollback()
+        return 0
+
+    for model_name, object_id in sorted(objects):
+        JSONPatchOplist.rebuild(model_name, object_id)
+        materialize.expire(model_name, object_id)
+    model.repo.commit()
+
+    for model_name, object_id in objects:
+        apply_cache.invalidate(model_name, object_id)
+    session.remove()
+
+    log.debug("Imported %d patches for %d objects", added, len(objects))
+    return added
+
+
+def _row_dict(row):
+    patch_dict = dict((field, row[field]) for field in FIELDS)
+    patch_dict['timestamp'] = row['timestamp'].isoformat()
+    return patch_dict
@@ -1,18 +1,33 @@
 # encoding: utf-8
 
-import jsonpatch
+import datetime
+import hashlib
+import json
 import logging
+import jsonpointer
+from jsonpatch import JsonPatchException
 from paste.deploy.converters import asbool
+from sqlalchemy import select, exists, or_, and_
 
 import ckan.plugins.toolkit as tk
 from ckan.common import _
+from ckan.lib.helpers import date_str_to_datetime
 from ckanext.jsonpatch.logic import schema
-from ckanext.jsonpatch.lib.dictization import jsonpatch_dict_save, jsonpatch_dictize
-from ckanext.jsonpatch.model.jsonpatch import JSONPatch
+from ckanext.jsonpatch.lib import cache as apply_cache, checkpoints, health, materialize, revisions, search, stats, storage
+from ckanext.jsonpatch.lib.patch import CompiledPatch, get_compiled_patch
+from ckanext.jsonpatch.lib import diff
+from ckanext.jsonpatch.lib.compaction import compact
+from ckanext.jsonpatch.lib.projection import project_oplist
+from ckanext.jsonpatch.lib.resolvers import resolve
+from ckanext.jsonpatch.lib.dictization import jsonpatch_dict_save, jsonpatch_dictize, jsonpatch_list_dictize
+from ckanext.jsonpatch.model.jsonpatch import JSONPatch, jsonpatch_table, jsonpatch_revision_table
+from ckanext.jsonpatch.model.oplist import JSONPatchOplist, ALL_SCOPES
+from ckanext.jsonpatch.model.health import JSONPatchHealth
 
 log = logging.getLogger(__name__)
 
 
+@stats.timed_action
 def jsonpatch_create(context, data_dict):
     """
     Create a new JSON Patch for some object. This consists of a single patch "operation" as
@@ -33,6 +48,10 @@ def jsonpatch_create(context, data_dict):
     :type ordinal: integer
     :param data: any additional information about the patch (optional)
     :type data: dictionary
+    :param validate: check that the patch operation can be applied to the patched object at the
+        patch's position, and reject the patch if not (optional, default: the value of
+        ``ckanext.jsonpatch.validate``)
+    :type validate: boolean
 
     :returns: the newly created JSON Patch (unless 'return_id_only' is set to True
               in the context, in which case just the JSON Patch id will be returned)
@@ -42,36 +61,42 @@ def jsonpatch_create(context, data_dict):
     .. _`Section 4`: https://tools.ietf.org/html/rfc6902#section-4
     """
     log.info("Creating JSON Patch: %r", data_dict)
-    tk.check_access('jsonpatch_create', context, data_dict)
+    timed = stats.timers('jsonpatch_create', data_dict.get('model_name'), data_dict.get('scope'))
+    with timed('auth'):
+        tk.check_access('jsonpatch_create', context, data_dict)
 
     model = context['model']
-    user = context['user']
     session = context['session']
     defer_commit = context.get('defer_commit', False)
     return_id_only = context.get('return_id_only', False)
 
-    data, errors = tk.navl_validate(data_dict, schema.jsonpatch_create_schema(), context)
+    with timed('validate'):
+        data, errors = tk.navl_validate(data_dict, schema.jsonpatch_create_schema(), context)
     if errors:
         session.rollback()
         raise tk.ValidationError(errors)
 
-    jsonpatch = jsonpatch_dict_save(data, context)
-
-    rev = model.repo.new_revision()
-    rev.author = user
-    if 'message' in context:
-        rev.message = context['message']
-    else:
-        rev.message = _(u'REST API: Create JSON Patch %s') % jsonpatch.id
+    with timed('save'):
+        jsonpatch, = _save_jsonpatches(context, [(None, data)],
+                                       lambda jsonpatches: _(u'REST API: Create JSON Patch %s') % jsonpatches[0].id)
 
+    with timed('derived'):
+        _update_derived_tables(jsonpatch.model_name, jsonpatch.object_id)
+    if _get_validate(data_dict):
+        with timed('check'):
+            _check_operation(context, jsonpatch)
     if not defer_commit:
-        model.repo.commit()
+        with timed('commit'):
+            model.repo.commit()
+
+    _on_patches_changed(jsonpatch.model_name, jsonpatch.object_id)
 
     output = jsonpatch.id if return_id_only \
         else tk.get_action('jsonpatch_show')(context, {'id': jsonpatch.id})
     return output
 
 
+@stats.timed_action
 def jsonpatch_update(context, data_dict):
     """
     Update a JSON Patch.
@@ -97,7 +122,6 @@ def jsonpatch_update(context, data_dict):
     log.info("Updating JSON Patch: %r", data_dict)
 
     model = context['model']
-    user = context['user']
     session = context['session']
     defer_commit = context.get('defer_commit', False)
     return_id_only = context.get('return_id_only', False)
@@ -109,7 +133,9 @@ def jsonpatch_update(context, data_dict):
     else:
         raise tk.ObjectNotFound('%s: %s' % (_('Not found'), _('JSON Patch')))
 
-    tk.check_access('jsonpatch_update', context, data_dict)
+    timed = stats.timers('jsonpatch_update', jsonpatch.model_name, jsonpatch.scope)
+    with timed('auth'):
+        tk.check_access('jsonpatch_update', context, data_dict)
 
     data_dict.update({
         'id': jsonpatch_id,
@@ -119,28 +145,33 @@ def jsonpatch_update(context, data_dict):
         'allow_partial_update': True,
     })
 
-    data, errors = tk.navl_validate(data_dict, schema.jsonpatch_update_schema(), context)
+    with timed('validate'):
+        data, errors = tk.navl_validate(data_dict, schema.jsonpatch_update_schema(), context)
     if errors:
         session.rollback()
         raise tk.ValidationError(errors)
 
-    jsonpatch = jsonpatch_dict_save(data, context)
-
-    rev = model.repo.new_revision()
-    rev.author = user
-    if 'message' in context:
-        rev.message = context['message']
-    else:
-        rev.message = _(u'REST API: Update JSON Patch %s') % jsonpatch_id
+    with timed('save'):
+        jsonpatch, = _save_jsonpatches(context, [(jsonpatch, data)],
+                                       lambda jsonpatches: _(u'REST API: Update JSON Patch %s') % jsonpatch_id)
 
+    with timed('derived'):
+        _update_derived_tables(jsonpatch.model_name, jsonpatch.object_id)
+    if _get_validate(data_dict):
+        with timed('check'):
+            _check_operation(context, jsonpatch)
     if not defer_commit:
-        model.repo.commit()
+        with timed('commit'):
+            model.repo.commit()
+
+    _on_patches_changed(jsonpatch.model_name, jsonpatch.object_id)
 
     output = jsonpatch_id if return_id_only \
         else tk.get_action('jsonpatch_show')(context, {'id': jsonpatch_id})
     return output
 
 
+@stats.timed_action
 def jsonpatch_delete(context, data_dict):
     """
     Delete a JSON Patch.
@@ -162,18 +193,268 @@ def jsonpatch_delete(context, data_dict):
     else:
         raise tk.ObjectNotFound('%s: %s' % (_('Not found'), _('JSON Patch')))
 
-    tk.check_access('jsonpatch_delete', context, data_dict)
-
-    rev = model.repo.new_revision()
-    rev.author = user
-    rev.message = _(u'REST API: Delete JSON Patch %s') % jsonpatch_id
+    timed = stats.timers('jsonpatch_delete', jsonpatch.model_name, jsonpatch.scope)
+    with timed('auth'):
+        tk.check_access('jsonpatch_delete', context, data_dict)
 
-    jsonpatch.delete()
+    with timed('save'):
+        if revisions.is_revisioned(jsonpatch.scope):
+            rev = model.repo.new_revision()
+            rev.author = user
+            rev.message = _(u'REST API: Delete JSON Patch %s') % jsonpatch_id
+            jsonpatch.delete()
+        else:
+            revisions.delete_unrevisioned(jsonpatch, context)
+    with timed('derived'):
+        _update_derived_tables(jsonpatch.model_name, jsonpatch.object_id)
     if not defer_commit:
-        model.repo.commit()
+        with timed('commit'):
+            model.repo.commit()
+
+    _on_patches_changed(jsonpatch.model_name, jsonpatch.object_id)
+
+
+@stats.timed_action
+def jsonpatch_create_many(context, data_dict):
+    """
+    Create multiple JSON Patches in a single revision and transaction.
+
+    All the patches are validated before any is saved; if any patch is invalid, none are created.
+    Patches for the same object with the same ordinal are applied in the order in which they are
+    listed.
+
+    For the fields of each patch see
+    :py:func:`~ckanext.jsonpatch.logic.action.jsonpatch_create`.
+
+    :param patches: the patches to create
+    :type patches: list of dictionaries
+    :param validate: check that each patch operation can be applied to the patched object at the
+        patch's position, and reject all the patches if any cannot (optional, default: the value
+        of ``ckanext.jsonpatch.validate``)
+    :type validate: boolean
+    :param all_fields: return dictionaries instead of just ids (optional, default: ``False``)
+    :type all_fields: boolean
+
+    :returns: the ids (or dictionaries) of the newly created JSON Patches, in the order given
+    :rtype: list
+    """
+    log.info("Creating JSON Patches: %d", len(data_dict.get('patches') or []))
+
+    session = context['session']
+    defer_commit = context.get('defer_commit', False)
+
+    patches = _get_patch_list(data_dict)
+    all_fields = asbool(data_dict.get('all_fields'))
+
+    timed = stats.timers('jsonpatch_create_many')
+    with timed('auth'):
+        tk.check_access('jsonpatch_create_many', context, data_dict)
+        for patch_dict in patches:
+            tk.check_access('jsonpatch_create', context, patch_dict)
+
+    context.pop('jsonpatch', None)
+    create_schema = schema.jsonpatch_create_schema()
+    validated = []
+    errors = []
+    with timed('validate'):
+        for patch_dict in patches:
+            data, patch_errors = tk.navl_validate(patch_dict, create_schema, context)
+            validated += [data]
+            errors += [patch_errors]
+    if any(errors):
+        session.rollback()
+        raise tk.ValidationError({'patches': errors})
+
+    # give each patch a distinct timestamp, so that the given order is the order of application
+    timestamp = datetime.datetime.utcnow()
+    for i, data in enumerate(validated):
+        data['timestamp'] = timestamp + datetime.timedelta(microseconds=i)
+
+    with timed('save'):
+        jsonpatches = _save_jsonpatches(context, [(None, data) for data in validated],
+                                        lambda jsonpatches: _(u'REST API: Create %d JSON Patches') % len(jsonpatches))
+
+    return _save_many(context, jsonpatches, all_fields, _get_validate(data_dict), timed)
+
+
+@stats.timed_action
+def jsonpatch_update_many(context, data_dict):
+    """
+    Update multiple JSON Patches in a single revision and transaction.
+
+    All the patches are validated before any is saved; if any patch is invalid or cannot be found,
+    none are updated.
+
+    For the fields of each patch see
+    :py:func:`~ckanext.jsonpatch.logic.action.jsonpatch_update`.
+
+    :param patches: the patches to update, each including its 'id'
+    :type patches: list of dictionaries
+    :param validate: check that each patch operation can be applied to the patched object at the
+        patch's position, and reject all the patches if any cannot (optional, default: the value
+        of ``ckanext.jsonpatch.validate``)
+    :type validate: boolean
+    :param all_fields: return dictionaries instead of just ids (optional, default: ``False``)
+    :type all_fields: boolean
+
+    :returns: the ids (or dictionaries) of the updated JSON Patches, in the order given
+    :rtype: list
+    """
+    log.info("Updating JSON Patches: %d", len(data_dict.get('patches') or []))
+
+    session = context['session']
+
+    patches = _get_patch_list(data_dict)
+    all_fields = asbool(data_dict.get('all_fields'))
+
+    timed = stats.timers('jsonpatch_update_many')
+    with timed('auth'):
+        tk.check_access('jsonpatch_update_many', context, data_dict)
+
+    jsonpatch_ids = [patch_dict.get('id') for patch_dict in patches]
+    with timed('query'):
+        existing = dict((jsonpatch.id, jsonpatch) for jsonpatch in
+                        session.query(JSONPatch).filter(JSONPatch.id.in_([id_ for id_ in jsonpatch_ids if id_])))
+
+    update_schema = schema.jsonpatch_update_schema()
+    context['allow_partial_update'] = True
+    validated = []
+    errors = []
+    with timed('validate'):
+        for patch_dict in patches:
+            jsonpatch = existing.get(patch_dict.get('id'))
+            if jsonpatch is None:
+                validated += [None]
+                errors += [{'id': [_('Not found') + ': ' + _('JSON Patch')]}]
+                continue
+
+            tk.check_access('jsonpatch_update', context, patch_dict)
+            context['jsonpatch'] = jsonpatch
+            data, patch_errors = tk.navl_validate(patch_dict, update_schema, context)
+            validated += [(jsonpatch, data)]
+            errors += [patch_errors]
+    if any(errors):
+        session.rollback()
+        raise tk.ValidationError({'patches': errors})
+
+    with timed('save'):
+        jsonpatches = _save_jsonpatches(context, validated,
+                                        lambda jsonpatches: _(u'REST API: Update %d JSON Patches') % len(jsonpatches))
+
+    return _save_many(context, jsonpatches, all_fields, _get_validate(data_dict), timed)
+
+
+@stats.timed_action
+def jsonpatch_create_from_diff(context, data_dict):
+    """
+    Create the JSON Patches that transform an object's current patched dictionary, as returned by
+    :py:func:`~ckanext.jsonpatch.logic.action.jsonpatch_apply`, into the given dictionary, e.g. a
+    patched dictionary that has been edited by a curator.
+
+    Lists of dictionaries are compared by a key identifying their elements (by default 'id' or
+    'name'), rather than by position, so that an element inserted into a long list gives a single
+    'add' operation. Each resulting operation is saved as a patch, in a single revision and
+    transaction, with an ordinal that places the new patches after the object's existing patches.
+
+    :param model_name: the 'xyz' part of the 'xyz_show' action to which the patches will be applied
+    :type model_name: string
+    :param object_id: the id or name of the 'xyz' object
+    :type object_id: string
+    :param object: the edited object dictionary
+    :type object: dictionary
+    :param scope: compare with the object as patched with this scope, and create the patches with
+        this scope (optional, default: compare with the object as patched with all patches)
+    :type scope: string
+    :param data: any additional information, saved with each patch (optional)
+    :type data: dictionary
+    :param keys: the keys identifying the elements of lists of dictionaries, in order of preference
+        (optional, default: ``['id', 'name']``)
+    :type keys: list of strings
+    :param if_match: the version token of the patched object from which the edited dictionary was
+        derived (see jsonpatch_apply's ``with_version``); if the patched object has changed since,
+        no patches are created (optional)
+    :type if_match: string
+    :param validate: check that each new patch operation can be applied to the patched object
+        (optional, default: the value of ``ckanext.jsonpatch.validate``)
+    :type validate: boolean
+    :param all_fields: return dictionaries instead of just ids (optional, default: ``False``)
+    :type all_fields: boolean
+
+    :returns: the ids (or dictionaries) of the newly created JSON Patches, in the order in which
+        they are applied; empty if there are no differences
+    :rtype: list
+    """
+    log.info("Creating JSON Patches from diff: %s %s", data_dict.get('model_name'), data_dict.get('object_id'))
+
+    session = context['session']
+
+    model_name, object_id, edited_dict = tk.get_or_bust(data_dict, ['model_name', 'object_id', 'object'])
+    scope = data_dict.get('scope')
+    keys = data_dict.get('keys') or diff.DEFAULT_KEYS
+    if_match = data_dict.get('if_match')
+    all_fields = asbool(data_dict.get('all_fields'))
+    if not isinstance(edited_dict, dict):
+        raise tk.ValidationError({'object': [_('Expecting a JSON object')]})
+    if not isinstance(keys, (list, tuple)) or not all(isinstance(key, basestring) for key in keys):
+        raise tk.ValidationError({'keys': [_('Must be a list of key names')]})
+
+    timed = stats.timers('jsonpatch_create_from_diff', model_name, scope)
+    with timed('auth'):
+        tk.check_access('jsonpatch_create_from_diff', context, data_dict)
+        object_id = resolve(context, model_name, object_id)
+
+    # the object's patches are locked until the new patches are committed, so that they cannot
+    # change between the if_match check and the insert
+    with timed('lock'):
+        JSONPatchOplist.lock(model_name, object_id)
+
+    current = tk.get_action('jsonpatch_apply')(dict(context), {
+        'model_name': model_name,
+        'object_id': object_id,
+        'scope': scope,
+        'with_version': True,
+    })
+    if if_match and current['version'] != if_match:
+        raise tk.ValidationError({'if_match': [_('The patched object has been modified')]})
+
+    with timed('diff'):
+        oplist = diff.make_oplist(current['object'], edited_dict, keys)
+        if not diff.verify(current['object'], edited_dict, oplist):
+            raise tk.ValidationError({'object': [_('Unable to derive JSON Patches that give this object')]})
+    if not oplist:
+        return []
+
+    # the new patches must follow all of the object's active patches; those with the highest
+    # ordinal are followed by timestamp, unless any has a timestamp later than the new patches'
+    with timed('query'):
+        last = session.query(JSONPatch.ordinal, JSONPatch.timestamp) \
+            .filter_by(model_name=model_name, object_id=object_id, state='active') \
+            .order_by(JSONPatch.ordinal.desc(), JSONPatch.timestamp.desc()) \
+            .first()
+    ordinal = 0
+    if last is not None:
+        ordinal = last.ordinal if last.timestamp < datetime.datetime.utcnow() else last.ordinal + 1
+        ordinal = max(ordinal, 0)
+
+    patches = [{
+        'model_name': model_name,
+        'object_id': object_id,
+        'operation': operation,
+        'scope': scope,
+        'ordinal': ordinal,
+        'data': data_dict.get('data'),
+    } for operation in oplist]
+    create_context = dict(context)
+    create_context.setdefault('message', _(u'REST API: Create %d JSON Patches from diff') % len(patches))
+    return tk.get_action('jsonpatch_create_many')(create_context, {
+        'patches': patches,
+        'validate': data_dict.get('validate'),
+        'all_fields': all_fields,
+    })
 
 
 @tk.side_effect_free
+@stats.timed_action
 def jsonpatch_show(context, data_dict):
     """
     Return a JSON Patch definition.
@@ -205,12 +486,17 @@ def jsonpatch_show(context, data_dict):
 
 
 @tk.side_effect_free
+@stats.timed_action
 def jsonpatch_list(context, data_dict):
     """
     Return a list of ids of an object's JSON Patches, in the order in which they will be applied.
 
     The structure of the returned dictionaries may be customized by passing 'schema' in the context.
 
+    Large patch lists may be paged through either with ``limit`` and ``offset``, or by passing the
+    id of the last patch of the previous page as ``after`` (keyset paging, which stays fast however
+    deep the page).
+
     :param model_name: the 'xyz' part of the 'xyz_show' action to which the patches will be applied
     :type model_name: string
     :param object_id: the id of the 'xyz' object
@@ -219,39 +505,279 @@ def jsonpatch_list(context, data_dict):
     :type scope: string
     :param all_fields: return dictionaries instead of just ids (optional, default: ``False``)
     :type all_fields: boolean
+    :param limit: the maximum number of patches to return (optional, default: no limit)
+    :type limit: integer
+    :param offset: the number of patches to skip (optional, default: ``0``)
+    :type offset: integer
+    :param after: return only patches that are applied after the patch with this id (optional)
+    :type after: string
 
     :rtype: list of strings
     """
     log.debug("Retrieving JSON Patch list: %r", data_dict)
 
-    model = context['model']
     session = context['session']
 
     model_name, object_id = tk.get_or_bust(data_dict, ['model_name', 'object_id'])
     scope = data_dict.get('scope')
     all_fields = asbool(data_dict.get('all_fields'))
+    limit = _get_natural_number(data_dict, 'limit')
+    offset = _get_natural_number(data_dict, 'offset')
+    after = data_dict.get('after')
 
-    tk.check_access('jsonpatch_list', context, data_dict)
+    timed = stats.timers('jsonpatch_list', model_name, scope)
+    with timed('auth'):
+        tk.check_access('jsonpatch_list', context, data_dict)
+        if all_fields:
+            tk.check_access('jsonpatch_show', context, data_dict)
 
-    q = session.query(JSONPatch.id) \
+    q = session.query(JSONPatch if all_fields else JSONPatch.id) \
         .filter_by(model_name=model_name, object_id=object_id, state='active') \
-        .order_by(JSONPatch.ordinal, JSONPatch.timestamp)
+        .order_by(JSONPatch.ordinal, JSONPatch.timestamp, JSONPatch.id)
     if scope:
         q = q.filter_by(scope=scope)
 
-    jsonpatches = q.all()
+    if after:
+        after_position = session.query(JSONPatch.ordinal, JSONPatch.timestamp) \
+            .filter_by(id=after).first()
+        if after_position is None:
+            raise tk.ValidationError({'after': [_('Not found') + ': ' + _('JSON Patch')]})
+        after_ordinal, after_timestamp = after_position
+        q = q.filter(or_(
+            JSONPatch.ordinal > after_ordinal,
+            and_(JSONPatch.ordinal == after_ordinal, JSONPatch.timestamp > after_timestamp),
+            and_(JSONPatch.ordinal == after_ordinal, JSONPatch.timestamp == after_timestamp, JSONPatch.id > after),
+        ))
+
+    if offset:
+        q = q.offset(offset)
+    if limit is not None:
+        q = q.limit(limit)
+
+    if not all_fields:
+        with timed('query'):
+            return [id_ for (id_,) in q.all()]
+
+    with timed('query'):
+        jsonpatches = q.all()
+    output_schema = context.get('schema') or schema.jsonpatch_show_schema()
     result = []
-    for (id_,) in jsonpatches:
-        if all_fields:
-            data_dict['id'] = id_
-            result += [tk.get_action('jsonpatch_show')(context, data_dict)]
-        else:
-            result += [id_]
+    with timed('dictize'):
+        for jsonpatch_dict in jsonpatch_list_dictize(jsonpatches, context):
+            result_dict, errors = tk.navl_validate(jsonpatch_dict, output_schema, context)
+            result += [result_dict]
 
     return result
 
 
 @tk.side_effect_free
+@stats.timed_action
+def jsonpatch_changes(context, data_dict):
+    """
+    Return the changes made to JSON Patches (for any object) after a cursor, in the order in which
+    they were made. Each change is a version of a patch recorded in the jsonpatch_revision table,
+    so patches with scopes that are written without revisions are not included, and changes
+    older than the last revision pruning may be incomplete.
+
+    To sync incrementally, start with a ``since`` timestamp (or neither parameter, to read all
+    recorded changes), and then pass the returned ``next_cursor`` in each subsequent call.
+
+    Changes made within the last ``ckanext.jsonpatch.changes.lag`` seconds are not returned
+    until the lag has passed, as a change is stamped when its revision is created and may only
+    be committed later, e.g. by a long-running jsonpatch_create_many call.
+
+    :param cursor: the next_cursor returned by a previous call (optional)
+    :type cursor: string
+    :param since: return changes made after this ISO timestamp (optional; ignored if cursor is given)
+    :type since: string
+    :param model_name: return only changes to patches for this model (optional)
+    :type model_name: string
+    :param scope: return only changes to patches with this scope (optional)
+    :type scope: string
+    :param limit: the maximum number of changes to return (optional, default: ``1000``)
+    :type limit: integer
+
+    :returns: {'changes': list of patch dictionaries, each with 'change' ('created', 'updated'
+        or 'deleted'), 'revision_id' and 'revision_timestamp', 'next_cursor': cursor}
+    :rtype: dictionary
+    """
+    log.debug("Retrieving JSON Patch changes: %r", data_dict)
+
+    session = context['session']
+
+    cursor = data_dict.get('cursor')
+    since = data_dict.get('since')
+    model_name = data_dict.get('model_name')
+    scope = data_dict.get('scope')
+    limit = _get_natural_number(data_dict, 'limit')
+    if limit is None:
+        limit = 1000
+    timed = stats.timers('jsonpatch_changes', model_name, scope)
+
+    with timed('auth'):
+        tk.check_access('jsonpatch_changes', context, data_dict)
+
+    table = jsonpatch_revision_table
+    q = select([table]).where(table.c.revision_timestamp <= revisions.get_changes_horizon()) \
+        .order_by(table.c.revision_timestamp, table.c.id, table.c.revision_id).limit(limit)
+    if cursor:
+        try:
+            cursor_timestamp, cursor_id, cursor_revision_id = cursor.split(' ')
+            cursor_timestamp = date_str_to_datetime(cursor_timestamp)
+        except ValueError:
+            raise tk.ValidationError({'cursor': [_('Invalid cursor')]})
+        q = q.where(or_(
+            table.c.revision_timestamp > cursor_timestamp,
+            and_(table.c.revision_timestamp == cursor_timestamp, table.c.id > cursor_id),
+            and_(table.c.revision_timestamp == cursor_timestamp, table.c.id == cursor_id,
+                 table.c.revision_id > cursor_revision_id),
+        ))
+    elif since:
+        try:
+            q = q.where(table.c.revision_timestamp > date_str_to_datetime(since))
+        except ValueError:
+            raise tk.ValidationError({'since': [_('Invalid timestamp')]})
+    if model_name:
+        q = q.where(table.c.model_name == model_name)
+    if scope:
+        q = q.where(table.c.scope == scope)
+
+    with timed('query'):
+        rows = session.execute(q).fetchall()
+        # the first recorded version of a patch is its creation
+        earlier = table.alias()
+        first_versions = set()
+        if rows:
+            q = select([table.c.id, table.c.revision_id]).where(and_(
+                table.c.id.in_(set(row['id'] for row in rows)),
+                ~exists().where(and_(earlier.c.id == table.c.id,
+                                     earlier.c.revision_timestamp < table.c.revision_timestamp))))
+            first_versions = set((id_, revision_id) for (id_, revision_id) in session.execute(q))
+
+    changes = []
+    for row in rows:
+        change_dict = dict((column.name, row[column.name]) for column in jsonpatch_table.c)
+        change_dict['timestamp'] = row['timestamp'].isoformat()
+        change_dict['revision_timestamp'] = row['revision_timestamp'].isoformat()
+        if row['state'] == 'deleted':
+            change_dict['change'] = 'deleted'
+        elif (row['id'], row['revision_id']) in first_versions:
+            change_dict['change'] = 'created'
+        else:
+            change_dict['change'] = 'updated'
+        changes += [change_dict]
+
+    if rows:
+        last = rows[-1]
+        cursor = u' '.join((last['revision_timestamp'].isoformat(), last['id'], last['revision_id']))
+    elif not cursor and since:
+        cursor = u' '.join((date_str_to_datetime(since).isoformat(), u'', u''))
+
+    return {
+        'changes': changes,
+        'next_cursor': cursor,
+    }
+
+
+@tk.side_effect_free
+@stats.timed_action
+def jsonpatch_search(context, data_dict):
+    """
+    Return the objects with active patches that touch the given location: patches whose path or
+    'from' path is at or under the location, or that replace or remove a containing location.
+
+    Patches may also be matched by their operation type and their data, where operations and data
+    are stored as JSONB (see ``paster jsonpatch migrate-jsonb``); at least one of ``path``, ``op``
+    and ``data`` must be given.
+
+    :param path: a JSON Pointer, e.g. '/extras' or '/resources/0/url' (optional)
+    :type path: string
+    :param op: match only patches with this operation type, e.g. 'remove' (optional)
+    :type op: string
+    :param data: match only patches whose data contains this dictionary (optional)
+    :type data: dictionary
+    :param model_name: return only objects of this model (optional)
+    :type model_name: string
+    :param scope: consider only patches with this scope (optional)
+    :type scope: string
+    :param limit: the maximum number of objects to return (optional, default: no limit)
+    :type limit: integer
+    :param offset: the number of objects to skip (optional, default: ``0``)
+    :type offset: integer
+
+    :returns: [{'model_name': ..., 'object_id': ...}], ordered by model_name and object_id
+    :rtype: list of dictionaries
+    """
+    log.debug("Searching JSON Patches: %r", data_dict)
+
+    session = context['session']
+
+    path = data_dict.get('path')
+    op = data_dict.get('op')
+    data = data_dict.get('data')
+    model_name = data_dict.get('model_name')
+    scope = data_dict.get('scope')
+    limit = _get_natural_number(data_dict, 'limit')
+    offset = _get_natural_number(data_dict, 'offset')
+    timed = stats.timers('jsonpatch_search', model_name, scope)
+
+    if not (path or op or data):
+        raise tk.ValidationError({'path': [_('Missing value')]})
+    if data is not None and not isinstance(data, dict):
+        raise tk.ValidationError({'data': [_('Expecting a JSON object')]})
+    if (op or data) and not storage.uses_jsonb():
+        error = [_('Searching by operation type or data requires JSONB storage')]
+        raise tk.ValidationError({'op' if op else 'data': error})
+
+    with timed('auth'):
+        tk.check_access('jsonpatch_search', context, data_dict)
+
+    q = session.query(JSONPatch.model_name, JSONPatch.object_id) \
+        .filter(JSONPatch.state == 'active') \
+        .distinct() \
+        .order_by(JSONPatch.model_name, JSONPatch.object_id)
+
+    if path:
+        try:
+            parts = jsonpointer.JsonPointer(path).parts
+        except jsonpointer.JsonPointerException, e:
+            raise tk.ValidationError({'path': [str(e)]})
+
+        # patches at or under the location; these lookups use the path prefix indexes
+        subtree = path.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '/%'
+        conditions = [
+            JSONPatch.path == path,
+            JSONPatch.path.like(subtree, escape='\\'),
+            JSONPatch.from_path == path,
+            JSONPatch.from_path.like(subtree, escape='\\'),
+        ]
+        # patches that overwrite a containing location
+        ancestors = [jsonpointer.JsonPointer.from_parts(parts[:i]).path for i in xrange(len(parts))]
+        if ancestors:
+            conditions += [JSONPatch.path.in_(ancestors)]
+        q = q.filter(or_(*conditions))
+
+    # these lookups use the GIN indexes on the JSONB columns
+    if op:
+        q = q.filter(storage.contains(jsonpatch_table.c.operation, {'op': op}))
+    if data:
+        q = q.filter(storage.contains(jsonpatch_table.c.data, data))
+
+    if model_name:
+        q = q.filter(JSONPatch.model_name == model_name)
+    if scope:
+        q = q.filter(JSONPatch.scope == scope)
+    if offset:
+        q = q.offset(offset)
+    if limit is not None:
+        q = q.limit(limit)
+
+    with timed('query'):
+        return [{'model_name': model_name_, 'object_id': object_id} for (model_name_, object_id) in q.all()]
+
+
+@tk.side_effect_free
+@stats.timed_action
 def jsonpatch_apply(context, data_dict):
     """
     Return an object dictionary, modified by its list of JSON patches.
@@ -264,32 +790,747 @@ def jsonpatch_apply(context, data_dict):
     :type scope: string
     :param kwargs: additional arguments to be passed in the data_dict to the 'xyz_show' action (optional)
     :param kwargs: dictionary
-
-    :returns: the patched object dict
+    :param with_version: return the patched object together with its version token (optional,
+        default: ``False``)
+    :type with_version: boolean
+    :param if_none_match: a version token previously returned for the object; if the object's
+        current version token matches, the patched object is not returned (optional; implies
+        ``with_version``)
+    :type if_none_match: string
+    :param fields: return only these top-level fields of the patched object; only the patch
+        operations that affect them are applied (optional, default: return the whole object)
+    :type fields: list of strings
+
+    :returns: the patched object dict; or, if with_version or if_none_match is given,
+        {'version': version token, 'not_modified': boolean, 'object': the patched object dict,
+        unless not_modified}
     :rtype: dictionary
     """
     log.debug("Retrieving JSON-patched object: %r", data_dict)
 
-    model = context['model']
-    session = context['session']
-
     model_name, object_id = tk.get_or_bust(data_dict, ['model_name', 'object_id'])
     scope = data_dict.get('scope')
+    kwargs = data_dict.get('kwargs') or {}
+    if_none_match = data_dict.get('if_none_match')
+    with_version = asbool(data_dict.get('with_version')) or bool(if_none_match)
+    fields = _get_fields(data_dict)
+    timed = stats.timers('jsonpatch_apply', model_name, scope)
 
-    tk.check_access('jsonpatch_apply', context, data_dict)
+    with timed('auth'):
+        tk.check_access('jsonpatch_apply', context, data_dict)
 
-    q = session.query(JSONPatch.operation) \
-        .filter_by(model_name=model_name, object_id=object_id, state='active') \
-        .order_by(JSONPatch.ordinal, JSONPatch.timestamp)
-    if scope:
-        q = q.filter_by(scope=scope)
+    if not with_version:
+        return _apply(context, model_name, object_id, scope, kwargs, fields, timed)
+
+    with timed('version'):
+        version_token = _get_version_token(context, model_name, object_id, scope, kwargs, fields)
+    if version_token is not None and version_token == if_none_match:
+        return {'version': version_token, 'not_modified': True}
 
-    oplist = [operation for (operation,) in q.all()]
-    patch = jsonpatch.JsonPatch(oplist)
+    patched_dict = _apply(context, model_name, object_id, scope, kwargs, fields, timed)
+    if version_token is None:
+        # the object's modification time is not known, so the version token is derived from the result
+        version_token = hashlib.sha1(json.dumps(patched_dict, sort_keys=True)).hexdigest()
+        if version_token == if_none_match:
+            return {'version': version_token, 'not_modified': True}
 
-    show_params = data_dict.get('kwargs') or {}
+    return {'version': version_token, 'not_modified': False, 'object': patched_dict}
+
+
+def _apply(context, model_name, object_id, scope, kwargs, fields, timed):
+    """
+    Return an object dictionary, modified by its list of JSON patches with the given scope,
+    from the result cache, from the stored materialized dictionaries, or by patching the output
+    of the 'xyz_show' action.
+
+    If fields are given, the cache and materialized dictionaries are not used; only the patch
+    operations affecting the given fields are applied, and only those fields are returned.
+    """
+    show_params = dict(kwargs)
     show_params['id'] = object_id
-    object_dict = tk.get_action('{}_show'.format(model_name))(context, show_params)
-    patched_dict = patch.apply(object_dict)
+
+    if fields:
+        with timed('query'):
+            version = _get_patch_version(context, model_name, object_id, scope)
+        with timed('compile'):
+            patch = _get_patch(context, model_name, object_id, scope, version, fields)
+        with timed('show'):
+            object_dict = tk.get_action('{}_show'.format(model_name))(context, show_params)
+        with timed('patch'):
+            patched_dict = patch.apply(object_dict, in_place=True)
+        return dict((field, patched_dict[field]) for field in fields if field in patched_dict)
+
+    with timed('query'):
+        version = _get_patch_version(context, model_name, object_id, scope)
+
+    # results shared between users (cached or materialized) may only be returned once the
+    # user's access to the object has been checked, and only while the object's operation list
+    # and modification time are those from which they were derived; results are therefore only
+    # cached for models whose modification time can be looked up
+    cache = apply_cache.get_cache() if materialize.has_source_modified(model_name) else None
+    materialized = version is not None and not kwargs and materialize.is_enabled(model_name)
+    source_modified = None
+    if cache is not None or materialized:
+        with timed('auth'):
+            shared = _check_show_access(context, model_name, show_params)
+        if shared:
+            with timed('query'):
+                source_modified = materialize.get_source_modified(context, model_name, object_id)
+
+    if cache is not None and source_modified is not None:
+        with timed('cache'):
+            patched_dict = cache.get(model_name, object_id, scope, kwargs, version, source_modified)
+        if patched_dict is not None:
+            return patched_dict
+
+    if materialized and source_modified is not None:
+        with timed('materialized'):
+            patched_dict = materialize.get(model_name, object_id, scope, version, source_modified)
+        if patched_dict is not None:
+            if cache is not None:
+                with timed('cache'):
+                    cache.set(model_name, object_id, scope, kwargs, version, source_modified, patched_dict)
+            return patched_dict
+
+    with timed('compile'):
+        patch = _get_patch(context, model_name, object_id, scope, version)
+
+    with timed('show'):
+        object_dict = tk.get_action('{}_show'.format(model_name))(context, show_params)
+    with timed('patch'):
+        # the show result is built afresh for this request, so it can safely be patched in place
+        patched_dict = patch.apply(object_dict, in_place=True)
+
+    if materialized and source_modified is not None:
+        with timed('materialized'):
+            materialize.store(model_name, object_id, scope, version, source_modified, patched_dict)
+    if cache is not None and source_modified is not None:
+        with timed('cache'):
+            cache.set(model_name, object_id, scope, kwargs, version, source_modified, patched_dict)
 
     return patched_dict
+
+
+@tk.side_effect_free
+@stats.timed_action
+def jsonpatch_apply_many(context, data_dict):
+    """
+    Return a set of object dictionaries, each modified by its list of JSON patches.
+
+    The operation lists for all the requested objects are loaded with a single query. A failure to
+    fetch or patch one object does not abort the batch; it is reported in the 'errors' dictionary.
+
+    :param model_name: the 'xyz' part of the 'xyz_show' action to which the patches will be applied
+    :type model_name: string
+    :param object_ids: the ids of the 'xyz' objects
+    :type object_ids: list of strings
+    :param scope: apply only patches with the specified scope (optional, default: apply all)
+    :type scope: string
+    :param kwargs: additional arguments to be passed in the data_dict to the 'xyz_show' action (optional)
+    :param kwargs: dictionary
+
+    :returns: {'results': {object_id: patched object dict}, 'errors': {object_id: error message}}
+    :rtype: dictionary
+    """
+    log.debug("Retrieving JSON-patched objects: %r", data_dict)
+
+    session = context['session']
+
+    model_name, object_ids = tk.get_or_bust(data_dict, ['model_name', 'object_ids'])
+    scope = data_dict.get('scope')
+    if isinstance(object_ids, basestring):
+        object_ids = [object_ids]
+    object_ids = list(set(object_ids))
+
+    timed = stats.timers('jsonpatch_apply_many', model_name, scope)
+    with timed('auth'):
+        tk.check_access('jsonpatch_apply_many', context, data_dict)
+
+    oplists = dict((object_id, []) for object_id in object_ids)
+    if object_ids:
+        q = session.query(JSONPatchOplist.object_id, JSONPatchOplist.operations) \
+            .filter(JSONPatchOplist.model_name == model_name) \
+            .filter(JSONPatchOplist.object_id.in_(object_ids)) \
+            .filter(JSONPatchOplist.scope == (scope or ALL_SCOPES))
+        with timed('query'):
+            for object_id, operations in q.all():
+                oplists[object_id] = operations
+
+    show_func = tk.get_action('{}_show'.format(model_name))
+    kwargs = data_dict.get('kwargs') or {}
+    results = {}
+    errors = {}
+    for object_id, oplist in oplists.iteritems():
+        show_params = dict(kwargs)
+        show_params['id'] = object_id
+        try:
+            # an invalid stored operation list is reported as an error for its object only
+            with timed('compile'):
+                patch = CompiledPatch(oplist)
+            with timed('show'):
+                object_dict = show_func(context.copy(), show_params)
+            with timed('patch'):
+                results[object_id] = patch.apply(object_dict, in_place=True)
+        except Exception, e:
+            log.warning("Unable to apply JSON Patches to %s %s: %s", model_name, object_id, e)
+            errors[object_id] = _get_error_message(e)
+
+    return {
+        'results': results,
+        'errors': errors,
+    }
+
+
+@tk.side_effect_free
+@stats.timed_action
+def jsonpatch_apply_scopes(context, data_dict):
+    """
+    Return an object dictionary modified by its JSON patches, for each of several scopes.
+
+    The object is fetched once, and the operation lists for all the requested scopes are loaded
+    with a single query. Each scope's patches are applied to a copy of the object that shares
+    all the parts of the object that the patches do not touch.
+
+    :param model_name: the 'xyz' part of the 'xyz_show' action to which the patches will be applied
+    :type model_name: string
+    :param object_id: the id of the 'xyz' object
+    :type object_id: string
+    :param scopes: the scopes of the patches to apply
+    :type scopes: list of strings
+    :param include_unscoped: also return the object with all its patches applied, as for
+        jsonpatch_apply without a scope, under the key ``''`` (optional, default: ``False``)
+    :type include_unscoped: boolean
+    :param kwargs: additional arguments to be passed in the data_dict to the 'xyz_show' action (optional)
+    :param kwargs: dictionary
+
+    :returns: {scope: patched object dict}
+    :rtype: dictionary
+    """
+    log.debug("Retrieving JSON-patched object for multiple scopes: %r", data_dict)
+
+    session = context['session']
+
+    model_name, object_id, scopes = tk.get_or_bust(data_dict, ['model_name', 'object_id', 'scopes'])
+    if isinstance(scopes, basestring):
+        scopes = [scopes]
+    scopes = [scope for scope in set(scopes) if scope]
+    if asbool(data_dict.get('include_unscoped')):
+        scopes += [ALL_SCOPES]
+    kwargs = data_dict.get('kwargs') or {}
+    timed = stats.timers('jsonpatch_apply_scopes', model_name)
+
+    with timed('auth'):
+        tk.check_access('jsonpatch_apply_scopes', context, data_dict)
+
+    show_params = dict(kwargs)
+    show_params['id'] = object_id
+
+    with timed('query'):
+        versions = dict(session.query(JSONPatchOplist.scope, JSONPatchOplist.version)
+                        .filter_by(model_name=model_name, object_id=object_id)
+                        .filter(JSONPatchOplist.scope.in_(scopes)))
+
+    # as in jsonpatch_apply, cached results are checked against the operation list versions and
+    # the object's modification time
+    results = {}
+    cache = apply_cache.get_cache() if materialize.has_source_modified(model_name) else None
+    source_modified = None
+    if cache is not None:
+        with timed('auth'):
+            shared = _check_show_access(context, model_name, show_params)
+        if shared:
+            with timed('query'):
+                source_modified = materialize.get_source_modified(context, model_name, object_id)
+        if source_modified is not None:
+            with timed('cache'):
+                for scope in scopes:
+                    patched_dict = cache.get(model_name, object_id, scope or None, kwargs,
+                                             versions.get(scope), source_modified)
+                    if patched_dict is not None:
+                        results[scope] = patched_dict
+    scopes = [scope for scope in scopes if scope not in results]
+    if not scopes:
+        return results
+
+    patches = {}
+    patched_scopes = [scope for scope in scopes if scope in versions]
+    if patched_scopes:
+        with timed('query'):
+            oplists = session.query(JSONPatchOplist.scope, JSONPatchOplist.operations) \
+                .filter_by(model_name=model_name, object_id=object_id) \
+                .filter(JSONPatchOplist.scope.in_(patched_scopes)) \
+                .all()
+        with timed('compile'):
+            for scope, operations in oplists:
+                patches[scope] = get_compiled_patch((model_name, object_id, scope), versions[scope],
+                                                    lambda operations=operations: operations)
+
+    with timed('show'):
+        object_dict = tk.get_action('{}_show'.format(model_name))(context, show_params)
+    with timed('patch'):
+        for scope in scopes:
+            patch = patches.get(scope)
+            results[scope] = patch.apply(object_dict) if patch is not None else object_dict
+
+    if cache is not None and source_modified is not None:
+        with timed('cache'):
+            for scope in scopes:
+                cache.set(model_name, object_id, scope or None, kwargs, versions.get(scope), source_modified,
+                          results[scope])
+
+    return results
+
+
+@stats.timed_action
+def jsonpatch_compact(context, data_dict):
+    """
+    Reduce an object's list of JSON Patches to a minimal equivalent list, by deleting patches whose
+    operations are made redundant by later patches, and merging an 'add' with a subsequent 'replace'
+    of the same location. Patches with different scopes are only combined where this does not
+    change the result of applying patches for any scope.
+
+    :param model_name: the 'xyz' part of the 'xyz_show' action to which the patches are applied
+    :type model_name: string
+    :param object_id: the id of the 'xyz' object
+    :type object_id: string
+    :param dry_run: only report the result of compaction, without modifying any patches
+        (optional, default: ``True``)
+    :type dry_run: boolean
+
+    :returns: the compacted list of operations, the numbers of operations before and after
+        compaction, and the ids of the patches that were (or would be) deleted and modified
+    :rtype: dictionary
+    """
+    log.info("Compacting JSON Patches: %r", data_dict)
+
+    model = context['model']
+    user = context['user']
+    session = context['session']
+    defer_commit = context.get('defer_commit', False)
+
+    model_name, object_id = tk.get_or_bust(data_dict, ['model_name', 'object_id'])
+    dry_run = asbool(data_dict.get('dry_run', True))
+
+    timed = stats.timers('jsonpatch_compact', model_name)
+    with timed('auth'):
+        tk.check_access('jsonpatch_compact', context, data_dict)
+
+    with timed('query'):
+        patches = session.query(JSONPatch.id, JSONPatch.scope, JSONPatch.operation) \
+            .filter_by(model_name=model_name, object_id=object_id, state='active') \
+            .order_by(JSONPatch.ordinal, JSONPatch.timestamp, JSONPatch.id) \
+            .all()
+
+    with timed('compact'):
+        kept, removed_ids, modified_ids = compact(patches)
+
+    if not dry_run and (removed_ids or modified_ids):
+        scopes = dict((jsonpatch_id, scope) for (jsonpatch_id, scope, operation) in patches)
+        if any(revisions.is_revisioned(scopes[jsonpatch_id]) for jsonpatch_id in removed_ids + modified_ids):
+            rev = model.repo.new_revision()
+            rev.author = user
+            rev.message = _(u'REST API: Compact JSON Patches for %s %s') % (model_name, object_id)
+
+        for jsonpatch_id in removed_ids:
+            if revisions.is_revisioned(scopes[jsonpatch_id]):
+                JSONPatch.get(jsonpatch_id).delete()
+            else:
+                revisions.delete_unrevisioned(JSONPatch.get(jsonpatch_id), context)
+        operations = dict((jsonpatch_id, operation) for (jsonpatch_id, scope, operation) in kept)
+        for jsonpatch_id in modified_ids:
+            if revisions.is_revisioned(scopes[jsonpatch_id]):
+                JSONPatch.get(jsonpatch_id).operation = operations[jsonpatch_id]
+            else:
+                revisions.save_unrevisioned({'operation': operations[jsonpatch_id]},
+                                            dict(context, jsonpatch=JSONPatch.get(jsonpatch_id)))
+
+        _update_derived_tables(model_name, object_id)
+        if not defer_commit:
+            model.repo.commit()
+
+        _on_patches_changed(model_name, object_id)
+
+    return {
+        'model_name': model_name,
+        'object_id': object_id,
+        'operations_before': len(patches),
+        'operations_after': len(kept),
+        'removed_ids': removed_ids,
+        'modified_ids': modified_ids,
+        'operations': [operation for (jsonpatch_id, scope, operation) in kept],
+    }
+
+
+@tk.side_effect_free
+@stats.timed_action
+def jsonpatch_cache_stats(context, data_dict):
+    """
+    Return the hit, miss, stale and invalidation counters of this process's jsonpatch_apply result
+    cache.
+
+    :returns: the cache statistics, or None if the cache is not enabled
+    :rtype: dictionary
+    """
+    tk.check_access('jsonpatch_cache_stats', context, data_dict)
+
+    cache = apply_cache.get_cache()
+    return cache.stats() if cache is not None else None
+
+
+@tk.side_effect_free
+@stats.timed_action
+def jsonpatch_stats(context, data_dict):
+    """
+    Return this process's timing statistics for the jsonpatch actions, per action, phase,
+    model_name and scope: call counts, total, mean and maximum durations, and latency histograms.
+
+    :returns: the statistics, or None if timing is not enabled
+    :rtype: list of dictionaries
+    """
+    tk.check_access('jsonpatch_stats', context, data_dict)
+
+    return stats.snapshot() if stats.is_enabled() else None
+
+
+@stats.timed_action
+def jsonpatch_health_check(context, data_dict):
+    """
+    Start a background job that checks that the patches of all patched objects can be applied,
+    recording the outcome for each object and scope; see ``paster jsonpatch check``.
+
+    :param model_name: check only objects of this model (optional)
+    :type model_name: string
+    :param recheck: check every object, including those that have not changed since their last
+        check (optional, default: ``False``)
+    :type recheck: boolean
+    :param deactivate: delete patches whose operations cannot be applied in the operation list for
+        their own scope (optional, default: ``False``)
+    :type deactivate: boolean
+
+    :returns: {'job_id': the id of the background job}
+    :rtype: dictionary
+    """
+    tk.check_access('jsonpatch_health_check', context, data_dict)
+
+    job = tk.enqueue_job(health.run, kwargs={
+        'model_name': data_dict.get('model_name'),
+        'recheck': asbool(data_dict.get('recheck')),
+        'deactivate': asbool(data_dict.get('deactivate')),
+    }, title=u'JSON Patch health check')
+    return {'job_id': job.id}
+
+
+@tk.side_effect_free
+@stats.timed_action
+def jsonpatch_health_list(context, data_dict):
+    """
+    Return the outcomes of the most recent health checks of patched objects, ordered by model_name,
+    object_id and scope. For failed checks, 'patch_id' and 'op_index' identify the first operation
+    that could not be applied.
+
+    :param model_name: return only outcomes for objects of this model (optional)
+    :type model_name: string
+    :param status: return only outcomes with this status: 'ok', 'failed', 'deactivated' or 'error'
+        (optional, default: all but 'ok')
+    :type status: string
+    :param limit: the maximum number of outcomes to return (optional, default: no limit)
+    :type limit: integer
+    :param offset: the number of outcomes to skip (optional, default: ``0``)
+    :type offset: integer
+
+    :rtype: list of dictionaries
+    """
+    tk.check_access('jsonpatch_health_list', context, data_dict)
+
+    model_name = data_dict.get('model_name')
+    status = data_dict.get('status')
+    limit = _get_natural_number(data_dict, 'limit')
+    offset = _get_natural_number(data_dict, 'offset')
+
+    q = context['session'].query(JSONPatchHealth) \
+        .order_by(JSONPatchHealth.model_name, JSONPatchHealth.object_id, JSONPatchHealth.scope)
+    if model_name:
+        q = q.filter(JSONPatchHealth.model_name == model_name)
+    if status:
+        q = q.filter(JSONPatchHealth.status == status)
+    else:
+        q = q.filter(JSONPatchHealth.status != health.STATUS_OK)
+    if offset:
+        q = q.offset(offset)
+    if limit is not None:
+        q = q.limit(limit)
+
+    return [{
+        'model_name': outcome.model_name,
+        'object_id': outcome.object_id,
+        'scope': outcome.scope or None,
+        'status': outcome.status,
+        'patch_id': outcome.patch_id,
+        'op_index': outcome.op_index,
+        'message': outcome.message,
+        'checked': outcome.checked.isoformat(),
+    } for outcome in q]
+
+
+def _get_patch_version(context, model_name, object_id, scope):
+    """
+    Return the version of an object's denormalized operation list, or None if it has no patches.
+    """
+    return context['session'].query(JSONPatchOplist.version).filter_by(
+        model_name=model_name, object_id=object_id, scope=scope or ALL_SCOPES).scalar()
+
+
+def _get_version_token(context, model_name, object_id, scope, kwargs, fields):
+    """
+    Return a token that changes whenever the patched object returned by jsonpatch_apply may change:
+    a hash of the version of the object's operation list, the object's modification time, and the
+    parameters of the request. This is computed without calling 'xyz_show'.
+
+    :returns: the version token, or None if the object's modification time cannot be determined,
+        or access to the object cannot be checked without calling 'xyz_show'
+    """
+    if not materialize.has_source_modified(model_name):
+        return None
+    if not _check_show_access(context, model_name, dict(kwargs, id=object_id)):
+        return None
+    source_modified = materialize.get_source_modified(context, model_name, object_id)
+    if source_modified is None:
+        return None
+    patch_version = _get_patch_version(context, model_name, object_id, scope)
+    return hashlib.sha1(json.dumps([patch_version, source_modified, scope or ALL_SCOPES, kwargs, fields],
+                                   sort_keys=True)).hexdigest()
+
+
+def _get_patch(context, model_name, object_id, scope, version, fields=None):
+    """
+    Return the compiled patch for an object, reusing the cached compilation for as long as the
+    version of the object's denormalized operation list is unchanged.
+
+    :param fields: if given, the patch includes only the operations affecting these top-level fields
+    """
+    if version is None:
+        return CompiledPatch([])
+
+    def load_oplist():
+        oplist = context['session'].query(JSONPatchOplist.operations).filter_by(
+            model_name=model_name, object_id=object_id, scope=scope or ALL_SCOPES).scalar() or []
+        return project_oplist(oplist, fields) if fields else oplist
+
+    key = (model_name, object_id, scope or ALL_SCOPES)
+    if fields:
+        key += (fields,)
+    return get_compiled_patch(key, version, load_oplist)
+
+
+def _get_validate(data_dict):
+    """
+    Return whether the patches written by a create or update action are to be checked.
+    """
+    validate = data_dict.get('validate')
+    if validate is None or validate == '':
+        return checkpoints.is_enabled()
+    return asbool(validate)
+
+
+def _check_operation(context, jsonpatch):
+    """
+    Check that a saved (but not yet committed) patch's operation can be applied to the patched
+    object at the patch's position; if not, roll back and raise a ValidationError.
+    """
+    errors = _get_operation_errors(context, jsonpatch)
+    if errors:
+        context['session'].rollback()
+        raise tk.ValidationError(errors)
+
+
+def _get_operation_errors(context, jsonpatch):
+    """
+    Check that a saved (but not yet committed) patch's operation can be applied to the patched
+    object at the patch's position.
+
+    :returns: a dictionary of errors, empty if the operation can be applied
+    """
+    try:
+        checkpoints.check(context, jsonpatch.model_name, jsonpatch.object_id, jsonpatch.scope, jsonpatch.id)
+    except (JsonPatchException, jsonpointer.JsonPointerException), e:
+        return {'operation': [_('Cannot be applied to the patched object: %s') % e]}
+    return {}
+
+
+def _check_show_access(context, model_name, show_params):
+    """
+    Check that the user may call the 'xyz_show' action, without calling it. This is required
+    before returning a cached result, since the cache is shared between users.
+
+    :returns: False if there is no 'xyz_show' auth function, in which case the result may not be cached
+    """
+    try:
+        tk.check_access('{}_show'.format(model_name), context, dict(show_params))
+    except ValueError:
+        return False
+    return True
+
+
+def _update_derived_tables(model_name, object_id):
+    """
+    Bring the tables derived from an object's patches up to date, within the current transaction:
+    rebuild its operation lists, and discard its materialized patched dictionaries.
+    """
+    JSONPatchOplist.rebuild(model_name, object_id)
+    materialize.expire(model_name, object_id)
+
+
+def _on_patches_changed(model_name, object_id):
+    """
+    Discard derived state (cached patch results) for an object whose patches have changed, and
+    reindex the affected package if patches are applied at search-index time.
+    """
+    apply_cache.invalidate(model_name, object_id)
+    if search.is_enabled():
+        search.reindex(model_name, object_id)
+
+
+def _save_jsonpatches(context, items, get_message):
+    """
+    Save validated patch dictionaries. Patches are saved under a single revision, except for those
+    with scopes that are configured to be written without revisions.
+
+    :param items: list of (jsonpatch, data) tuples, where jsonpatch is the patch to be updated,
+        or None for a new patch
+    :param get_message: function returning the revision message for the list of saved patches,
+        used if there is no 'message' in the context
+
+    :returns: the list of saved JSONPatch objects
+    """
+    model = context['model']
+
+    def is_revisioned(jsonpatch, data):
+        scope = data.get('scope') if 'scope' in data or jsonpatch is None else jsonpatch.scope
+        return revisions.is_revisioned(scope)
+
+    # the revision must be set before any revisioned patch is flushed
+    rev = None
+    if any(is_revisioned(jsonpatch, data) for jsonpatch, data in items):
+        rev = model.repo.new_revision()
+        rev.author = context['user']
+
+    jsonpatches = []
+    for jsonpatch, data in items:
+        if jsonpatch is not None:
+            context['jsonpatch'] = jsonpatch
+        else:
+            context.pop('jsonpatch', None)
+        if is_revisioned(jsonpatch, data):
+            jsonpatches += [jsonpatch_dict_save(data, context)]
+        else:
+            jsonpatches += [revisions.save_unrevisioned(data, context)]
+    context.pop('jsonpatch', None)
+
+    if rev is not None:
+        rev.message = context['message'] if 'message' in context else get_message(jsonpatches)
+    return jsonpatches
+
+
+def _get_patch_list(data_dict):
+    """
+    Return the list of patch dictionaries passed to a bulk action.
+    """
+    patches = tk.get_or_bust(data_dict, 'patches')
+    if not isinstance(patches, list) or not all(isinstance(patch_dict, dict) for patch_dict in patches):
+        raise tk.ValidationError({'patches': [_('Must be a list of dictionaries')]})
+    return patches
+
+
+def _save_many(context, jsonpatches, all_fields, validate, timed):
+    """
+    Complete a bulk create or update: rebuild the affected objects' operation lists, check the
+    patches' operations if validate is set, and commit.
+
+    :param timed: the action's phase timers (see stats.timers)
+    :returns: the ids of the saved patches, or their dictionaries if all_fields is set
+    """
+    model = context['model']
+    session = context['session']
+
+    # objects are locked in a consistent order, so that concurrent bulk writes do not deadlock
+    objects = sorted(set((jsonpatch.model_name, jsonpatch.object_id) for jsonpatch in jsonpatches))
+    with timed('derived'):
+        for model_name, object_id in objects:
+            _update_derived_tables(model_name, object_id)
+
+    if validate:
+        with timed('check'):
+            errors = [_get_operation_errors(context, jsonpatch) for jsonpatch in jsonpatches]
+        if any(errors):
+            session.rollback()
+            raise tk.ValidationError({'patches': errors})
+
+    if not context.get('defer_commit', False):
+        with timed('commit'):
+            model.repo.commit()
+
+    for model_name, object_id in objects:
+        _on_patches_changed(model_name, object_id)
+
+    jsonpatch_ids = [jsonpatch.id for jsonpatch in jsonpatches]
+    if not all_fields:
+        return jsonpatch_ids
+
+    jsonpatches = dict((jsonpatch.id, jsonpatch) for jsonpatch in
+                       session.query(JSONPatch).filter(JSONPatch.id.in_(jsonpatch_ids)))
+    output_schema = context.get('schema') or schema.jsonpatch_show_schema()
+    result = []
+    for jsonpatch_dict in jsonpatch_list_dictize([jsonpatches[id_] for id_ in jsonpatch_ids], context):
+        result_dict, errors = tk.navl_validate(jsonpatch_dict, output_schema, context)
+        result += [result_dict]
+    return result
+
+
+def _get_natural_number(data_dict, key):
+    """
+    Return the (optional) non-negative integer value of a data_dict key, or None if not supplied.
+    """
+    value = data_dict.get(key)
+    if value is None or value == '':
+        return None
+    try:
+        value = int(value)
+        if value < 0:
+            raise ValueError
+    except (TypeError, ValueError):
+        raise tk.ValidationError({key: [_('Must be a natural number')]})
+    return value
+
+
+def _get_fields(data_dict):
+    """
+    Return the (optional) top-level field names requested in a data_dict, as a sorted tuple,
+    or None if not supplied. Names may be given as JSON Pointers, e.g. '/title'.
+    """
+    fields = data_dict.get('fields')
+    if not fields:
+        return None
+    if isinstance(fields, basestring):
+        fields = fields.split(',')
+    if not isinstance(fields, list) or not all(isinstance(field, basestring) for field in fields):
+        raise tk.ValidationError({'fields': [_('Must be a list of field names')]})
+
+    names = set()
+    for field in fields:
+        name = field.strip()
+        if name.startswith('/'):
+            name = name[1:]
+        if not name or '/' in name:
+            raise tk.ValidationError({'fields': [_('Invalid field name: %s') % field]})
+        names.add(name.replace('~1', '/').replace('~0', '~'))
+    return tuple(sorted(names))
+
+
+def _get_error_message(e):
+    """
+    Return a readable message for an exception raised while processing a single object in a batch.
+    """
+    if isinstance(e, tk.ValidationError):
+        return e.error_dict
+    return getattr(e, 'message', None) or unicode(e) or e.__class__.__name__
+
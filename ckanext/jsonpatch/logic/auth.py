@@ -15,6 +15,18 @@ def jsonpatch_delete(context, data_dict):
     return {'success': True}
 
 
+def jsonpatch_create_many(context, data_dict):
+    return {'success': True}
+
+
+def jsonpatch_update_many(context, data_dict):
+    return {'success': True}
+
+
+def jsonpatch_create_from_diff(context, data_dict):
+    return {'success': True}
+
+
 def jsonpatch_show(context, data_dict):
     return {'success': True}
 
@@ -23,5 +35,45 @@ def jsonpatch_list(context, data_dict):
     return {'success': True}
 
 
+def jsonpatch_changes(context, data_dict):
+    return {'success': True}
+
+
+def jsonpatch_search(context, data_dict):
+    return {'success': True}
+
+
 def jsonpatch_apply(context, data_dict):
     return {'success': True}
+
+
+def jsonpatch_apply_many(context, data_dict):
+    return {'success': True}
+
+
+def jsonpatch_apply_scopes(context, data_dict):
+    return {'success': True}
+
+
+def jsonpatch_compact(context, data_dict):
+    return {'success': True}
+
+
+def jsonpatch_cache_stats(context, data_dict):
+    # sysadmins only
+    return {'success': False}
+
+
+def jsonpatch_stats(context, data_dict):
+    # sysadmins only
+    return {'success': False}
+
+
+def jsonpatch_health_check(context, data_dict):
+    # sysadmins only
+    return {'success': False}
+
+
+def jsonpatch_health_list(context, data_dict):
+    # sysadmins only
+    return {'success': False}
@@ -22,6 +22,7 @@ def jsonpatch_create_schema():
         'ordinal': [ignore_missing, int_validator],
         'timestamp': [ignore],
         'data': [ignore_empty, ignore_missing],
+        'validate': [ignore],
         '__after': [v.model_reference_validator, ignore],
     }
     return schema
@@ -37,6 +38,7 @@ def jsonpatch_update_schema():
         'ordinal': [ignore_missing, int_validator],
         'timestamp': [ignore],
         'data': [ignore_empty, ignore_missing],
+        'validate': [ignore],
     }
     return schema
 
@@ -45,4 +47,5 @@ def jsonpatch_show_schema():
     schema = dict.fromkeys(jsonpatch_create_schema(), [])
     schema['revision_id'] = []
     del schema['__after']
+    del schema['validate']
     return schema
@@ -5,6 +5,7 @@ import json
 
 import ckan.plugins.toolkit as tk
 from ckan.common import _
+from ckanext.jsonpatch.lib.resolvers import resolve
 
 
 def jsonpatch_operation_validator(operation_dict):
@@ -47,18 +48,20 @@ def model_reference_validator(key, data, errors, context):
     """
     Checks that a 'model_name_show' action exists and that an object is gettable with the supplied id/name.
     Also converts object name to id if applicable.
+
+    Objects are looked up using the lightweight resolver registered for the model, if any; see
+    :py:mod:`ckanext.jsonpatch.lib.resolvers`.
     """
     model_name = data.get(key[:-1] + ('model_name',))
     object_id = data.get(key[:-1] + ('object_id',))
     show_func_name = '{}_show'.format(model_name)
     try:
-        show_func = tk.get_action(show_func_name)
+        tk.get_action(show_func_name)
     except:
         raise tk.Invalid(_("Invalid model name: action function '{}' does not exist".format(show_func_name)))
 
     try:
-        object_dict = show_func(context, {'id': object_id})
-        data[key[:-1] + ('object_id',)] = object_dict['id']
+        data[key[:-1] + ('object_id',)] = resolve(context, model_name, object_id)
     except Exception, e:
         raise tk.Invalid(_("Unable to get object with id '{}' using action function '{}': {}".
                            format(object_id, show_func_name, e.message)))
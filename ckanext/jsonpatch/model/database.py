@@ -0,0 +1,71 @@
+# encoding: utf-8
+
+"""
+Database statements shared by the plugin's tables, and by the upgrade and migration of their
+schema on a live site.
+
+Schema changes are made with statements supported by PostgreSQL 9.3, the oldest version supported
+by CKAN 2.8: rather than ``ADD COLUMN IF NOT EXISTS`` (9.6) or ``CREATE INDEX IF NOT EXISTS``
+(9.5), the catalog is checked first.
+"""
+
+from sqlalchemy import and_, text
+
+from ckan.model import meta
+
+
+def replace_row(table, key, values):
+    """
+    Replace the row of a table that has the given key by a row with the key and the given values.
+    This is done in its own transaction, independently of the session, so that derived state may
+    be recorded while reading, or without committing the session's changes.
+
+    :param key: dictionary of the values of the key columns
+    :param values: dictionary of the values of the other columns
+    :raises sqlalchemy.exc.IntegrityError: if the row is inserted concurrently
+    """
+    with meta.engine.begin() as conn:
+        conn.execute(table.delete().where(and_(*[table.c[name] == value for name, value in key.iteritems()])))
+        conn.execute(table.insert().values(**dict(key, **values)))
+
+
+def execute_autocommit(*statements):
+    """
+    Execute statements that cannot run inside a transaction block, such as CREATE INDEX
+    CONCURRENTLY, in order, each being committed on its own.
+    """
+    with meta.engine.connect() as conn:
+        conn = conn.execution_options(isolation_level='AUTOCOMMIT')
+        for statement in statements:
+            conn.execute(statement)
+
+
+def column_exists(conn, table_name, column_name):
+    """
+    Return True if the table, in the current schema, has the column.
+    """
+    return conn.execute(text(
+        u'SELECT 1 FROM information_schema.columns '
+        u'WHERE table_schema = current_schema() AND table_name = :table_name AND column_name = :column_name'),
+        table_name=table_name, column_name=column_name).first() is not None
+
+
+def create_index_concurrently(name, ddl):
+    """
+    Build an index with a CREATE INDEX CONCURRENTLY statement, unless a valid index with the name
+    already exists in the current schema. An invalid index, left behind by an interrupted build,
+    is dropped first. PostgreSQL only.
+
+    :returns: False if the index already existed, True if it was built
+    """
+    row = meta.engine.execute(text(
+        u'SELECT i.indisvalid FROM pg_index i '
+        u'JOIN pg_class c ON c.oid = i.indexrelid JOIN pg_namespace n ON n.oid = c.relnamespace '
+        u'WHERE c.relname = :name AND n.nspname = current_schema()'), name=name).first()
+    if row is not None and row[0]:
+        return False
+    if row is not None:
+        execute_autocommit(u'DROP INDEX CONCURRENTLY {}'.format(name), ddl)
+    else:
+        execute_autocommit(ddl)
+    return True
@@ -0,0 +1,39 @@
+# encoding: utf-8
+
+from sqlalchemy import types, Table, Column, Index
+import datetime
+
+from ckan.model import meta, domain_object
+from ckanext.jsonpatch.model.oplist import ALL_SCOPES
+
+jsonpatch_health_table = Table(
+    'jsonpatch_health', meta.metadata,
+    Column('model_name', types.UnicodeText, primary_key=True),
+    Column('object_id', types.UnicodeText, primary_key=True),
+    Column('scope', types.UnicodeText, primary_key=True),
+    Column('status', types.UnicodeText, nullable=False),
+    Column('patch_id', types.UnicodeText),
+    Column('op_index', types.Integer),
+    Column('message', types.UnicodeText),
+    Column('patch_version', types.UnicodeText, nullable=False),
+    Column('source_modified', types.UnicodeText),
+    Column('checked', types.DateTime, nullable=False, default=datetime.datetime.utcnow),
+    Index('idx_jsonpatch_health_status', 'status'),
+)
+
+
+class JSONPatchHealth(domain_object.DomainObject):
+    """
+    The outcome of the most recent health check of an object's operation list for a scope
+    (ALL_SCOPES for all scopes). For a failed check, patch_id and op_index identify the first
+    operation that could not be applied. The row is current for as long as its patch_version
+    matches that of the object's operation list, and its source_modified matches the modification
+    time of the source object.
+    """
+
+    @classmethod
+    def get(cls, model_name, object_id, scope=None):
+        return meta.Session.query(cls).get((model_name, object_id, scope or ALL_SCOPES))
+
+
+meta.mapper(JSONPatchHealth, jsonpatch_health_table)
@@ -1,10 +1,11 @@
 # encoding: utf-8
 
-from sqlalchemy import types, Table, Column
+from sqlalchemy import types, event, Table, Column, Index
 import vdm.sqlalchemy
 import datetime
 
 from ckan.model import meta, core, types as _types, domain_object
+from ckanext.jsonpatch.model.types import JsonDictType
 
 
 jsonpatch_table = Table(
@@ -12,16 +13,48 @@ jsonpatch_table = Table(
     Column('id', types.UnicodeText, primary_key=True, default=_types.make_uuid),
     Column('model_name', types.UnicodeText, nullable=False),
     Column('object_id', types.UnicodeText, nullable=False),
-    Column('operation', _types.JsonDictType),
+    Column('operation', JsonDictType),
     Column('scope', types.UnicodeText),
     Column('ordinal', types.Integer, nullable=False, default=0),
     Column('timestamp', types.DateTime, nullable=False, default=datetime.datetime.utcnow),
-    Column('data', _types.JsonDictType),
+    Column('data', JsonDictType),
+    # derived from the operation, for looking up patches by the locations they touch
+    Column('path', types.UnicodeText),
+    Column('from_path', types.UnicodeText),
 )
 
 vdm.sqlalchemy.make_table_stateful(jsonpatch_table)
 jsonpatch_revision_table = core.make_revisioned_table(jsonpatch_table)
 
+# covers the patch lookup done by jsonpatch_list and jsonpatch_apply: equality on the leading
+# columns, ordering by (ordinal, timestamp, id), with scope available without a table visit
+Index('idx_jsonpatch_object',
+      jsonpatch_table.c.model_name,
+      jsonpatch_table.c.object_id,
+      jsonpatch_table.c.state,
+      jsonpatch_table.c.ordinal,
+      jsonpatch_table.c.timestamp,
+      jsonpatch_table.c.id,
+      jsonpatch_table.c.scope)
+
+# support prefix searches on the locations touched by patches (see jsonpatch_search)
+Index('idx_jsonpatch_path',
+      jsonpatch_table.c.path,
+      postgresql_ops={'path': 'text_pattern_ops'})
+Index('idx_jsonpatch_from_path',
+      jsonpatch_table.c.from_path,
+      postgresql_ops={'from_path': 'text_pattern_ops'})
+
+# supports the jsonpatch_changes feed: keyset pagination over patch versions in revision order
+Index('idx_jsonpatch_revision_timestamp',
+      jsonpatch_revision_table.c.revision_timestamp,
+      jsonpatch_revision_table.c.id,
+      jsonpatch_revision_table.c.revision_id)
+
+# supports pruning of superseded patch versions
+Index('idx_jsonpatch_revision_expired_timestamp',
+      jsonpatch_revision_table.c.expired_timestamp)
+
 
 class JSONPatch(vdm.sqlalchemy.RevisionedObjectMixin,
                 vdm.sqlalchemy.StatefulObjectMixin,
@@ -44,3 +77,24 @@ meta.mapper(JSONPatch, jsonpatch_table,
 vdm.sqlalchemy.modify_base_object_mapper(JSONPatch, core.Revision, core.State)
 JSONPatchRevision = vdm.sqlalchemy.create_object_version(
     meta.mapper, JSONPatch, jsonpatch_revision_table)
+
+
+def operation_paths(operation):
+    """
+    Return the (path, from_path) of a patch operation; from_path is None unless the operation
+    is a move or copy.
+    """
+    if not isinstance(operation, dict):
+        return None, None
+    path = operation.get('path')
+    from_path = operation.get('from') if operation.get('op') in ('move', 'copy') else None
+    return (path if isinstance(path, basestring) else None,
+            from_path if isinstance(from_path, basestring) else None)
+
+
+def _set_paths(mapper, connection, jsonpatch):
+    jsonpatch.path, jsonpatch.from_path = operation_paths(jsonpatch.operation)
+
+
+event.listen(JSONPatch, 'before_insert', _set_paths)
+event.listen(JSONPatch, 'before_update', _set_paths)
@@ -0,0 +1,34 @@
+# encoding: utf-8
+
+from sqlalchemy import types, Table, Column
+import datetime
+
+from ckan.model import meta, domain_object
+from ckanext.jsonpatch.model.types import JsonDictType
+from ckanext.jsonpatch.model.oplist import ALL_SCOPES
+
+jsonpatch_materialized_table = Table(
+    'jsonpatch_materialized', meta.metadata,
+    Column('model_name', types.UnicodeText, primary_key=True),
+    Column('object_id', types.UnicodeText, primary_key=True),
+    Column('scope', types.UnicodeText, primary_key=True),
+    Column('data', JsonDictType),
+    Column('patch_version', types.UnicodeText, nullable=False),
+    Column('source_modified', types.UnicodeText, nullable=False),
+    Column('modified', types.DateTime, nullable=False, default=datetime.datetime.utcnow),
+)
+
+
+class JSONPatchMaterialized(domain_object.DomainObject):
+    """
+    A stored patched object dictionary, for an object and scope (ALL_SCOPES for all scopes).
+    The row is fresh for as long as its patch_version matches that of the object's operation list,
+    and its source_modified matches the modification time of the source object.
+    """
+
+    @classmethod
+    def get(cls, model_name, object_id, scope=None):
+        return meta.Session.query(cls).get((model_name, object_id, scope or ALL_SCOPES))
+
+
+meta.mapper(JSONPatchMaterialized, jsonpatch_materialized_table)
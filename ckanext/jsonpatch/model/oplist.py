@@ -0,0 +1,95 @@
+# encoding: utf-8
+
+from sqlalchemy import types, Table, Column, text
+import datetime
+import hashlib
+import json
+
+from ckan.model import meta, domain_object
+from ckanext.jsonpatch.model.types import JsonType
+from ckanext.jsonpatch.model.jsonpatch import JSONPatch
+
+# value of the scope column for the list of all of an object's patches, regardless of scope
+ALL_SCOPES = u''
+
+jsonpatch_oplist_table = Table(
+    'jsonpatch_oplist', meta.metadata,
+    Column('model_name', types.UnicodeText, primary_key=True),
+    Column('object_id', types.UnicodeText, primary_key=True),
+    Column('scope', types.UnicodeText, primary_key=True),
+    Column('patch_ids', JsonType),
+    Column('operations', JsonType),
+    Column('version', types.UnicodeText, nullable=False),
+    Column('modified', types.DateTime, nullable=False, default=datetime.datetime.utcnow),
+)
+
+
+class JSONPatchOplist(domain_object.DomainObject):
+    """
+    The ordered list of active patch operations for an object, as applied either for a specific
+    scope or (with scope ALL_SCOPES) for all scopes. This is derived from the jsonpatch table, and
+    is kept up to date by calling rebuild() whenever an object's patches change.
+    """
+
+    @classmethod
+    def get(cls, model_name, object_id, scope=None):
+        return meta.Session.query(cls).get((model_name, object_id, scope or ALL_SCOPES))
+
+    @classmethod
+    def lock(cls, model_name, object_id):
+        """
+        Serialise changes to an object's patches: take a lock on the object that is held until the
+        current transaction ends. On databases other than PostgreSQL this does nothing.
+        """
+        session = meta.Session
+        if session.get_bind().dialect.name == 'postgresql':
+            session.execute(text('SELECT pg_advisory_xact_lock(hashtext(:model_name), hashtext(:object_id))'),
+                            {'model_name': model_name, 'object_id': object_id})
+
+    @classmethod
+    def rebuild(cls, model_name, object_id):
+        """
+        Regenerate an object's operation lists from its active patches, within the current transaction.
+        The object is locked first, so that concurrent rebuilds do not overwrite each other's lists.
+        """
+        session = meta.Session
+        cls.lock(model_name, object_id)
+        session.flush()
+
+        patches = session.query(JSONPatch.id, JSONPatch.scope, JSONPatch.timestamp, JSONPatch.operation) \
+            .filter_by(model_name=model_name, object_id=object_id, state='active') \
+            .order_by(JSONPatch.ordinal, JSONPatch.timestamp, JSONPatch.id) \
+            .all()
+
+        patches_by_scope = {}
+        for patch in patches:
+            patches_by_scope.setdefault(ALL_SCOPES, []).append(patch)
+            if patch.scope:
+                patches_by_scope.setdefault(patch.scope, []).append(patch)
+
+        oplists = dict((oplist.scope, oplist) for oplist in
+                       session.query(cls).filter_by(model_name=model_name, object_id=object_id))
+
+        for scope, scope_patches in patches_by_scope.iteritems():
+            oplist = oplists.pop(scope, None) or cls(model_name=model_name, object_id=object_id, scope=scope)
+            oplist.patch_ids = [patch.id for patch in scope_patches]
+            oplist.operations = [patch.operation for patch in scope_patches]
+            oplist.version = _version(scope_patches)
+            oplist.modified = datetime.datetime.utcnow()
+            session.add(oplist)
+
+        for oplist in oplists.itervalues():
+            session.delete(oplist)
+
+
+def _version(patches):
+    """
+    Return a token derived from the ids, timestamps and operations of the given patches, which
+    changes whenever a patch in the list is added, removed, reordered or modified.
+    """
+    content = json.dumps([[patch.id, patch.timestamp.isoformat(), patch.operation] for patch in patches],
+                         sort_keys=True)
+    return unicode(hashlib.sha1(content).hexdigest())
+
+
+meta.mapper(JSONPatchOplist, jsonpatch_oplist_table)
@@ -1,20 +1,157 @@
 # encoding: utf-8
 
 import logging
+from sqlalchemy import inspect, select, and_, not_, exists
+from sqlalchemy.schema import CreateIndex
 
+from ckan.model import meta
+from ckanext.jsonpatch.model.database import create_index_concurrently, execute_autocommit
 from ckanext.jsonpatch.model.jsonpatch import *
+from ckanext.jsonpatch.model.oplist import *
+from ckanext.jsonpatch.model.materialized import *
+from ckanext.jsonpatch.model.health import *
 
 log = logging.getLogger(__name__)
 
+tables = (
+    jsonpatch_table,
+    jsonpatch_revision_table,
+    jsonpatch_oplist_table,
+    jsonpatch_materialized_table,
+    jsonpatch_health_table,
+)
+
 
 def init_tables():
-    tables = (
-        jsonpatch_table,
-        jsonpatch_revision_table,
-    )
     for table in tables:
         if not table.exists():
             log.debug("Creating table %s", table.name)
             table.create()
         else:
             log.debug("Table %s already exists", table.name)
+
+
+def upgrade_tables():
+    """
+    Bring the tables of an existing installation up to date with the current table definitions:
+    missing tables are created, missing (nullable) columns are added, missing indexes are built
+    and changed indexes rebuilt, and the operation lists of patched objects that have none are generated.
+    """
+    init_tables()
+    for table in tables:
+        existing = set(column['name'] for column in inspect(meta.engine).get_columns(table.name))
+        for column in table.columns:
+            if column.name not in existing:
+                log.info("Adding column %s to table %s", column.name, table.name)
+                _add_column(column)
+    _populate_paths()
+
+    for table in tables:
+        existing = dict((index['name'], index['column_names'])
+                        for index in inspect(meta.engine).get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                log.info("Creating index %s on table %s", index.name, table.name)
+                _create_index(index)
+            elif existing[index.name] != [column.name for column in index.columns]:
+                log.info("Rebuilding index %s on table %s with columns %s", index.name, table.name,
+                         ', '.join(column.name for column in index.columns))
+                _replace_index(index)
+            else:
+                log.debug("Index %s already exists", index.name)
+    _populate_oplists()
+
+
+def _create_index(index):
+    """
+    Build an index on an existing table. On PostgreSQL the index is built concurrently, so that
+    writes to the table are not blocked for the duration of the build.
+    """
+    engine = meta.engine
+    if engine.dialect.name == 'postgresql':
+        ddl = unicode(CreateIndex(index).compile(dialect=engine.dialect))
+        create_index_concurrently(index.name, ddl.replace(u'CREATE INDEX', u'CREATE INDEX CONCURRENTLY', 1))
+    else:
+        index.create(engine)
+
+
+def _replace_index(index):
+    """
+    Rebuild an existing index whose definition has changed. On PostgreSQL the new index is built
+    concurrently under a temporary name, and then replaces the old one, so that the table remains
+    indexed throughout.
+    """
+    engine = meta.engine
+    if engine.dialect.name == 'postgresql':
+        new_name = index.name + u'_new'
+        ddl = unicode(CreateIndex(index).compile(dialect=engine.dialect))
+        ddl = ddl.replace(u'CREATE INDEX {}'.format(index.name),
+                          u'CREATE INDEX CONCURRENTLY {}'.format(new_name), 1)
+        # a complete new index left behind by an interrupted rebuild is kept
+        create_index_concurrently(new_name, ddl)
+        execute_autocommit(u'DROP INDEX CONCURRENTLY {}'.format(index.name),
+                           u'ALTER INDEX {} RENAME TO {}'.format(new_name, index.name))
+    else:
+        index.drop(engine)
+        index.create(engine)
+
+
+def _add_column(column):
+    engine = meta.engine
+    ddl = u'ALTER TABLE {} ADD COLUMN {} {}'.format(
+        column.table.name, column.name, column.type.compile(dialect=engine.dialect))
+    with engine.begin() as conn:
+        conn.execute(ddl)
+
+
+def _populate_paths(batch_size=1000):
+    """
+    Fill in the path columns of patches saved before they were added.
+    """
+    table = jsonpatch_table
+    count = 0
+    while True:
+        with meta.engine.begin() as conn:
+            rows = conn.execute(select([table.c.id, table.c.operation])
+                                .where(and_(table.c.path.is_(None), table.c.operation.isnot(None)))
+                                .limit(batch_size)).fetchall()
+            updated = 0
+            for id_, operation in rows:
+                path, from_path = operation_paths(operation)
+                if path is not None:
+                    conn.execute(table.update().where(table.c.id == id_).values(path=path, from_path=from_path))
+                    updated += 1
+        count += updated
+        # rows whose operations have no path are left as they are
+        if len(rows) < batch_size or not updated:
+            break
+    if count:
+        log.info("Populated the paths of %d patches", count)
+
+
+def _populate_oplists(batch_size=100):
+    """
+    Generate the operation lists of objects with active patches saved before the jsonpatch_oplist
+    table was added. Each batch of objects is committed separately.
+    """
+    patch = jsonpatch_table
+    oplist = jsonpatch_oplist_table
+    session = meta.Session
+    count = 0
+    while True:
+        objects = session.execute(
+            select([patch.c.model_name, patch.c.object_id]).distinct()
+            .where(and_(patch.c.state == 'active', not_(exists().where(and_(
+                oplist.c.model_name == patch.c.model_name,
+                oplist.c.object_id == patch.c.object_id,
+                oplist.c.scope == ALL_SCOPES,
+            )))))
+            .limit(batch_size)).fetchall()
+        if not objects:
+            break
+        for model_name, object_id in objects:
+            JSONPatchOplist.rebuild(model_name, object_id)
+        session.commit()
+        count += len(objects)
+    if count:
+        log.info("Generated the operation lists of %d objects", count)
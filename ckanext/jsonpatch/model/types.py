@@ -0,0 +1,34 @@
+# encoding: utf-8
+
+"""
+Column types for JSON values that may be stored either as text or, on PostgreSQL, as JSONB
+(see lib/storage.py). Values are always written as JSON text, which PostgreSQL converts on
+assignment to a JSONB column; values read from a JSONB column are decoded by the driver, and
+are returned as they are.
+"""
+
+import json
+
+from ckan.model import types as _types
+
+
+class JsonType(_types.JsonType):
+
+    def process_result_value(self, value, engine):
+        if value is None or not isinstance(value, basestring):
+            return value
+        return json.loads(value)
+
+    def copy(self):
+        return JsonType(self.impl.length)
+
+
+class JsonDictType(_types.JsonDictType):
+
+    def process_result_value(self, value, engine):
+        if value is None or not isinstance(value, basestring):
+            return value
+        return json.loads(value)
+
+    def copy(self):
+        return JsonDictType(self.impl.length)
@@ -4,6 +4,7 @@ import logging
 import ckan.plugins as p
 import ckanext.jsonpatch.logic.action as action
 import ckanext.jsonpatch.logic.auth as auth
+from ckanext.jsonpatch.lib import cache, checkpoints, health, patch, materialize, revisions, search, stats
 
 log = logging.getLogger(__name__)
 
@@ -12,17 +13,42 @@ class JSONPatchPlugin(p.SingletonPlugin):
     """
     Plugin allowing model output dictionaries to be patched according to the JSON Patch specification.
     """
+    p.implements(p.IConfigurable)
     p.implements(p.IActions)
     p.implements(p.IAuthFunctions)
+    p.implements(p.IPackageController, inherit=True)
+    p.implements(p.IResourceController, inherit=True)
+
+    def configure(self, config):
+        cache.configure(config)
+        checkpoints.configure(config)
+        health.configure(config)
+        patch.configure(config)
+        materialize.configure(config)
+        revisions.configure(config)
+        search.configure(config)
+        stats.configure(config)
 
     def get_actions(self):
         return {
             'jsonpatch_create': action.jsonpatch_create,
             'jsonpatch_update': action.jsonpatch_update,
             'jsonpatch_delete': action.jsonpatch_delete,
+            'jsonpatch_create_many': action.jsonpatch_create_many,
+            'jsonpatch_update_many': action.jsonpatch_update_many,
+            'jsonpatch_create_from_diff': action.jsonpatch_create_from_diff,
             'jsonpatch_show': action.jsonpatch_show,
             'jsonpatch_list': action.jsonpatch_list,
+            'jsonpatch_changes': action.jsonpatch_changes,
+            'jsonpatch_search': action.jsonpatch_search,
             'jsonpatch_apply': action.jsonpatch_apply,
+            'jsonpatch_apply_many': action.jsonpatch_apply_many,
+            'jsonpatch_apply_scopes': action.jsonpatch_apply_scopes,
+            'jsonpatch_compact': action.jsonpatch_compact,
+            'jsonpatch_cache_stats': action.jsonpatch_cache_stats,
+            'jsonpatch_stats': action.jsonpatch_stats,
+            'jsonpatch_health_check': action.jsonpatch_health_check,
+            'jsonpatch_health_list': action.jsonpatch_health_list,
         }
 
     def get_auth_functions(self):
@@ -30,7 +56,64 @@ class JSONPatchPlugin(p.SingletonPlugin):
             'jsonpatch_create': auth.jsonpatch_create,
             'jsonpatch_update': auth.jsonpatch_update,
             'jsonpatch_delete': auth.jsonpatch_delete,
+            'jsonpatch_create_many': auth.jsonpatch_create_many,
+            'jsonpatch_update_many': auth.jsonpatch_update_many,
+            'jsonpatch_create_from_diff': auth.jsonpatch_create_from_diff,
             'jsonpatch_show': auth.jsonpatch_show,
             'jsonpatch_list': auth.jsonpatch_list,
+            'jsonpatch_changes': auth.jsonpatch_changes,
+            'jsonpatch_search': auth.jsonpatch_search,
             'jsonpatch_apply': auth.jsonpatch_apply,
+            'jsonpatch_apply_many': auth.jsonpatch_apply_many,
+            'jsonpatch_apply_scopes': auth.jsonpatch_apply_scopes,
+            'jsonpatch_compact': auth.jsonpatch_compact,
+            'jsonpatch_cache_stats': auth.jsonpatch_cache_stats,
+            'jsonpatch_stats': auth.jsonpatch_stats,
+            'jsonpatch_health_check': auth.jsonpatch_health_check,
+            'jsonpatch_health_list': auth.jsonpatch_health_list,
         }
+
+    # IPackageController
+
+    def before_index(self, pkg_dict):
+        if search.is_enabled():
+            pkg_dict = search.patch_index_dict(pkg_dict)
+        return pkg_dict
+
+    def after_search(self, search_results, search_params):
+        if search.is_enabled():
+            search_results = search.patch_search_results(search_results, search_params)
+        return search_results
+
+    # IPackageController and IResourceController share the after_update and after_delete hook names
+
+    def after_update(self, context, data_dict):
+        if 'package_id' in data_dict:
+            self._resource_changed(data_dict)
+        else:
+            self._package_changed(data_dict)
+
+    def after_delete(self, context, data_dict):
+        if isinstance(data_dict, list):
+            for resource_dict in data_dict:
+                self._resource_changed(resource_dict)
+        else:
+            self._package_changed(data_dict)
+
+    def _package_changed(self, pkg_dict):
+        for key in ('id', 'name'):
+            if pkg_dict.get(key):
+                cache.invalidate('package', pkg_dict[key])
+                checkpoints.invalidate('package', pkg_dict[key])
+        if pkg_dict.get('id'):
+            materialize.expire('package', pkg_dict['id'])
+
+    def _resource_changed(self, resource_dict):
+        if resource_dict.get('id'):
+            cache.invalidate('resource', resource_dict['id'])
+            checkpoints.invalidate('resource', resource_dict['id'])
+            materialize.expire('resource', resource_dict['id'])
+        if resource_dict.get('package_id'):
+            cache.invalidate('package', resource_dict['package_id'])
+            checkpoints.invalidate('package', resource_dict['package_id'])
+            materialize.expire('package', resource_dict['package_id'])
@@ -0,0 +1,34 @@
+# encoding: utf-8
+
+import ckan.plugins as p
+import ckan.tests.helpers as helpers
+from ckanext.jsonpatch.model.setup import init_tables
+
+
+class ActionTestBase(object):
+    """
+    Base class for tests that call the plugin's actions: the plugin is loaded for the duration
+    of the class, and each test starts with an empty database.
+    """
+
+    @classmethod
+    def setup_class(cls):
+        if not p.plugin_loaded('jsonpatch'):
+            p.load('jsonpatch')
+
+    @classmethod
+    def teardown_class(cls):
+        p.unload('jsonpatch')
+
+    def setup(self):
+        helpers.reset_db()
+        init_tables()
+
+
+def create_patches(model_name, object_id, operations, scope=None, **kwargs):
+    """
+    Create a patch for each operation, in order, and return their ids.
+    """
+    return helpers.call_action('jsonpatch_create_many', patches=[dict(
+        kwargs, model_name=model_name, object_id=object_id, operation=operation, scope=scope,
+    ) for operation in operations])
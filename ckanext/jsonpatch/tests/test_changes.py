@@ -0,0 +1,68 @@
+# encoding: utf-8
+
+import datetime
+from nose.tools import assert_equal
+
+import ckan.model as model
+import ckan.tests.factories as factories
+import ckan.tests.helpers as helpers
+from ckanext.jsonpatch.lib import revisions
+from ckanext.jsonpatch.model.jsonpatch import jsonpatch_revision_table
+from ckanext.jsonpatch.tests import ActionTestBase, create_patches
+
+
+def _stamp(jsonpatch_id, seconds_ago):
+    # set the revision timestamp of a patch's versions, as if its revision was created that long ago
+    timestamp = datetime.datetime.utcnow() - datetime.timedelta(seconds=seconds_ago)
+    model.Session.execute(jsonpatch_revision_table.update().where(
+        jsonpatch_revision_table.c.id == jsonpatch_id).values(revision_timestamp=timestamp))
+    model.Session.commit()
+
+
+def _changed_ids(result):
+    return [change['id'] for change in result['changes']]
+
+
+class TestChanges(ActionTestBase):
+
+    def setup(self):
+        super(TestChanges, self).setup()
+        revisions.configure({'ckanext.jsonpatch.changes.lag': '60'})
+
+    def teardown(self):
+        revisions.configure({})
+
+    def _create(self, object_id, title):
+        return create_patches('package', object_id, [{'op': 'replace', 'path': '/title', 'value': title}])[0]
+
+    def test_late_commit_not_skipped(self):
+        package = factories.Dataset()
+        first = self._create(package['id'], u'first')
+        _stamp(first, 300)
+        recent = self._create(package['id'], u'recent')
+        _stamp(recent, 10)
+
+        result = helpers.call_action('jsonpatch_changes')
+        assert_equal(_changed_ids(result), [first])
+
+        # a transaction that created its revision before the recent one, but committed after
+        # the feed was read; without the lag the cursor would already have passed it
+        late = self._create(package['id'], u'late')
+        _stamp(late, 20)
+
+        # once the lag has passed, both are returned, in revision order
+        _stamp(late, 80)
+        _stamp(recent, 70)
+        result = helpers.call_action('jsonpatch_changes', cursor=result['next_cursor'])
+        assert_equal(_changed_ids(result), [late, recent])
+
+    def test_cursor_kept_within_lag(self):
+        package = factories.Dataset()
+        first = self._create(package['id'], u'first')
+        _stamp(first, 300)
+
+        result = helpers.call_action('jsonpatch_changes')
+        self._create(package['id'], u'recent')
+        next_result = helpers.call_action('jsonpatch_changes', cursor=result['next_cursor'])
+        assert_equal(next_result['changes'], [])
+        assert_equal(next_result['next_cursor'], result['next_cursor'])
@@ -0,0 +1,171 @@
+# encoding: utf-8
+
+import jsonpatch
+import jsonpointer
+import mock
+from nose.tools import assert_equal, assert_true, assert_false, assert_raises, assert_in
+
+import ckan.plugins.toolkit as tk
+import ckan.tests.factories as factories
+import ckan.tests.helpers as helpers
+from ckanext.jsonpatch.lib import checkpoints, diff
+from ckanext.jsonpatch.lib.patch import CompiledPatch
+from ckanext.jsonpatch.tests import ActionTestBase
+
+ERRORS = (jsonpatch.JsonPatchException, jsonpointer.JsonPointerException)
+
+
+class _Oplist(object):
+
+    def __init__(self, patch_ids, operations):
+        self.patch_ids = patch_ids
+        self.operations = operations
+
+
+class TestCheck(object):
+    """
+    Checks against an object whose operation list, unpatched dictionary and source modification
+    time are set by each test.
+    """
+
+    def setup(self):
+        checkpoints.configure({'ckanext.jsonpatch.validate.checkpoint_interval': '4'})
+        self.object_dict = {}
+        self.source_modified = u'2019-01-01T00:00:00'
+        self.oplist = _Oplist([], [])
+        self.shown = 0
+        self.applied = []
+
+        test = self
+
+        def show(context, model_name, object_id):
+            test.shown += 1
+            return dict(test.object_dict)
+
+        class CountingPatch(CompiledPatch):
+            def __init__(self, oplist):
+                CompiledPatch.__init__(self, oplist)
+                test.applied.extend(oplist)
+
+        self.patches = [
+            mock.patch.object(checkpoints, '_show', show),
+            mock.patch.object(checkpoints, 'CompiledPatch', CountingPatch),
+            mock.patch.object(checkpoints.JSONPatchOplist, 'get', staticmethod(lambda *args: self.oplist)),
+            mock.patch.object(checkpoints.materialize, 'has_source_modified', lambda model_name: True),
+            mock.patch.object(checkpoints.materialize, 'get_source_modified',
+                              lambda context, model_name, object_id: self.source_modified),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def teardown(self):
+        for patch in self.patches:
+            patch.stop()
+        checkpoints.configure({})
+
+    def _append(self, patch_id, operation):
+        self._insert(len(self.oplist.patch_ids), patch_id, operation)
+
+    def _insert(self, position, patch_id, operation):
+        self.oplist = _Oplist(self.oplist.patch_ids[:position] + [patch_id] + self.oplist.patch_ids[position:],
+                              self.oplist.operations[:position] + [operation] + self.oplist.operations[position:])
+
+    def _check(self, patch_id):
+        del self.applied[:]
+        return checkpoints.check({}, 'package', 'some-package', None, patch_id)
+
+    def _add(self, n):
+        return {'op': 'add', 'path': '/a{}'.format(n), 'value': n}
+
+    def test_append_applies_new_operation_only(self):
+        for n in xrange(10):
+            self._append(n, self._add(n))
+        assert_true(self._check(9))
+        assert_equal(len(self.applied), 10)
+
+        self._append(10, self._add(10))
+        assert_true(self._check(10))
+        assert_equal(self.applied, [self._add(10)])
+        assert_equal(self.shown, 1)
+
+    def test_insert_replays_from_nearest_checkpoint(self):
+        for n in xrange(10):
+            self._append(n, self._add(n))
+        assert_true(self._check(9))
+
+        # with checkpoints every 4 operations, an insert at position 6 replays operations 4 and 5
+        self._insert(6, 'inserted', {'op': 'replace', 'path': '/a5', 'value': 0})
+        assert_true(self._check('inserted'))
+        assert_equal(self.applied, [self._add(4), self._add(5), {'op': 'replace', 'path': '/a5', 'value': 0}])
+        assert_equal(self.shown, 1)
+
+    def test_operation_that_cannot_be_applied(self):
+        self._append(0, self._add(0))
+        self._append(1, {'op': 'remove', 'path': '/a1'})
+        assert_raises(ERRORS, self._check, 1)
+
+    def test_unchecked_if_preceding_operations_fail(self):
+        self._append(0, {'op': 'remove', 'path': '/a0'})
+        self._append(1, self._add(1))
+        assert_false(self._check(1))
+
+    def test_source_change_discards_cached_states(self):
+        self.object_dict = {'a0': 0}
+        self._append(0, {'op': 'remove', 'path': '/a0'})
+        assert_true(self._check(0))
+
+        self.object_dict = {}
+        self.source_modified = u'2019-01-02T00:00:00'
+        assert_raises(ERRORS, self._check, 0)
+        assert_equal(self.shown, 2)
+
+
+class TestCheckActions(ActionTestBase):
+
+    INVALID = {'op': 'remove', 'path': '/missing'}
+
+    def test_create_rejects_operation(self):
+        package = factories.Dataset()
+        with assert_raises(tk.ValidationError) as cm:
+            helpers.call_action('jsonpatch_create', model_name='package', object_id=package['id'],
+                                operation=self.INVALID, validate=True)
+        assert_in('operation', cm.exception.error_dict)
+        assert_equal(helpers.call_action('jsonpatch_list', model_name='package', object_id=package['id']), [])
+
+    def test_create_many_rejects_operation(self):
+        package = factories.Dataset()
+        with assert_raises(tk.ValidationError) as cm:
+            helpers.call_action('jsonpatch_create_many', validate=True, patches=[
+                {'model_name': 'package', 'object_id': package['id'],
+                 'operation': {'op': 'replace', 'path': '/title', 'value': u'New'}},
+                {'model_name': 'package', 'object_id': package['id'], 'operation': self.INVALID},
+            ])
+        errors = cm.exception.error_dict['patches']
+        assert_equal(errors[0], {})
+        assert_in('operation', errors[1])
+        assert_equal(helpers.call_action('jsonpatch_list', model_name='package', object_id=package['id']), [])
+
+    def test_create_from_diff_rejects_operation(self):
+        package = factories.Dataset()
+        edited = dict(package, notes=u'Edited')
+        # operations are derived from the patched object, so a failing one is only produced by a
+        # faulty diff
+        with mock.patch.object(diff, 'make_oplist', return_value=[self.INVALID]), \
+                mock.patch.object(diff, 'verify', return_value=True):
+            with assert_raises(tk.ValidationError) as cm:
+                helpers.call_action('jsonpatch_create_from_diff', model_name='package', object_id=package['id'],
+                                    object=edited, validate=True)
+        assert_in('operation', cm.exception.error_dict['patches'][0])
+        assert_equal(helpers.call_action('jsonpatch_list', model_name='package', object_id=package['id']), [])
+
+    def test_changed_package_not_checked_against_cached_state(self):
+        package = factories.Dataset(title=u'Old')
+        helpers.call_action('jsonpatch_create', model_name='package', object_id=package['id'],
+                            operation={'op': 'replace', 'path': '/notes', 'value': u'Patched'}, validate=True)
+
+        # the state cached by the first check has the old title
+        helpers.call_action('package_patch', id=package['id'], title=u'New')
+        with assert_raises(tk.ValidationError) as cm:
+            helpers.call_action('jsonpatch_create', model_name='package', object_id=package['id'],
+                                operation={'op': 'test', 'path': '/title', 'value': u'Old'}, validate=True)
+        assert_in('operation', cm.exception.error_dict)
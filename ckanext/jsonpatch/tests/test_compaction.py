@@ -0,0 +1,179 @@
+# encoding: utf-8
+
+import copy
+import random
+import jsonpatch
+from nose.tools import assert_equal
+
+import ckan.model as model
+import ckan.tests.factories as factories
+import ckan.tests.helpers as helpers
+from ckanext.jsonpatch.lib.compaction import compact
+from ckanext.jsonpatch.model.jsonpatch import JSONPatch, jsonpatch_revision_table
+from ckanext.jsonpatch.tests import ActionTestBase, create_patches
+
+SCOPES = (None, u'a', u'b')
+
+PATHS = ('/x', '/x/y', '/x/z', '/list', '/list/0', '/list/1', '/list/-', '/list/0/y', '/w')
+
+
+def _random_operation(rnd):
+    op = rnd.choice(('add', 'add', 'replace', 'replace', 'remove', 'move', 'copy', 'test'))
+    operation = {'op': op, 'path': rnd.choice(PATHS)}
+    if op in ('add', 'replace', 'test'):
+        operation['value'] = rnd.choice((1, 2, u's', {'y': 1}, [1, 2], {}))
+    if op in ('move', 'copy'):
+        operation['from'] = rnd.choice(PATHS)
+    return operation
+
+
+def _apply(document, operations):
+    """
+    Return the result of applying the operations to a copy of the document, or None if they fail.
+    """
+    try:
+        return jsonpatch.apply_patch(copy.deepcopy(document), copy.deepcopy(operations))
+    except Exception:
+        return None
+
+
+def _scope_list(entries, scope):
+    # the operations applied for a scope: those of the scope's patches and of unscoped patches
+    return [operation for (key, entry_scope, operation) in entries
+            if scope is None or entry_scope in (None, scope)]
+
+
+class TestCompact(object):
+
+    def test_equivalent_for_all_scopes_and_each_scope(self):
+        rnd = random.Random(7)
+        documents = [{}, {'x': {'y': 0}}, {'x': {}, 'list': [{'y': 0}, 2]}, {'list': [], 'w': 1}]
+        for i in xrange(3000):
+            entries = [(n, rnd.choice(SCOPES), _random_operation(rnd)) for n in xrange(rnd.randint(1, 8))]
+            kept, removed, modified = compact(copy.deepcopy(entries))
+            assert_equal(len(kept) + len(removed), len(entries))
+            for scope in SCOPES:
+                for document in documents:
+                    expected = _apply(document, _scope_list(entries, scope))
+                    if expected is not None:
+                        assert_equal(_apply(document, _scope_list(kept, scope)), expected,
+                                     'scope %s: %r compacted to %r' % (scope, entries, kept))
+
+    def test_replace_after_add_is_merged(self):
+        kept, removed, modified = compact([
+            (1, None, {'op': 'add', 'path': '/x', 'value': 1}),
+            (2, None, {'op': 'replace', 'path': '/x', 'value': 2}),
+        ])
+        assert_equal(kept, [(1, None, {'op': 'add', 'path': '/x', 'value': 2})])
+        assert_equal(removed, [2])
+        assert_equal(modified, [1])
+
+    def test_overwritten_operations_are_dropped(self):
+        kept, removed, modified = compact([
+            (1, None, {'op': 'add', 'path': '/x/y', 'value': 1}),
+            (2, None, {'op': 'replace', 'path': '/x', 'value': {}}),
+        ])
+        assert_equal([key for (key, scope, operation) in kept], [2])
+        assert_equal(removed, [1])
+
+    def _assert_unchanged(self, operations):
+        entries = [(n, None, operation) for n, operation in enumerate(operations)]
+        kept, removed, modified = compact(copy.deepcopy(entries))
+        assert_equal(kept, entries)
+        assert_equal((removed, modified), ([], []))
+
+    def test_not_merged_across_test(self):
+        self._assert_unchanged([
+            {'op': 'add', 'path': '/x', 'value': 1},
+            {'op': 'test', 'path': '/x', 'value': 1},
+            {'op': 'replace', 'path': '/x', 'value': 2},
+        ])
+        self._assert_unchanged([
+            {'op': 'add', 'path': '/x/y', 'value': 1},
+            {'op': 'test', 'path': '/x/y', 'value': 1},
+            {'op': 'replace', 'path': '/x', 'value': {}},
+        ])
+
+    def test_not_merged_across_move(self):
+        self._assert_unchanged([
+            {'op': 'add', 'path': '/x', 'value': 1},
+            {'op': 'move', 'from': '/x', 'path': '/w'},
+            {'op': 'add', 'path': '/x', 'value': 2},
+            {'op': 'replace', 'path': '/w', 'value': 3},
+        ])
+        self._assert_unchanged([
+            {'op': 'add', 'path': '/x/y', 'value': 1},
+            {'op': 'move', 'from': '/x/y', 'path': '/w'},
+            {'op': 'remove', 'path': '/x'},
+        ])
+
+    def test_not_merged_across_copy(self):
+        self._assert_unchanged([
+            {'op': 'add', 'path': '/x', 'value': 1},
+            {'op': 'copy', 'from': '/x', 'path': '/w'},
+            {'op': 'replace', 'path': '/x', 'value': 2},
+        ])
+        self._assert_unchanged([
+            {'op': 'add', 'path': '/x/y', 'value': 1},
+            {'op': 'copy', 'from': '/x', 'path': '/w'},
+            {'op': 'remove', 'path': '/x'},
+        ])
+
+    def test_scoped_operations_not_merged_into_other_scopes(self):
+        entries = [
+            (1, u'a', {'op': 'add', 'path': '/x', 'value': 1}),
+            (2, u'b', {'op': 'replace', 'path': '/x', 'value': 2}),
+        ]
+        kept, removed, modified = compact(copy.deepcopy(entries))
+        assert_equal(kept, entries)
+
+    def test_unscoped_operation_kept_when_overwritten_in_one_scope(self):
+        # the unscoped replace is still applied for scope b, which does not include the remove
+        entries = [
+            (1, None, {'op': 'replace', 'path': '/x', 'value': 1}),
+            (2, u'a', {'op': 'remove', 'path': '/x'}),
+        ]
+        kept, removed, modified = compact(copy.deepcopy(entries))
+        assert_equal(kept, entries)
+
+
+class TestCompactAction(ActionTestBase):
+
+    def test_compact_in_a_single_revision(self):
+        package = factories.Dataset()
+        create_patches('package', package['id'], [
+            {'op': 'add', 'path': '/notes', 'value': u'first'},
+            {'op': 'replace', 'path': '/notes', 'value': u'second'},
+            {'op': 'add', 'path': '/extras/-', 'value': {'key': u'k', 'value': u'1'}},
+            {'op': 'replace', 'path': '/title', 'value': u'one'},
+            {'op': 'replace', 'path': '/title', 'value': u'two'},
+        ])
+        before = helpers.call_action('jsonpatch_apply', model_name='package', object_id=package['id'])
+
+        result = helpers.call_action('jsonpatch_compact', model_name='package', object_id=package['id'],
+                                     dry_run=False)
+        assert_equal(result['operations_before'], 5)
+        assert_equal(result['operations_after'], 3)
+        assert_equal(len(result['removed_ids']), 2)
+        assert_equal(len(result['modified_ids']), 1)
+
+        after = helpers.call_action('jsonpatch_apply', model_name='package', object_id=package['id'])
+        assert_equal(after, before)
+
+        for jsonpatch_id in result['removed_ids']:
+            assert_equal(JSONPatch.get(jsonpatch_id).state, 'deleted')
+        changed_ids = result['removed_ids'] + result['modified_ids']
+        table = jsonpatch_revision_table
+        revision_ids = set(revision_id for (revision_id,) in model.Session.query(table.c.revision_id).filter(
+            table.c.id.in_(changed_ids), table.c.current == True))
+        assert_equal(len(revision_ids), 1)
+
+    def test_dry_run_changes_nothing(self):
+        package = factories.Dataset()
+        ids = create_patches('package', package['id'], [
+            {'op': 'replace', 'path': '/title', 'value': u'one'},
+            {'op': 'replace', 'path': '/title', 'value': u'two'},
+        ])
+        result = helpers.call_action('jsonpatch_compact', model_name='package', object_id=package['id'])
+        assert_equal(result['removed_ids'], [ids[0]])
+        assert_equal(helpers.call_action('jsonpatch_list', model_name='package', object_id=package['id']), ids)
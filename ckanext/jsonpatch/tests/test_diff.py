@@ -0,0 +1,151 @@
+# encoding: utf-8
+
+import copy
+import random
+import jsonpatch
+from nose.tools import assert_equal, assert_true, assert_false, assert_raises, assert_in
+
+import ckan.plugins.toolkit as tk
+import ckan.tests.factories as factories
+import ckan.tests.helpers as helpers
+from ckanext.jsonpatch.lib.diff import make_oplist, verify
+from ckanext.jsonpatch.tests import ActionTestBase, create_patches
+
+DOCUMENT = {
+    'title': u'Title',
+    'tags': [{'name': u'a'}, {'name': u'b'}, {'name': u'c'}, {'name': u'd'}],
+    'resources': [
+        {'id': u'r1', 'url': u'http://a', 'extras': [{'key': u'k1', 'value': 1}]},
+        {'id': u'r2', 'url': u'http://b', 'extras': []},
+        {'id': u'r3', 'url': u'http://c', 'extras': [{'key': u'k1', 'value': 1}, {'key': u'k2', 'value': 2}]},
+    ],
+}
+
+
+def _apply(src, oplist):
+    return jsonpatch.apply_patch(copy.deepcopy(src), copy.deepcopy(oplist))
+
+
+def _edit(document, edit):
+    result = copy.deepcopy(document)
+    edit(result)
+    return result
+
+
+class TestMakeOplist(object):
+
+    def _assert_round_trip(self, src, dst):
+        oplist = make_oplist(src, dst)
+        assert_equal(_apply(src, oplist), dst, oplist)
+        assert_true(verify(src, dst, oplist))
+        return oplist
+
+    def test_keyed_list_changes(self):
+        edits = (
+            lambda d: d['tags'].insert(2, {'name': u'x'}),
+            lambda d: d['tags'].append({'name': u'x'}),
+            lambda d: d['tags'].pop(1),
+            lambda d: d['tags'].reverse(),
+            lambda d: d['tags'].insert(0, d['tags'].pop()),
+            lambda d: d['resources'][1].update(url=u'http://x'),
+            lambda d: d['resources'][2]['extras'].pop(0),
+            lambda d: d['resources'][0]['extras'].insert(0, {'key': u'k0', 'value': 0}),
+            lambda d: d.update(resources=[d['resources'][2], d['resources'][0]]),
+        )
+        for edit in edits:
+            self._assert_round_trip(DOCUMENT, _edit(DOCUMENT, edit))
+
+    def test_combined_changes(self):
+        def edit(document):
+            tags = document['tags']
+            tags.pop(0)
+            tags.insert(1, {'name': u'x'})
+            tags.reverse()
+            resources = document['resources']
+            resources[2]['extras'][1]['value'] = 3
+            resources[2]['extras'].reverse()
+            resources.insert(1, resources.pop(2))
+            resources.append({'id': u'r4', 'url': u'http://d', 'extras': []})
+            document['title'] = u'New'
+        self._assert_round_trip(DOCUMENT, _edit(DOCUMENT, edit))
+
+    def test_random_keyed_list_changes(self):
+        rnd = random.Random(5)
+        for i in xrange(1000):
+            src = [{'id': n, 'value': rnd.randint(0, 2), 'list': [{'id': m} for m in xrange(rnd.randint(0, 3))]}
+                   for n in rnd.sample(xrange(10), rnd.randint(1, 6))]
+            dst = [dict(element) for element in src if rnd.random() < 0.8]
+            rnd.shuffle(dst)
+            for n in xrange(rnd.randint(0, 3)):
+                dst.insert(rnd.randint(0, len(dst)), {'id': 10 + n, 'value': 0, 'list': []})
+            for element in dst:
+                if rnd.random() < 0.3:
+                    element['value'] = rnd.randint(0, 2)
+                if rnd.random() < 0.3:
+                    element['list'] = list(reversed(element['list']))
+            self._assert_round_trip({'list': src}, {'list': dst})
+
+    def test_single_insert_gives_single_add(self):
+        dst = _edit(DOCUMENT, lambda d: d['tags'].insert(2, {'name': u'x'}))
+        assert_equal(make_oplist(DOCUMENT, dst), [{'op': 'add', 'path': u'/tags/2', 'value': {'name': u'x'}}])
+
+    def test_single_remove_gives_single_remove(self):
+        dst = _edit(DOCUMENT, lambda d: d['resources'].pop(0))
+        assert_equal(make_oplist(DOCUMENT, dst), [{'op': 'remove', 'path': u'/resources/0'}])
+
+    def test_no_changes(self):
+        assert_equal(make_oplist(DOCUMENT, copy.deepcopy(DOCUMENT)), [])
+
+    def test_boolean_distinguished_from_number(self):
+        oplist = self._assert_round_trip({'x': [True]}, {'x': [1]})
+        assert_true(oplist)
+
+    def test_unverified_list_operations_replaced(self):
+        # jsonpatch.make_patch gives operations for these lists that fail to apply
+        src, dst = [True, [True, u'x']], [u'x', []]
+        assert_false(verify(src, dst, jsonpatch.make_patch(src, dst).patch))
+        oplist = self._assert_round_trip({'x': src}, {'x': dst})
+        assert_equal(oplist, [{'op': 'replace', 'path': u'/x', 'value': dst}])
+
+    def test_verify_rejects_wrong_operations(self):
+        assert_false(verify({'x': 1}, {'x': 2}, [{'op': 'replace', 'path': '/x', 'value': 3}]))
+        assert_false(verify({'x': 1}, {'x': 2}, [{'op': 'remove', 'path': '/y'}]))
+        assert_false(verify({'x': 1}, {'x': True}, [{'op': 'replace', 'path': '/x', 'value': 1}]))
+
+
+class TestCreateFromDiff(ActionTestBase):
+
+    def test_patches_give_edited_object(self):
+        package = factories.Dataset(tags=[{'name': u'a'}, {'name': u'b'}])
+        create_patches('package', package['id'], [{'op': 'replace', 'path': '/title', 'value': u'Patched'}])
+        current = helpers.call_action('jsonpatch_apply', model_name='package', object_id=package['id'])
+        edited = copy.deepcopy(current)
+        edited['notes'] = u'Edited'
+        edited['tags'].insert(1, dict(edited['tags'][0], name=u'x', id=u'x'))
+
+        ids = helpers.call_action('jsonpatch_create_from_diff', model_name='package', object_id=package['id'],
+                                  object=edited)
+        assert_equal(len(ids), 2)
+        assert_equal(helpers.call_action('jsonpatch_apply', model_name='package', object_id=package['id']), edited)
+
+    def test_if_match_rejected_after_change(self):
+        package = factories.Dataset()
+        current = helpers.call_action('jsonpatch_apply', model_name='package', object_id=package['id'],
+                                      with_version=True)
+        create_patches('package', package['id'], [{'op': 'replace', 'path': '/title', 'value': u'Patched'}])
+
+        edited = dict(current['object'], notes=u'Edited')
+        with assert_raises(tk.ValidationError) as cm:
+            helpers.call_action('jsonpatch_create_from_diff', model_name='package', object_id=package['id'],
+                                object=edited, if_match=current['version'])
+        assert_in('if_match', cm.exception.error_dict)
+        assert_equal(len(helpers.call_action('jsonpatch_list', model_name='package', object_id=package['id'])), 1)
+
+    def test_if_match_accepted(self):
+        package = factories.Dataset()
+        current = helpers.call_action('jsonpatch_apply', model_name='package', object_id=package['id'],
+                                      with_version=True)
+        edited = dict(current['object'], notes=u'Edited')
+        ids = helpers.call_action('jsonpatch_create_from_diff', model_name='package', object_id=package['id'],
+                                  object=edited, if_match=current['version'])
+        assert_equal(len(ids), 1)
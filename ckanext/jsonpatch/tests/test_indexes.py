@@ -0,0 +1,48 @@
+# encoding: utf-8
+
+from nose.plugins.skip import SkipTest
+from nose.tools import assert_in, assert_not_in
+
+import ckan.model as model
+import ckan.tests.helpers as helpers
+from ckanext.jsonpatch.model.jsonpatch import JSONPatch
+from ckanext.jsonpatch.model.setup import init_tables
+
+
+def _query_plan(q):
+    """
+    Return the PostgreSQL query plan of a query, with sequential scans disabled so that the
+    planner uses an index if one applies, however few rows the table has.
+    """
+    engine = model.meta.engine
+    sql = unicode(q.statement.compile(dialect=engine.dialect, compile_kwargs={'literal_binds': True}))
+    with engine.begin() as conn:
+        conn.execute('SET LOCAL enable_seqscan = off')
+        return u'\n'.join(row[0] for row in conn.execute(u'EXPLAIN ' + sql))
+
+
+class TestPatchLookupIndex(object):
+
+    @classmethod
+    def setup_class(cls):
+        if model.meta.engine.dialect.name != 'postgresql':
+            raise SkipTest("Query plans are checked on PostgreSQL only")
+        helpers.reset_db()
+        init_tables()
+
+    def _list_query(self, *columns):
+        # the query of jsonpatch_list and jsonpatch_apply
+        return model.Session.query(*columns) \
+            .filter_by(model_name='package', object_id='some-package', state='active') \
+            .order_by(JSONPatch.ordinal, JSONPatch.timestamp, JSONPatch.id)
+
+    def test_list_uses_index(self):
+        plan = _query_plan(self._list_query(JSONPatch.id))
+        assert_in('idx_jsonpatch_object', plan)
+        # the rows are read in index order
+        assert_not_in('Sort', plan)
+
+    def test_list_by_scope_uses_index(self):
+        plan = _query_plan(self._list_query(JSONPatch.id).filter_by(scope='some-scope'))
+        assert_in('idx_jsonpatch_object', plan)
+        assert_not_in('Sort', plan)
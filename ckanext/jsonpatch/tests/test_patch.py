@@ -0,0 +1,127 @@
+# encoding: utf-8
+
+import copy
+import json
+import random
+import jsonpatch
+import jsonpointer
+from nose.tools import assert_equal, assert_raises
+
+from ckanext.jsonpatch.lib.patch import CompiledPatch
+
+DOCUMENT = {
+    'title': u'Title',
+    'tags': [{'name': u'a'}, {'name': u'b'}, {'name': u'c'}],
+    'extras': {'key': {'value': 1, 'list': [1, 2, 3]}},
+    'resources': [],
+}
+
+CASES = (
+    [{'op': 'add', 'path': '/notes', 'value': u'Notes'}],
+    [{'op': 'add', 'path': '/tags/-', 'value': {'name': u'd'}}],
+    [{'op': 'add', 'path': '/tags/0', 'value': {'name': u'z'}}],
+    [{'op': 'add', 'path': '/tags/3', 'value': {'name': u'z'}}],
+    [{'op': 'add', 'path': '/extras/key/list/1', 'value': [0]}],
+    [{'op': 'remove', 'path': '/title'}],
+    [{'op': 'remove', 'path': '/tags/1'}],
+    [{'op': 'remove', 'path': '/extras/key/list/2'}],
+    [{'op': 'replace', 'path': '/title', 'value': u'New'}],
+    [{'op': 'replace', 'path': '/tags/2/name', 'value': u'x'}],
+    [{'op': 'replace', 'path': '/extras/key', 'value': {'value': 2}}],
+    [{'op': 'move', 'from': '/tags/0', 'path': '/tags/-'}],
+    [{'op': 'move', 'from': '/tags/2', 'path': '/tags/0'}],
+    [{'op': 'move', 'from': '/extras/key/list', 'path': '/list'}],
+    [{'op': 'move', 'from': '/tags/1/name', 'path': '/extras/key/name'}],
+    [{'op': 'copy', 'from': '/tags/0', 'path': '/tags/-'}],
+    [{'op': 'copy', 'from': '/extras/key', 'path': '/resources/0'}],
+    [{'op': 'copy', 'from': '/extras', 'path': '/extras/key/copy'}],
+    [{'op': 'test', 'path': '/tags/1/name', 'value': u'b'}],
+    [{'op': 'test', 'path': '/extras/key/list', 'value': [1, 2, 3]}],
+    # operations on locations modified by earlier operations
+    [{'op': 'add', 'path': '/tags/-', 'value': {'name': u'd'}},
+     {'op': 'replace', 'path': '/tags/3/name', 'value': u'e'}],
+    [{'op': 'copy', 'from': '/tags/0', 'path': '/resources/-'},
+     {'op': 'replace', 'path': '/resources/0/name', 'value': u'r'}],
+    [{'op': 'move', 'from': '/tags/0', 'path': '/extras/key/tag'},
+     {'op': 'remove', 'path': '/tags/0'},
+     {'op': 'add', 'path': '/extras/key/tag/name', 'value': u'm'}],
+)
+
+FAILING_CASES = (
+    [{'op': 'remove', 'path': '/notes'}],
+    [{'op': 'replace', 'path': '/tags/3', 'value': 1}],
+    [{'op': 'add', 'path': '/tags/4', 'value': 1}],
+    [{'op': 'move', 'from': '/missing', 'path': '/title'}],
+    [{'op': 'move', 'from': '/extras', 'path': '/extras/key/x'}],
+    [{'op': 'copy', 'from': '/tags/5', 'path': '/title'}],
+    [{'op': 'test', 'path': '/title', 'value': u'Other'}],
+)
+
+
+def _expected(document, operations):
+    return jsonpatch.apply_patch(copy.deepcopy(document), copy.deepcopy(operations))
+
+
+def _dump(document):
+    return json.dumps(document, sort_keys=True)
+
+
+class TestCompiledPatch(object):
+
+    def test_matches_jsonpatch(self):
+        for operations in CASES:
+            for in_place in (False, True):
+                document = copy.deepcopy(DOCUMENT)
+                result = CompiledPatch(operations).apply(document, in_place=in_place)
+                assert_equal(result, _expected(DOCUMENT, operations), operations)
+
+    def test_shared_leaves_document_unchanged(self):
+        for operations in CASES:
+            document = copy.deepcopy(DOCUMENT)
+            patch = CompiledPatch(operations)
+            result = patch.apply(document)
+            assert_equal(_dump(document), _dump(DOCUMENT), operations)
+            # the patch may be applied to the same document again
+            assert_equal(patch.apply(document), result)
+            assert_equal(_dump(document), _dump(DOCUMENT), operations)
+
+    def test_inserted_values_not_shared(self):
+        patch = CompiledPatch([{'op': 'add', 'path': '/list', 'value': [1]}])
+        first = patch.apply({})
+        first['list'].append(2)
+        assert_equal(patch.apply({}), {'list': [1]})
+
+    def test_failures_match_jsonpatch(self):
+        for operations in FAILING_CASES:
+            assert_raises((jsonpatch.JsonPatchException, jsonpointer.JsonPointerException),
+                          _expected, DOCUMENT, operations)
+            assert_raises((jsonpatch.JsonPatchException, jsonpointer.JsonPointerException),
+                          CompiledPatch(operations).apply, copy.deepcopy(DOCUMENT), True)
+            document = copy.deepcopy(DOCUMENT)
+            assert_raises((jsonpatch.JsonPatchException, jsonpointer.JsonPointerException),
+                          CompiledPatch(operations).apply, document)
+            assert_equal(_dump(document), _dump(DOCUMENT), operations)
+
+    def test_random_patches_match_jsonpatch(self):
+        rnd = random.Random(11)
+        paths = ('/title', '/tags', '/tags/0', '/tags/1', '/tags/-', '/tags/0/name', '/extras/key',
+                 '/extras/key/list', '/extras/key/list/0', '/extras/key/list/-', '/resources/-', '/x')
+        for i in xrange(2000):
+            operations = []
+            for n in xrange(rnd.randint(1, 5)):
+                op = rnd.choice(('add', 'remove', 'replace', 'move', 'copy', 'test'))
+                operation = {'op': op, 'path': rnd.choice(paths)}
+                if op in ('add', 'replace', 'test'):
+                    operation['value'] = rnd.choice((1, u'v', {'name': u'a'}, [1, 2, 3]))
+                if op in ('move', 'copy'):
+                    operation['from'] = rnd.choice(paths)
+                operations += [operation]
+            try:
+                expected = _expected(DOCUMENT, operations)
+            except (jsonpatch.JsonPatchException, jsonpointer.JsonPointerException, TypeError):
+                # jsonpatch raises TypeError for some operations on the wrong type of value
+                continue
+            document = copy.deepcopy(DOCUMENT)
+            assert_equal(CompiledPatch(operations).apply(document), expected, operations)
+            assert_equal(_dump(document), _dump(DOCUMENT), operations)
+            assert_equal(CompiledPatch(operations).apply(document, in_place=True), expected, operations)
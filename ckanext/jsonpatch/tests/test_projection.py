@@ -0,0 +1,94 @@
+# encoding: utf-8
+
+import copy
+import random
+import jsonpatch
+from nose.tools import assert_equal
+
+from ckanext.jsonpatch.lib.projection import project_oplist
+
+FIELDS = ('a', 'b', 'c', 'd')
+
+PATHS = ('/a', '/a/0', '/a/1', '/a/2', '/a/-', '/a/0/x', '/a/1/x', '/b', '/b/x', '/b/y', '/b/x/0',
+         '/b/x/-', '/c', '/d', '/d/x')
+
+DOCUMENTS = (
+    {},
+    {'a': [1, 2], 'b': {'x': [0]}, 'c': 1},
+    {'a': [{'x': 1}, {'x': [2]}, 3], 'b': {'x': [], 'y': {'x': 1}}, 'd': {}},
+)
+
+
+def _apply(document, operations):
+    """
+    Return the result of applying the operations to a copy of the document, or None if they fail.
+    """
+    try:
+        return jsonpatch.apply_patch(copy.deepcopy(document), copy.deepcopy(operations))
+    except Exception:
+        return None
+
+
+def _restrict(document, fields):
+    # as returned by jsonpatch_apply with 'fields'
+    return dict((field, document[field]) for field in fields if field in document)
+
+
+def _assert_projection(document, operations, fields):
+    expected = _apply(document, operations)
+    if expected is None:
+        return
+    projected = _apply(document, project_oplist(operations, fields))
+    assert_equal(projected is not None and _restrict(projected, fields), _restrict(expected, fields),
+                 '%r with %r for %r' % (document, operations, fields))
+
+
+class TestProjectOplist(object):
+
+    def test_unrelated_operations_dropped(self):
+        operations = [
+            {'op': 'add', 'path': '/a', 'value': 1},
+            {'op': 'replace', 'path': '/b/x', 'value': 2},
+            {'op': 'add', 'path': '/c', 'value': 3},
+        ]
+        assert_equal(project_oplist(operations, ['b']), [operations[1]])
+
+    def test_tests_kept(self):
+        operations = [{'op': 'test', 'path': '/a', 'value': 1}, {'op': 'add', 'path': '/b', 'value': 1}]
+        assert_equal(project_oplist(operations, ['b']), operations)
+
+    def test_move_and_copy_sources_kept(self):
+        document = {'a': {'x': 1}, 'b': {}}
+        for op in ('move', 'copy'):
+            operations = [
+                {'op': 'replace', 'path': '/a/x', 'value': 2},
+                {'op': op, 'from': '/a', 'path': '/b/y'},
+            ]
+            assert_equal(project_oplist(operations, ['b']), operations)
+            _assert_projection(document, operations, ['b'])
+
+    def test_array_insert_and_remove_kept(self):
+        document = {'a': [{'x': 1}, {'x': 2}], 'b': {}}
+        operations = [
+            {'op': 'add', 'path': '/a/0', 'value': {'x': 0}},
+            {'op': 'remove', 'path': '/a/2'},
+            {'op': 'copy', 'from': '/a/1', 'path': '/b/y'},
+        ]
+        assert_equal(project_oplist(operations, ['b']), operations)
+        _assert_projection(document, operations, ['b'])
+
+    def test_random_projections_match_full_apply(self):
+        rnd = random.Random(3)
+        for i in xrange(5000):
+            operations = []
+            for n in xrange(rnd.randint(1, 6)):
+                op = rnd.choice(('add', 'add', 'remove', 'replace', 'move', 'copy', 'test'))
+                operation = {'op': op, 'path': rnd.choice(PATHS)}
+                if op in ('add', 'replace', 'test'):
+                    operation['value'] = rnd.choice((1, {'x': 1}, {'x': [2]}, [], [1, 2]))
+                if op in ('move', 'copy'):
+                    operation['from'] = rnd.choice(PATHS)
+                operations += [operation]
+            fields = rnd.sample(FIELDS, rnd.randint(1, 2))
+            for document in DOCUMENTS:
+                _assert_projection(document, operations, fields)
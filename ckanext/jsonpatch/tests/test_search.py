@@ -0,0 +1,38 @@
+# encoding: utf-8
+
+import mock
+from nose.tools import assert_equal, assert_is_none
+
+import ckan.tests.factories as factories
+import ckan.tests.helpers as helpers
+from ckan.lib.search import SearchIndexError
+from ckanext.jsonpatch.lib import search
+from ckanext.jsonpatch.tests import ActionTestBase, create_patches
+
+
+class TestSearch(ActionTestBase):
+
+    def setup(self):
+        super(TestSearch, self).setup()
+        search.configure({'ckanext.jsonpatch.index': 'true', 'ckanext.jsonpatch.index.prefetch_ttl': '60'})
+
+    def teardown(self):
+        search.configure({})
+
+    def test_reindex_error_does_not_fail_action(self):
+        package = factories.Dataset()
+        with mock.patch('ckan.lib.search.rebuild', side_effect=SearchIndexError('Solr is unavailable')):
+            ids = create_patches('package', package['id'], [{'op': 'replace', 'path': '/title', 'value': u'New'}])
+        assert_equal(helpers.call_action('jsonpatch_list', model_name='package', object_id=package['id']), ids)
+
+    def test_search_results_patched_without_prefetch(self):
+        package = factories.Dataset()
+        other = factories.Dataset()
+        for package_dict in (package, other):
+            create_patches('package', package_dict['id'], [{'op': 'replace', 'path': '/title', 'value': u'New'}])
+        search.clear_prefetched()
+
+        results = search.patch_search_results({'results': [dict(package)]}, {})
+        assert_equal(results['results'][0]['title'], u'New')
+        # only the result set's patches are loaded
+        assert_is_none(search._prefetched)
@@ -0,0 +1,41 @@
+# encoding: utf-8
+
+from nose.tools import assert_equal
+
+from ckanext.jsonpatch.lib import stats
+
+
+@stats.timed_action
+def _update(context, data_dict):
+    # like jsonpatch_update: the model and scope are those of the patch, given only its id
+    timed = stats.timers('_update', 'package', u'public')
+    with timed('save'):
+        pass
+    if data_dict.get('nested'):
+        _update(context, {})
+
+
+class TestTimedAction(object):
+
+    def setup(self):
+        stats.configure({'ckanext.jsonpatch.stats': 'true', 'ckanext.jsonpatch.stats.log': 'true'})
+
+    def teardown(self):
+        stats.configure({})
+
+    def _keys(self):
+        return sorted((stat['phase'], stat['model_name'], stat['scope'], stat['count'])
+                      for stat in stats.snapshot())
+
+    def test_total_recorded_with_phases(self):
+        _update({}, {'id': u'some-patch'})
+        assert_equal(self._keys(), [('save', 'package', u'public', 1), ('total', 'package', u'public', 1)])
+
+    def test_nested_call(self):
+        _update({}, {'id': u'some-patch', 'nested': True})
+        assert_equal(self._keys(), [('save', 'package', u'public', 2), ('total', 'package', u'public', 2)])
+
+    def test_disabled(self):
+        stats.configure({})
+        _update({}, {'id': u'some-patch'})
+        assert_equal(stats.snapshot(), [])